@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Callback dispatch: the old if/elif chain in handle_callback vs. CallbackRouter.
+
+The chain is rebuilt from the last revision that had it (--chain-rev), keeping
+its conditions in order and dropping the branch bodies, so it costs what
+finding the branch cost. Like the old branches, it is charged one
+data.split("_"); it is not charged their int() parsing. The router figures
+include arg conversion. Buttons now carry "~<base64>" data, so the router is
+timed on that and on the legacy "name_<id>" form old messages still send.
+
+    python3 benchmarks/callback_router.py [--chain-rev REV] [--number N]
+"""
+
+import argparse
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import timeit
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--chain-rev', default='7fd3aa1', help='git revision whose handle_callback has the elif chain')
+parser.add_argument('--number', type=int, default=20000, help='resolves per timing run')
+args = parser.parse_args()
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# bot opens its module-level database on import, so point it somewhere disposable
+os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bot_database.db')
+sys.path.insert(0, root)
+logging.disable(logging.INFO)  # migration chatter
+
+import bot  # noqa: E402
+
+# (legacy data, pattern and args to encode it with, or None for an exact route)
+SAMPLES = [
+    ('view_products', None),
+    ('main_menu', None),
+    ('admin_panel', None),
+    ('plan_12', ('plan_', 12)),
+    ('buy_12_5', ('buy_', 12, 5)),
+    ('admin_keys_next_3_free_1200', ('admin_keys_next_', 3, 'free', 1200)),
+    ('admin_view_user_5798359099', ('admin_view_user_', 5798359099)),
+    ('admin_set_plan_price_5798359099_12', ('admin_set_plan_price_', 5798359099, 12)),
+    ('admin_unban_user_42', ('admin_unban_user_', 42)),
+    ('admin_confirm_delete_5798359099', ('admin_confirm_delete_', 5798359099)),
+]
+
+
+def load_chain(rev):
+    # Returns a function mapping data to the index of the branch that takes it
+    source = subprocess.run(
+        ['git', 'show', f'{rev}:bot.py'], cwd=root, capture_output=True, text=True, check=True
+    ).stdout.replace('\r\n', '\n')
+    body = source[source.index('        # Main menu handlers\n'):source.index('    except Exception as e:\n        logging.error(f"Error in callback handler')]
+    conditions = [line.strip() for line in body.splitlines() if re.match(r'\s*(if|elif) ', line)]
+    chain = 'def chain(data):\n'
+    for n, condition in enumerate(conditions):
+        chain += f'    {condition}\n        return {n}\n'
+    chain += '    return None\n'
+    namespace = {}
+    exec(chain, namespace)
+    return namespace['chain'], len(conditions)
+
+
+def ns_per_call(function):
+    return min(timeit.repeat(function, number=args.number, repeat=5)) / args.number * 1e9
+
+
+if __name__ == '__main__':
+    chain, branches = load_chain(args.chain_rev)
+    router = bot.callback_router
+    print(f"chain from {args.chain_rev} ({branches} branches), Python {sys.version.split()[0]}, ns per resolve")
+    print(f"{'callback data':36} {'branch':>6} {'chain':>7} {'legacy':>7} {'~data':>7}")
+    for data, encode in SAMPLES:
+        encoded = router.encode(*encode) if encode else data
+        assert router.resolve(data)[0] is router.resolve(encoded)[0] is not None, data
+        chain_ns = ns_per_call(lambda: (chain(data), data.split('_')))
+        legacy_ns = ns_per_call(lambda: router.resolve(data))
+        encoded_ns = ns_per_call(lambda: router.resolve(encoded)) if encode else legacy_ns
+        print(f"{data:36} {chain(data):>6} {chain_ns:7.0f} {legacy_ns:7.0f} {encoded_ns:7.0f}")
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Write throughput: one commit per write vs. the group-commit writer.
+
+Runs the same balance updates both ways against a fresh database with the
+bot's own connection settings (the writer fsyncs every commit), so run it on
+the disk the bot uses, not tmpfs:
+
+    python3 benchmarks/group_commit.py [--writes N] [--concurrency N] [--dir PATH]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--writes', type=int, default=5000)
+parser.add_argument('--concurrency', type=int, default=64, help='writes in flight at once')
+parser.add_argument('--dir', default='.', help='directory for the scratch databases')
+args = parser.parse_args()
+
+scratch = tempfile.mkdtemp(prefix='bench_', dir=args.dir)
+# bot opens its module-level database on import, so keep that in the scratch dir too
+os.environ['DATABASE_PATH'] = os.path.join(scratch, 'import.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+logging.disable(logging.INFO)  # migration chatter
+
+import bot  # noqa: E402
+
+
+def fresh_database(name):
+    database = bot.Database(os.path.join(scratch, name))
+    for user_id in range(1, args.concurrency + 1):
+        database.create_user(user_id)
+    return database
+
+
+def one_commit_per_write():
+    database = fresh_database('serial.db')
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        start = time.perf_counter()
+        list(pool.map(
+            lambda i: database.update_user_balance(i % args.concurrency + 1, 1, 'admin_add'), range(args.writes)
+        ))
+        return time.perf_counter() - start
+
+
+def group_commit():
+    async_db = bot.AsyncDatabase(fresh_database('grouped.db'))
+    semaphore = asyncio.Semaphore(args.concurrency)
+    
+    async def write(i):
+        async with semaphore:
+            await async_db.update_user_balance(i % args.concurrency + 1, 1, 'admin_add')
+    
+    async def run():
+        start = time.perf_counter()
+        await asyncio.gather(*(write(i) for i in range(args.writes)))
+        return time.perf_counter() - start
+    
+    return asyncio.run(run())
+
+
+if __name__ == '__main__':
+    print(f"{args.writes} writes, {args.concurrency} in flight, databases in {scratch}")
+    for name, bench in (('one commit per write', one_commit_per_write), ('group commit', group_commit)):
+        elapsed = bench()
+        print(f"{name:>22}: {args.writes / elapsed:9.0f} writes/s")
+    shutil.rmtree(scratch)
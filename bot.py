@@ -1,24 +1,692 @@
+import asyncio
+import base64
+import concurrent.futures
+import csv
+import functools
+import hashlib
+import hmac
+import io
+import json
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import Application, BasePersistence, BaseUpdateProcessor, PersistenceInput, CommandHandler, CallbackQueryHandler, MessageHandler, TypeHandler, filters, ContextTypes
 import sqlite3
+import threading
+import time
+import queue
+import secrets
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from pathlib import Path
 import os
 
 # Bot configuration - USE ENVIRONMENT VARIABLES IN PRODUCTION
 BOT_TOKEN = os.getenv('BOT_TOKEN', "7767040819:AAFJfbJr2qFFVzeQCPkF54QeesYjAl7ssAw")
-ADMIN_IDS = [5798359099]  # Your user ID
+ADMIN_IDS = frozenset({5798359099})  # Owner user IDs: always admins, and the only ones who can appoint admins
 STORE_NAME = "TM Panel Store"
 
+# Update delivery: "polling" (default) or "webhook". In webhook mode the bot runs
+# its own HTTP listener and registers WEBHOOK_URL/WEBHOOK_PATH with Telegram.
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # Public base URL, e.g. https://shop.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+# Telegram echoes this in X-Telegram-Bot-Api-Secret-Token and other requests are
+# rejected. Set it explicitly when several instances share one webhook.
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))  # Parallel deliveries Telegram may open
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '32'))  # Updates handled at once (one at a time per user)
+
+# When set, buttons carrying IDs are HMAC-signed and unsigned or legacy
+# "name_<id>" callback data for them is refused
+CALLBACK_SECRET = os.getenv('CALLBACK_SECRET', '').encode()
+CALLBACK_SIGNATURE_BYTES = 6
+
+# Database configuration
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'bot_database.db')
+DB_READ_POOL_SIZE = int(os.getenv('DB_READ_POOL_SIZE', '4'))  # Read-only connections alongside the writer
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHE_SIZE_KB = 16384
+DB_MMAP_SIZE = 128 * 1024 * 1024
+GROUP_COMMIT_WINDOW = 0.002  # seconds the writer waits to gather more writes into one commit
+GROUP_COMMIT_MAX_BATCH = 256  # Most writes applied in one transaction
+
+# Checkout configuration
+BULK_QUANTITIES = (5, 10, 25, 50)  # Extra "Buy N" buttons on the plan page
+MAX_PURCHASE_QUANTITY = 100
+MAX_INLINE_KEYS_LENGTH = 3500  # Longer key lists are delivered as a .txt document
+PAGE_SIZE = 15  # Rows per page on the paginated user and order lists
+USER_SEARCH_LIMIT = 10  # Results shown for an admin user search
+STATEMENT_DAYS = 30  # Window of a user's balance statement
+STATEMENT_LIMIT = 20  # Most recent postings shown on a statement
+PURCHASED_KEYS_PAGE_SIZE = 8  # keeps a page of max-length keys under Telegram's 4096-char message limit
+KEY_PAGE_SIZE = 10  # Keys per page in the admin key browser (each gets a delete button)
+KEY_FILTERS = {'all': None, 'free': 0, 'used': 1}  # Key browser filter -> is_used
+KEY_IMPORT_BATCH_SIZE = 5000  # Rows per executemany call when importing keys
+MAX_KEY_LENGTH = 256  # Longer lines in an import are counted as invalid
+MAX_KEY_FILE_SIZE = 20 * 1024 * 1024  # Bot API download limit
+PERSISTENCE_INTERVAL = 5  # seconds between user_data/chat_data write-behind flushes
+PERSISTED_TABLES = ('user_data', 'chat_data')
+FLOW_SWEEP_INTERVAL = 60  # seconds between sweeps for timed-out input flows
+PROFILE_FLUSH_INTERVAL = 5  # seconds between batched Telegram profile upserts
+
+# In-process cache configuration
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300  # seconds
+PRICE_CACHE_SIZE = 2000  # Per-user resolved price maps
+PRICE_CACHE_TTL = 600  # seconds
+PROFILE_CACHE_SIZE = 50000  # Last profile written per user, to skip unchanged ones
+PROFILE_CACHE_TTL = 3600  # seconds
+
+# Schema migrations, applied in order on startup. PRAGMA user_version stores
+# how many have run, so only add new entries at the end - never edit old ones.
+MIGRATIONS = [
+    # 1: indexes for stock lookups, purchase history, order history and the transaction log
+    (
+        'CREATE INDEX IF NOT EXISTS idx_product_keys_plan_stock ON product_keys (plan_id, is_used, key_id)',
+        'CREATE INDEX IF NOT EXISTS idx_product_keys_used_by ON product_keys (used_by, used_at)',
+        'CREATE INDEX IF NOT EXISTS idx_product_plans_product ON product_plans (product_id, validity_days)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_plan ON orders (plan_id)',
+        'CREATE INDEX IF NOT EXISTS idx_balance_transactions_created ON balance_transactions (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_balance_transactions_user ON balance_transactions (user_id, created_at)',
+        # INSERT OR REPLACE in set_reseller_price needs a unique key to replace on
+        'DELETE FROM reseller_prices WHERE id NOT IN (SELECT MAX(id) FROM reseller_prices GROUP BY reseller_id, plan_id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_reseller_prices_reseller_plan ON reseller_prices (reseller_id, plan_id)',
+    ),
+    # 2: store-wide counters for the admin panel, seeded once and kept current by triggers
+    (
+        'CREATE TABLE IF NOT EXISTS store_counters (name TEXT PRIMARY KEY, value NUMERIC NOT NULL DEFAULT 0)',
+        '''INSERT OR REPLACE INTO store_counters (name, value)
+           SELECT 'total_sales', COUNT(*) FROM orders
+           UNION ALL SELECT 'total_revenue', COALESCE(SUM(total_price), 0) FROM orders
+           UNION ALL SELECT 'total_users', COUNT(*) FROM users
+           UNION ALL SELECT 'banned_users', COUNT(*) FROM users WHERE is_banned = 1
+           UNION ALL SELECT 'total_products', COUNT(*) FROM products WHERE is_active = 1
+           UNION ALL SELECT 'total_keys', COUNT(*) FROM product_keys
+           UNION ALL SELECT 'used_keys', COUNT(*) FROM product_keys WHERE is_used = 1''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_counters_order_insert AFTER INSERT ON orders BEGIN
+               UPDATE store_counters SET value = value + 1 WHERE name = 'total_sales';
+               UPDATE store_counters SET value = value + COALESCE(NEW.total_price, 0) WHERE name = 'total_revenue';
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_counters_order_delete AFTER DELETE ON orders BEGIN
+               UPDATE store_counters SET value = value - 1 WHERE name = 'total_sales';
+               UPDATE store_counters SET value = value - COALESCE(OLD.total_price, 0) WHERE name = 'total_revenue';
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_counters_user_insert AFTER INSERT ON users BEGIN
+               UPDATE store_counters SET value = value + 1 WHERE name = 'total_users';
+               UPDATE store_counters SET value = value + (NEW.is_banned = 1) WHERE name = 'banned_users';
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_counters_user_delete AFTER DELETE ON users BEGIN
+               UPDATE store_counters SET value = value - 1 WHERE name = 'total_users';
+               UPDATE store_counters SET value = value - (OLD.is_banned = 1) WHERE name = 'banned_users';
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_counters_user_ban AFTER UPDATE OF is_banned ON users BEGIN
+               UPDATE store_counters SET value = value + (NEW.is_banned = 1) - (OLD.is_banned = 1) WHERE name = 'banned_users';
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_counters_product_insert AFTER INSERT ON products BEGIN
+               UPDATE store_counters SET value = value + (NEW.is_active = 1) WHERE name = 'total_products';
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_counters_product_delete AFTER DELETE ON products BEGIN
+               UPDATE store_counters SET value = value - (OLD.is_active = 1) WHERE name = 'total_products';
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_counters_product_active AFTER UPDATE OF is_active ON products BEGIN
+               UPDATE store_counters SET value = value + (NEW.is_active = 1) - (OLD.is_active = 1) WHERE name = 'total_products';
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_counters_key_insert AFTER INSERT ON product_keys BEGIN
+               UPDATE store_counters SET value = value + 1 WHERE name = 'total_keys';
+               UPDATE store_counters SET value = value + (NEW.is_used = 1) WHERE name = 'used_keys';
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_counters_key_delete AFTER DELETE ON product_keys BEGIN
+               UPDATE store_counters SET value = value - 1 WHERE name = 'total_keys';
+               UPDATE store_counters SET value = value - (OLD.is_used = 1) WHERE name = 'used_keys';
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_counters_key_used AFTER UPDATE OF is_used ON product_keys BEGIN
+               UPDATE store_counters SET value = value + (NEW.is_used = 1) - (OLD.is_used = 1) WHERE name = 'used_keys';
+           END''',
+    ),
+    # 3: keyset pagination for the user list and per-user order history
+    (
+        'CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at, user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_user_order ON orders (user_id, order_id)',
+    ),
+    # 4: one row per key value within a plan, so bulk imports can skip duplicates with INSERT OR IGNORE.
+    # Unused duplicates go (a sold copy wins over an unused one) and stock is recounted. Extra sold
+    # copies back order history, so they stay, flagged is_duplicate and left out of the unique index.
+    (
+        'ALTER TABLE product_keys ADD COLUMN is_duplicate INTEGER NOT NULL DEFAULT 0',
+        '''DELETE FROM product_keys WHERE key_id IN (
+               SELECT key_id FROM (
+                   SELECT key_id, is_used,
+                          ROW_NUMBER() OVER (PARTITION BY plan_id, key_value ORDER BY is_used DESC, key_id) AS n
+                   FROM product_keys
+               ) WHERE n > 1 AND is_used = 0
+           )''',
+        '''UPDATE product_keys SET is_duplicate = 1 WHERE key_id IN (
+               SELECT key_id FROM (
+                   SELECT key_id, ROW_NUMBER() OVER (PARTITION BY plan_id, key_value ORDER BY key_id) AS n
+                   FROM product_keys
+               ) WHERE n > 1
+           )''',
+        'UPDATE product_plans SET stock = (SELECT COUNT(*) FROM product_keys k WHERE k.plan_id = product_plans.plan_id AND k.is_used = 0)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_product_keys_plan_value ON product_keys (plan_id, key_value) WHERE is_duplicate = 0',
+    ),
+    # 5: PTB user_data / chat_data as JSON, so half-finished admin flows survive a restart
+    (
+        'CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, data TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, data TEXT NOT NULL)',
+    ),
+    # 6: admin user search. A trigram FTS5 index over the name columns (kept in sync
+    # by triggers) answers substring searches; NOCASE indexes answer prefix searches
+    # for terms too short to have a trigram.
+    (
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+               username, first_name, last_name, content='users', content_rowid='user_id', tokenize='trigram'
+           )''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_users_fts_insert AFTER INSERT ON users BEGIN
+               INSERT INTO users_fts (rowid, username, first_name, last_name)
+               VALUES (NEW.user_id, NEW.username, NEW.first_name, NEW.last_name);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_users_fts_delete AFTER DELETE ON users BEGIN
+               INSERT INTO users_fts (users_fts, rowid, username, first_name, last_name)
+               VALUES ('delete', OLD.user_id, OLD.username, OLD.first_name, OLD.last_name);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_users_fts_update AFTER UPDATE OF username, first_name, last_name ON users BEGIN
+               INSERT INTO users_fts (users_fts, rowid, username, first_name, last_name)
+               VALUES ('delete', OLD.user_id, OLD.username, OLD.first_name, OLD.last_name);
+               INSERT INTO users_fts (rowid, username, first_name, last_name)
+               VALUES (NEW.user_id, NEW.username, NEW.first_name, NEW.last_name);
+           END''',
+        "INSERT INTO users_fts (users_fts) VALUES ('rebuild')",
+        'CREATE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE)',
+        'CREATE INDEX IF NOT EXISTS idx_users_first_name ON users (first_name COLLATE NOCASE)',
+        'CREATE INDEX IF NOT EXISTS idx_users_last_name ON users (last_name COLLATE NOCASE)',
+    ),
+    # 7: money in integer cents with a double-entry ledger. users.balance_cents is the
+    # authoritative balance (balance stays as its display copy). Every entry's postings
+    # sum to zero across accounts: 'wallet' (per user_id), 'revenue', 'admin_adjustments'
+    # and 'opening_balance'. Wallet postings carry the running balance after them, so a
+    # balance as of any time is one index seek. Existing balances open the ledger.
+    (
+        'ALTER TABLE users ADD COLUMN balance_cents INTEGER NOT NULL DEFAULT 0',
+        'UPDATE users SET balance_cents = CAST(ROUND(balance * 100) AS INTEGER), balance = ROUND(balance, 2)',
+        '''CREATE TABLE IF NOT EXISTS ledger_entries (
+               entry_id INTEGER PRIMARY KEY,
+               entry_type TEXT NOT NULL,
+               order_id INTEGER,
+               admin_id INTEGER,
+               memo TEXT,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )''',
+        '''CREATE TABLE IF NOT EXISTS ledger_postings (
+               posting_id INTEGER PRIMARY KEY,
+               entry_id INTEGER NOT NULL REFERENCES ledger_entries (entry_id),
+               account TEXT NOT NULL,
+               user_id INTEGER,
+               amount_cents INTEGER NOT NULL,
+               balance_after_cents INTEGER,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )''',
+        'CREATE INDEX IF NOT EXISTS idx_ledger_postings_user ON ledger_postings (user_id, created_at)',
+        '''INSERT INTO ledger_entries (entry_type, memo)
+           SELECT 'opening_balance', 'Balance carried over from before the ledger'
+           WHERE EXISTS (SELECT 1 FROM users WHERE balance_cents != 0)''',
+        '''INSERT INTO ledger_postings (entry_id, account, user_id, amount_cents, balance_after_cents)
+           SELECT (SELECT MAX(entry_id) FROM ledger_entries), 'wallet', user_id, balance_cents, balance_cents
+           FROM users WHERE balance_cents != 0''',
+        '''INSERT INTO ledger_postings (entry_id, account, amount_cents)
+           SELECT (SELECT MAX(entry_id) FROM ledger_entries), 'opening_balance', -SUM(balance_cents)
+           FROM users WHERE balance_cents != 0 HAVING COUNT(*) > 0''',
+    ),
+]
+
+# SQL for the hot queries, shared by the Database methods that run it and by
+# INDEXED_QUERIES, so the index check explains exactly what the bot executes
+
+CLAIM_KEYS_SQL = """
+    UPDATE product_keys
+    SET is_used = 1, used_by = ?, used_at = ?, order_id = ?, expires_at = ?
+    WHERE key_id IN (
+        SELECT key_id FROM product_keys WHERE plan_id = ? AND is_used = 0 ORDER BY key_id LIMIT ?
+    ) AND is_used = 0
+    RETURNING key_value
+"""
+
+USER_ORDERS_SQL = """
+    SELECT o.*, p.name, pl.validity_days FROM orders o
+    JOIN product_plans pl ON o.plan_id = pl.plan_id
+    JOIN products p ON pl.product_id = p.product_id
+    WHERE o.user_id = ?
+    ORDER BY o.created_at DESC
+"""
+
+PLAN_ORDER_COUNT_SQL = 'SELECT COUNT(*) FROM orders WHERE plan_id = ?'
+
+PRODUCT_PLANS_SQL = """
+    SELECT * FROM product_plans
+    WHERE product_id = ? AND is_active = 1
+    ORDER BY validity_days
+"""
+
+USER_TRANSACTIONS_SQL = """
+    SELECT * FROM balance_transactions
+    WHERE user_id = ?
+    ORDER BY created_at DESC
+    LIMIT ?
+"""
+
+RECENT_TRANSACTIONS_SQL = """
+    SELECT bt.*, u.username, u.first_name
+    FROM balance_transactions bt
+    LEFT JOIN users u ON bt.user_id = u.user_id
+    ORDER BY bt.created_at DESC
+    LIMIT ?
+"""
+
+EXPORT_PURCHASED_KEYS_SQL = """
+    SELECT k.key_value, p.name, pl.validity_days, k.order_id, k.used_at, k.expires_at
+    FROM product_keys k
+    JOIN product_plans pl ON k.plan_id = pl.plan_id
+    JOIN products p ON pl.product_id = p.product_id
+    WHERE k.used_by = ?
+    ORDER BY k.used_at DESC, k.key_id DESC
+"""
+
+USER_SEARCH_SQL = """
+    SELECT u.* FROM users_fts
+    JOIN users u ON u.user_id = users_fts.rowid
+    WHERE users_fts MATCH ?
+    ORDER BY rank LIMIT ?
+"""
+
+USER_PREFIX_SEARCH_SQL = r"""
+    SELECT * FROM users
+    WHERE username LIKE ? ESCAPE '\' OR first_name LIKE ? ESCAPE '\' OR last_name LIKE ? ESCAPE '\'
+    LIMIT ?
+"""
+
+BALANCE_AS_OF_SQL = """
+    SELECT balance_after_cents FROM ledger_postings
+    WHERE user_id = ? AND created_at <= ?
+    ORDER BY created_at DESC, posting_id DESC LIMIT 1
+"""
+
+STATEMENT_SQL = """
+    SELECT lp.created_at, le.entry_type, lp.amount_cents, lp.balance_after_cents, le.memo
+    FROM ledger_postings lp
+    JOIN ledger_entries le ON le.entry_id = lp.entry_id
+    WHERE lp.user_id = ? AND lp.created_at >= ?
+    ORDER BY lp.created_at DESC, lp.posting_id DESC LIMIT ?
+"""
+
+# Keyset pages: params are the filters, then the edge row's id when from_cursor,
+# then the LIMIT. backwards walks towards the start of the list.
+
+def users_page_sql(from_cursor, backwards):
+    # Newest first on (created_at, user_id); the cursor is a user_id
+    where = ''
+    if from_cursor:
+        where = f"WHERE (created_at, user_id) {'>' if backwards else '<'} (SELECT created_at, user_id FROM users WHERE user_id = ?)"
+    order = 'ASC' if backwards else 'DESC'
+    return f"""
+        SELECT * FROM users {where}
+        ORDER BY created_at {order}, user_id {order} LIMIT ?
+    """
+
+def orders_page_sql(by_user, from_cursor, backwards):
+    # Newest first on order_id, for one user (first param) or everyone
+    conditions = []
+    if by_user:
+        conditions.append('o.user_id = ?')
+    if from_cursor:
+        conditions.append(f"o.order_id {'>' if backwards else '<'} ?")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    order = 'ASC' if backwards else 'DESC'
+    return f"""
+        SELECT o.*, p.name, pl.validity_days, u.first_name FROM orders o
+        JOIN product_plans pl ON o.plan_id = pl.plan_id
+        JOIN products p ON pl.product_id = p.product_id
+        JOIN users u ON o.user_id = u.user_id
+        {where}
+        ORDER BY o.order_id {order} LIMIT ?
+    """
+
+def keys_page_sql(filtered, from_cursor, backwards):
+    # A plan's keys, available first, on (is_used, key_id) so every filter walks
+    # idx_product_keys_plan_stock. Params: plan_id, is_used when filtered
+    conditions = ['k.plan_id = ?']
+    sign = '<' if backwards else '>'
+    if filtered:
+        conditions.append('k.is_used = ?')
+        if from_cursor:
+            conditions.append(f'k.key_id {sign} ?')
+    elif from_cursor:
+        conditions.append(f'(k.is_used, k.key_id) {sign} (SELECT is_used, key_id FROM product_keys WHERE key_id = ?)')
+    order = 'DESC' if backwards else 'ASC'
+    return f"""
+        SELECT k.key_id, k.key_value, k.is_used, u.user_id, u.first_name
+        FROM product_keys k
+        LEFT JOIN users u ON k.is_used = 1 AND k.used_by = u.user_id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY k.is_used {order}, k.key_id {order} LIMIT ?
+    """
+
+def purchased_keys_page_sql(from_cursor, backwards):
+    # A user's keys, newest purchase first, on (used_at, key_id) along
+    # idx_product_keys_used_by
+    where = 'WHERE k.used_by = ?'
+    if from_cursor:
+        where += f" AND (k.used_at, k.key_id) {'>' if backwards else '<'} (SELECT used_at, key_id FROM product_keys WHERE key_id = ?)"
+    order = 'ASC' if backwards else 'DESC'
+    return f"""
+        SELECT k.key_id, k.key_value, k.used_at, p.name, pl.validity_days, k.order_id, k.expires_at
+        FROM product_keys k
+        JOIN product_plans pl ON k.plan_id = pl.plan_id
+        JOIN products p ON pl.product_id = p.product_id
+        {where}
+        ORDER BY k.used_at {order}, k.key_id {order} LIMIT ?
+    """
+
+# Hot queries that must always be served by an index: name -> (SQL, sample params).
+# Checked on startup and by tests/test_query_plans.py. The first page of all
+# orders isn't listed: it walks the orders rowid backwards, which EXPLAIN
+# reports as a SCAN even though LIMIT stops it after one page.
+INDEXED_QUERIES = {
+    'claim keys': (CLAIM_KEYS_SQL, (0, '', 0, '', 0, 1)),
+    'user orders': (USER_ORDERS_SQL, (0,)),
+    'plan orders': (PLAN_ORDER_COUNT_SQL, (0,)),
+    'product plans': (PRODUCT_PLANS_SQL, (0,)),
+    'user transactions': (USER_TRANSACTIONS_SQL, (0, 50)),
+    'recent transactions': (RECENT_TRANSACTIONS_SQL, (50,)),
+    'purchased keys export': (EXPORT_PURCHASED_KEYS_SQL, (0,)),
+    'user search': (USER_SEARCH_SQL, ('"abc"', USER_SEARCH_LIMIT)),
+    'user prefix search': (USER_PREFIX_SEARCH_SQL, ('a%', 'a%', 'a%', USER_SEARCH_LIMIT)),
+    'balance as of': (BALANCE_AS_OF_SQL, (0, '')),
+    'statement': (STATEMENT_SQL, (0, '', STATEMENT_LIMIT)),
+    'users page': (users_page_sql(False, False), (PAGE_SIZE + 1,)),
+    'user orders page': (orders_page_sql(True, False, False), (0, PAGE_SIZE + 1)),
+    'plan keys page': (keys_page_sql(False, False, False), (0, KEY_PAGE_SIZE + 1)),
+    'filtered plan keys page': (keys_page_sql(True, False, False), (0, 0, KEY_PAGE_SIZE + 1)),
+    'purchased keys page': (purchased_keys_page_sql(False, False), (0, PURCHASED_KEYS_PAGE_SIZE + 1)),
+}
+for backwards in (False, True):
+    direction = 'prev' if backwards else 'next'
+    INDEXED_QUERIES[f'users page {direction}'] = (users_page_sql(True, backwards), (0, PAGE_SIZE + 1))
+    INDEXED_QUERIES[f'all orders page {direction}'] = (orders_page_sql(False, True, backwards), (0, PAGE_SIZE + 1))
+    INDEXED_QUERIES[f'user orders page {direction}'] = (orders_page_sql(True, True, backwards), (0, 0, PAGE_SIZE + 1))
+    INDEXED_QUERIES[f'plan keys page {direction}'] = (keys_page_sql(False, True, backwards), (0, 0, KEY_PAGE_SIZE + 1))
+    INDEXED_QUERIES[f'filtered plan keys page {direction}'] = (keys_page_sql(True, True, backwards), (0, 0, 0, KEY_PAGE_SIZE + 1))
+    INDEXED_QUERIES[f'purchased keys page {direction}'] = (purchased_keys_page_sql(True, backwards), (0, 0, PURCHASED_KEYS_PAGE_SIZE + 1))
+
+def is_unindexed_step(detail):
+    # True for an EXPLAIN QUERY PLAN step that reads a whole table or sorts:
+    # keyset pages and LIMITed lookups rely on reading an index in order, so
+    # a TEMP B-TREE is as much a regression as a full scan
+    return (detail.startswith('SCAN') and 'INDEX' not in detail) or 'TEMP B-TREE' in detail
+
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
 
+class PurchaseError(Exception):
+    # Raised inside a purchase transaction to roll it back with a user-facing reason
+    pass
+
+class LRUCache:
+    # Thread-safe LRU cache with a per-entry TTL and hit/miss counters.
+    # invalidate() bumps a version so a read that started before the
+    # invalidation can't put a stale value back afterwards.
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, version=None):
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.version += 1
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+class CatalogSnapshot:
+    # In-memory view of the active catalog so browsing never touches SQLite.
+    # Product and plan rows have the same shape as the table rows. The
+    # snapshot is replaced wholesale on admin edits; only the free-key
+    # counters are adjusted in place.
+    def __init__(self, products, plans, stock):
+        self.products = {product[0]: product for product in products}
+        self.plans = {}
+        self.plans_by_product = {product_id: [] for product_id in self.products}
+        for plan in plans:
+            if plan[1] in self.products:
+                self.plans[plan[0]] = plan
+                self.plans_by_product[plan[1]].append(plan)
+        self.stock = stock
+        self.stock_lock = threading.Lock()
+
+    def get_products(self):
+        return list(self.products.values())
+
+    def get_product(self, product_id):
+        return self.products.get(product_id)
+
+    def get_product_plans(self, product_id):
+        return self.plans_by_product.get(product_id, [])
+
+    def get_plan(self, plan_id):
+        return self.plans.get(plan_id)
+
+    def get_stock(self, plan_id):
+        return self.stock.get(plan_id, 0)
+
+    def adjust_stock(self, plan_id, delta):
+        with self.stock_lock:
+            self.stock[plan_id] = self.stock.get(plan_id, 0) + delta
+
+# Stats for a product or plan with no keys and no orders yet
+EMPTY_STATS = {'sold': 0, 'available': 0, 'total_keys': 0, 'revenue': 0}
+
+def to_cents(amount):
+    # Dollars (as entered or as a REAL price) to integer cents
+    return int(round(amount * 100))
+
+def read_only(method):
+    # Marks Database methods that never write, so they can use the reader pool
+    method.read_only = True
+    return method
+
 class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect('bot_database.db', check_same_thread=False)
+    def __init__(self, path=DATABASE_PATH, read_pool_size=DB_READ_POOL_SIZE):
+        self.path = path
+        self.read_pool_size = read_pool_size
+        
+        # Single writer connection; all writes are serialized by write_lock
+        self.write_lock = threading.RLock()
+        self.transaction_depth = 0
+        self.commit_hooks = []
+        
+        self.user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self.price_cache = LRUCache(PRICE_CACHE_SIZE, PRICE_CACHE_TTL)
+        
+        # Telegram profiles seen on updates, written behind by flush_profiles
+        self.known_profiles = LRUCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+        self.pending_profiles = {}
+        self.profile_lock = threading.Lock()
+        self.catalog = None
+        self.admin_ids = frozenset()  # Role table: users with user_type 'admin'
+        self.conn = self.connect()
+        self.conn.execute('PRAGMA journal_mode = WAL')
         self.create_tables()
+        self.run_migrations()
+        self.rebuild_catalog()
+        self.load_admin_ids()
+        
+        # Read-only connections; WAL lets them run alongside the writer
+        self.read_pool = queue.Queue()
+        for _ in range(read_pool_size):
+            self.read_pool.put(self.connect(read_only=True))
+    
+    def connect(self, read_only=False):
+        if read_only:
+            uri = Path(self.path).resolve().as_uri() + '?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+        # The writer fsyncs the WAL on every commit, so a write that has been
+        # reported done survives a power loss; group commit keeps that affordable
+        conn.execute(f"PRAGMA synchronous = {'NORMAL' if read_only else 'FULL'}")
+        conn.execute(f'PRAGMA cache_size = -{DB_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size = {DB_MMAP_SIZE}')
+        return conn
+    
+    @contextmanager
+    def reader(self):
+        conn = self.read_pool.get()
+        try:
+            yield conn
+        finally:
+            self.read_pool.put(conn)
+    
+    @contextmanager
+    def transaction(self):
+        # Only the outermost call commits. BEGIN IMMEDIATE takes the write lock
+        # up front, so concurrent writers (other processes included) queue here
+        # instead of failing mid-way. Nested calls run in a SAVEPOINT: an
+        # exception undoes just that block, and its commit hooks, while the
+        # outer transaction carries on.
+        with self.write_lock:
+            self.transaction_depth += 1
+            depth = self.transaction_depth
+            hooks_mark = len(self.commit_hooks)
+            try:
+                if depth == 1:
+                    self.conn.execute('BEGIN IMMEDIATE')
+                else:
+                    self.conn.execute(f'SAVEPOINT sp{depth}')
+                yield self.conn
+                if depth == 1:
+                    self.conn.commit()
+                else:
+                    self.conn.execute(f'RELEASE sp{depth}')
+            except Exception:
+                if depth == 1:
+                    self.conn.rollback()
+                    self.commit_hooks = []
+                else:
+                    self.conn.execute(f'ROLLBACK TO sp{depth}')
+                    self.conn.execute(f'RELEASE sp{depth}')
+                    del self.commit_hooks[hooks_mark:]
+                raise
+            finally:
+                self.transaction_depth -= 1
+            # The writes are committed by now, so a failing hook is logged rather
+            # than raised: callers must not be told their committed write failed
+            if depth == 1:
+                hooks, self.commit_hooks = self.commit_hooks, []
+                for hook in hooks:
+                    try:
+                        hook()
+                    except Exception as e:
+                        logging.error(f"Error in commit hook: {e}")
+    
+    def run_batch(self, calls):
+        # Group commit: runs each (method, args, kwargs) in its own savepoint
+        # inside one transaction, so they share a single commit but a failing
+        # call only undoes itself. Returns (ok, result or exception) per call.
+        results = []
+        with self.transaction():
+            for method, args, kwargs in calls:
+                try:
+                    with self.transaction():
+                        results.append((True, method(*args, **kwargs)))
+                except Exception as e:
+                    results.append((False, e))
+        return results
+    
+    def after_commit(self, hook):
+        # Runs hook once the current transaction commits; dropped on rollback
+        self.commit_hooks.append(hook)
+    
+    def invalidate_user(self, user_id):
+        self.after_commit(lambda: self.user_cache.invalidate(user_id))
+    
+    def invalidate_catalog(self):
+        # Base prices may have changed, so every resolved price map goes too
+        self.after_commit(self.price_cache.clear)
+        self.after_commit(self.rebuild_catalog)
+    
+    def adjust_catalog_stock(self, plan_id, delta):
+        # Bound to the snapshot current now: if a rebuild queued in the same
+        # commit runs first, it already counts this change from the database
+        catalog = self.catalog
+        self.after_commit(lambda: catalog.adjust_stock(plan_id, delta))
+    
+    def load_admin_ids(self):
+        with self.write_lock:
+            rows = self.conn.execute("SELECT user_id FROM users WHERE user_type = 'admin'").fetchall()
+            self.admin_ids = frozenset(row[0] for row in rows)
+    
+    def set_admin_role(self, user_id, is_admin):
+        # Swaps in a new frozenset once the transaction commits, so readers on
+        # other threads never see a set being modified
+        def apply():
+            self.admin_ids = self.admin_ids | {user_id} if is_admin else self.admin_ids - {user_id}
+        self.after_commit(apply)
+    
+    def get_role(self, user_id):
+        # 'owner' for ADMIN_IDS, 'admin' for admin accounts, otherwise None.
+        # Answered from memory, so a refused request never reaches SQLite.
+        if user_id in ADMIN_IDS:
+            return 'owner'
+        if user_id in self.admin_ids:
+            return 'admin'
+        return None
+    
+    def rebuild_catalog(self):
+        # Runs under write_lock, so no purchase can adjust stock mid-rebuild
+        with self.write_lock:
+            products = self.conn.execute('SELECT * FROM products WHERE is_active = 1 ORDER BY product_id').fetchall()
+            plans = self.conn.execute('SELECT * FROM product_plans WHERE is_active = 1 ORDER BY product_id, validity_days').fetchall()
+            stock = dict(self.conn.execute('SELECT plan_id, COUNT(*) FROM product_keys WHERE is_used = 0 GROUP BY plan_id').fetchall())
+            self.catalog = CatalogSnapshot(products, plans, stock)
     
     def create_tables(self):
         # Users table with ban support
@@ -123,457 +791,1067 @@ class Database:
         
         self.conn.commit()
 
+    def run_migrations(self):
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            # Each migration and its version bump commit together
+            with self.transaction() as conn:
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {number}')
+            logging.info(f"Applied database migration {number}")
+
+    @read_only
+    def find_unindexed_queries(self):
+        # Returns the names of INDEXED_QUERIES whose plan has a full table scan or a sort
+        unindexed = []
+        with self.reader() as conn:
+            # EXPLAIN alone doesn't start a read, so touch sqlite_master to pick up schema changes
+            conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            for name, (sql, params) in INDEXED_QUERIES.items():
+                plan = conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+                if any(is_unindexed_step(row[3]) for row in plan):
+                    unindexed.append(name)
+        return unindexed
+
     def get_user(self, user_id):
-        cursor = self.conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        if not user:
-            # Create new user
-            self.conn.execute(
-                'INSERT INTO users (user_id, first_name, username) VALUES (?, ?, ?)', 
-                (user_id, "User", "username")
+        user = self.user_cache.get(user_id)
+        if user is None:
+            user = self.load_user(user_id) or self.create_user(user_id)
+        return user
+
+    @read_only
+    def load_user(self, user_id):
+        # Returns None for a user with no row yet; create_user adds it
+        version = self.user_cache.version
+        with self.reader() as conn:
+            user = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        if user:
+            self.user_cache.put(user_id, user, version)
+        return user
+
+    def create_user(self, user_id):
+        # Create new user with the profile from the update that brought them here
+        version = self.user_cache.version
+        username, first_name, last_name = self.pending_profiles.get(user_id, (None, None, None))
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO users (user_id, username, first_name, last_name) VALUES (?, ?, ?, ?)', 
+                (user_id, username, first_name, last_name)
             )
-            self.conn.commit()
-            cursor = self.conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-            user = cursor.fetchone()
+            user = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+            self.after_commit(lambda: self.user_cache.put(user_id, user, version))
         return user
 
+    def queue_profile(self, user_id, profile):
+        # profile is (username, first_name, last_name) from an update. Only a
+        # change from the last one seen is queued for the next flush_profiles.
+        if self.known_profiles.get(user_id) == profile:
+            return
+        self.known_profiles.put(user_id, profile)
+        with self.profile_lock:
+            self.pending_profiles[user_id] = profile
+    
+    def flush_profiles(self):
+        # Upserts every queued profile in one transaction; rows that already
+        # match are left alone so the search index isn't touched. Returns the
+        # number of profiles flushed.
+        with self.profile_lock:
+            pending, self.pending_profiles = self.pending_profiles, {}
+        if not pending:
+            return 0
+        try:
+            with self.transaction() as conn:
+                conn.executemany('''
+                    INSERT INTO users (user_id, username, first_name, last_name) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        username = excluded.username, first_name = excluded.first_name, last_name = excluded.last_name
+                    WHERE users.username IS NOT excluded.username
+                       OR users.first_name IS NOT excluded.first_name
+                       OR users.last_name IS NOT excluded.last_name
+                ''', [(user_id, *profile) for user_id, profile in pending.items()])
+                for user_id in pending:
+                    self.invalidate_user(user_id)
+        except Exception:
+            # Put them back for the next flush unless a newer profile arrived meanwhile
+            with self.profile_lock:
+                for user_id, profile in pending.items():
+                    self.pending_profiles.setdefault(user_id, profile)
+            raise
+        return len(pending)
+    
+    @read_only
     def is_user_banned(self, user_id):
-        user = self.get_user(user_id)
+        # A user with no row yet can't be banned, so this never creates one
+        user = self.user_cache.get(user_id) or self.load_user(user_id)
         return user[6] if user else False  # is_banned field
 
     def ban_user(self, user_id, reason="No reason provided", admin_id=None):
-        self.conn.execute(
-            'UPDATE users SET is_banned = 1, ban_reason = ?, banned_at = ? WHERE user_id = ?',
-            (reason, datetime.now(), user_id)
-        )
-        # Log the action
-        if admin_id:
-            self.conn.execute(
-                'INSERT INTO balance_transactions (user_id, amount, transaction_type, admin_id, reason) VALUES (?, ?, ?, ?, ?)',
-                (user_id, 0, 'ban', admin_id, reason)
+        with self.transaction() as conn:
+            self.invalidate_user(user_id)
+            conn.execute(
+                'UPDATE users SET is_banned = 1, ban_reason = ?, banned_at = ? WHERE user_id = ?',
+                (reason, datetime.now(), user_id)
             )
-        self.conn.commit()
+            # Log the action
+            if admin_id:
+                conn.execute(
+                    'INSERT INTO balance_transactions (user_id, amount, transaction_type, admin_id, reason) VALUES (?, ?, ?, ?, ?)',
+                    (user_id, 0, 'ban', admin_id, reason)
+                )
 
     def unban_user(self, user_id, admin_id=None):
-        self.conn.execute(
-            'UPDATE users SET is_banned = 0, ban_reason = NULL, banned_at = NULL WHERE user_id = ?',
-            (user_id,)
-        )
-        # Log the action
-        if admin_id:
-            self.conn.execute(
-                'INSERT INTO balance_transactions (user_id, amount, transaction_type, admin_id, reason) VALUES (?, ?, ?, ?, ?)',
-                (user_id, 0, 'unban', admin_id, 'User unbanned')
+        with self.transaction() as conn:
+            self.invalidate_user(user_id)
+            conn.execute(
+                'UPDATE users SET is_banned = 0, ban_reason = NULL, banned_at = NULL WHERE user_id = ?',
+                (user_id,)
             )
-        self.conn.commit()
+            # Log the action
+            if admin_id:
+                conn.execute(
+                    'INSERT INTO balance_transactions (user_id, amount, transaction_type, admin_id, reason) VALUES (?, ?, ?, ?, ?)',
+                    (user_id, 0, 'unban', admin_id, 'User unbanned')
+                )
 
     def delete_user(self, user_id, admin_id=None):
-        # Log before deletion
-        if admin_id:
-            self.conn.execute(
+        with self.transaction() as conn:
+            self.invalidate_user(user_id)
+            self.set_admin_role(user_id, False)
+            # Close out whatever is left in the wallet so the ledger still balances
+            row = conn.execute('SELECT balance_cents FROM users WHERE user_id = ?', (user_id,)).fetchone()
+            if row and row[0]:
+                self.record_entry(
+                    conn, 'account_closed',
+                    [('wallet', user_id, -row[0], 0), ('admin_adjustments', None, row[0], None)],
+                    admin_id=admin_id, memo='User account deleted'
+                )
+            # Log before deletion
+            if admin_id:
+                conn.execute(
+                    'INSERT INTO balance_transactions (user_id, amount, transaction_type, admin_id, reason) VALUES (?, ?, ?, ?, ?)',
+                    (user_id, 0, 'delete_user', admin_id, 'User account deleted')
+                )
+            # Actually delete user
+            conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+
+    def update_user_balance(self, user_id, amount, transaction_type="admin_adjustment", admin_id=None, reason=""):
+        cents = to_cents(amount)
+        with self.transaction() as conn:
+            self.invalidate_user(user_id)
+            # Update balance, offset against the admin adjustments account
+            wallet = conn.execute(
+                'UPDATE users SET balance_cents = balance_cents + ?, balance = (balance_cents + ?) / 100.0 WHERE user_id = ? RETURNING balance_cents',
+                (cents, cents, user_id)
+            ).fetchone()
+            if wallet:
+                self.record_entry(
+                    conn, transaction_type,
+                    [('wallet', user_id, cents, wallet[0]), ('admin_adjustments', None, -cents, None)],
+                    admin_id=admin_id, memo=reason
+                )
+
+            # Log transaction
+            conn.execute(
                 'INSERT INTO balance_transactions (user_id, amount, transaction_type, admin_id, reason) VALUES (?, ?, ?, ?, ?)',
-                (user_id, 0, 'delete_user', admin_id, 'User account deleted')
+                (user_id, amount, transaction_type, admin_id, reason)
             )
-        # Actually delete user
-        self.conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
-        self.conn.commit()
 
-    def update_user_balance(self, user_id, amount, transaction_type="admin_adjustment", admin_id=None, reason=""):
-        # Update balance
-        self.conn.execute(
-            'UPDATE users SET balance = balance + ? WHERE user_id = ?',
-            (amount, user_id)
+    def record_entry(self, conn, entry_type, postings, order_id=None, admin_id=None, memo=None):
+        # Writes one ledger entry inside the caller's transaction. postings are
+        # (account, user_id, amount_cents, balance_after_cents) and must sum to
+        # zero; the caller has already moved users.balance_cents for wallets.
+        if sum(posting[2] for posting in postings) != 0:
+            raise ValueError(f"Unbalanced ledger entry: {postings}")
+        entry_id = conn.execute(
+            'INSERT INTO ledger_entries (entry_type, order_id, admin_id, memo) VALUES (?, ?, ?, ?)',
+            (entry_type, order_id, admin_id, memo)
+        ).lastrowid
+        conn.executemany(
+            'INSERT INTO ledger_postings (entry_id, account, user_id, amount_cents, balance_after_cents) VALUES (?, ?, ?, ?, ?)',
+            [(entry_id, *posting) for posting in postings]
         )
-        
-        # Log transaction
-        self.conn.execute(
-            'INSERT INTO balance_transactions (user_id, amount, transaction_type, admin_id, reason) VALUES (?, ?, ?, ?, ?)',
-            (user_id, amount, transaction_type, admin_id, reason)
-        )
-        self.conn.commit()
+        return entry_id
+    
+    @read_only
+    def get_balance_at(self, user_id, at):
+        # Wallet balance in cents as of `at` (a UTC 'YYYY-MM-DD HH:MM:SS'
+        # timestamp): the running balance on the last posting up to then
+        with self.reader() as conn:
+            row = conn.execute(BALANCE_AS_OF_SQL, (user_id, at)).fetchone()
+        return row[0] if row else 0
+    
+    @read_only
+    def get_statement(self, user_id, days=STATEMENT_DAYS, limit=STATEMENT_LIMIT):
+        # Returns (opening_cents, postings) for the last `days` days. postings
+        # are the latest `limit` wallet postings, oldest first, as (created_at,
+        # entry_type, amount_cents, balance_after_cents, memo); opening_cents is
+        # the balance just before the first of them.
+        with self.reader() as conn:
+            start = conn.execute("SELECT datetime('now', ?)", (f'-{days} days',)).fetchone()[0]
+            postings = conn.execute(STATEMENT_SQL, (user_id, start, limit)).fetchall()[::-1]
+        if postings:
+            return postings[0][3] - postings[0][2], postings
+        return self.get_balance_at(user_id, start), postings
+    
+    @read_only
+    def load_persisted(self, table):
+        assert table in PERSISTED_TABLES
+        with self.reader() as conn:
+            return {row[0]: json.loads(row[1]) for row in conn.execute(f'SELECT id, data FROM {table}')}
+    
+    def save_persisted(self, table, rows):
+        # rows are (id, JSON text) pairs; None instead of text deletes the row
+        assert table in PERSISTED_TABLES
+        with self.transaction() as conn:
+            conn.executemany(f'DELETE FROM {table} WHERE id = ?', [(key,) for key, data in rows if data is None])
+            conn.executemany(
+                f'INSERT INTO {table} (id, data) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET data = excluded.data',
+                [(key, data) for key, data in rows if data is not None]
+            )
 
+    @read_only
     def get_balance_transactions(self, user_id=None, limit=50):
-        if user_id:
-            return self.conn.execute('''
-                SELECT * FROM balance_transactions 
-                WHERE user_id = ? 
-                ORDER BY created_at DESC 
-                LIMIT ?
-            ''', (user_id, limit)).fetchall()
-        else:
-            return self.conn.execute('''
-                SELECT bt.*, u.username, u.first_name 
-                FROM balance_transactions bt
-                LEFT JOIN users u ON bt.user_id = u.user_id
-                ORDER BY bt.created_at DESC 
-                LIMIT ?
-            ''', (limit,)).fetchall()
+        with self.reader() as conn:
+            if user_id:
+                return conn.execute(USER_TRANSACTIONS_SQL, (user_id, limit)).fetchall()
+            else:
+                return conn.execute(RECENT_TRANSACTIONS_SQL, (limit,)).fetchall()
 
+    @read_only
     def get_products(self):
-        return self.conn.execute('SELECT * FROM products WHERE is_active = 1').fetchall()
+        with self.reader() as conn:
+            return conn.execute('SELECT * FROM products WHERE is_active = 1').fetchall()
 
+    @read_only
     def get_all_products(self):
-        return self.conn.execute('SELECT * FROM products').fetchall()
+        with self.reader() as conn:
+            return conn.execute('SELECT * FROM products').fetchall()
+
+    @read_only
+    def get_product(self, product_id):
+        with self.reader() as conn:
+            return conn.execute('SELECT * FROM products WHERE product_id = ?', (product_id,)).fetchone()
 
+    @read_only
     def get_product_plans(self, product_id):
-        return self.conn.execute('''
-            SELECT * FROM product_plans 
-            WHERE product_id = ? AND is_active = 1 
-            ORDER BY validity_days
-        ''', (product_id,)).fetchall()
+        with self.reader() as conn:
+            return conn.execute(PRODUCT_PLANS_SQL, (product_id,)).fetchall()
 
+    @read_only
     def get_all_product_plans(self, product_id):
-        return self.conn.execute('''
-            SELECT * FROM product_plans 
-            WHERE product_id = ?
-            ORDER BY validity_days
-        ''', (product_id,)).fetchall()
+        with self.reader() as conn:
+            return conn.execute('''
+                SELECT * FROM product_plans 
+                WHERE product_id = ?
+                ORDER BY validity_days
+            ''', (product_id,)).fetchall()
+
+    @read_only
+    def get_plan_details(self, plan_id):
+        with self.reader() as conn:
+            return conn.execute('''
+                SELECT pl.*, p.name, p.description 
+                FROM product_plans pl 
+                JOIN products p ON pl.product_id = p.product_id 
+                WHERE pl.plan_id = ?
+            ''', (plan_id,)).fetchone()
 
+    @read_only
     def get_plan_price(self, plan_id, user_id):
-        # Check if user is reseller with custom price
-        reseller_price = self.conn.execute(
-            'SELECT custom_price FROM reseller_prices WHERE reseller_id = ? AND plan_id = ?',
-            (user_id, plan_id)
-        ).fetchone()
-        
-        if reseller_price:
-            return reseller_price[0]
-        
-        # Get base price
-        plan = self.conn.execute(
-            'SELECT base_price FROM product_plans WHERE plan_id = ?', 
-            (plan_id,)
-        ).fetchone()
-        
-        return plan[0] if plan else None
+        return self.get_plan_prices(user_id).get(plan_id)
+
+    @read_only
+    def get_plan_prices(self, user_id):
+        # Returns {plan_id: price} for the whole catalog as seen by user_id
+        prices = self.price_cache.get(user_id)
+        if prices is None:
+            prices = self.load_plan_prices(user_id)
+        return prices
+
+    @read_only
+    def load_plan_prices(self, user_id):
+        # Reseller overrides win over base prices; one joined query for every plan
+        version = self.price_cache.version
+        with self.reader() as conn:
+            prices = dict(conn.execute('''
+                SELECT pl.plan_id, COALESCE(rp.custom_price, pl.base_price)
+                FROM product_plans pl
+                LEFT JOIN reseller_prices rp ON rp.plan_id = pl.plan_id AND rp.reseller_id = ?
+            ''', (user_id,)).fetchall())
+        self.price_cache.put(user_id, prices, version)
+        return prices
 
     def create_order(self, user_id, plan_id, quantity=1):
-        # Check if user is banned
-        if self.is_user_banned(user_id):
-            return False, "Your account has been banned. Contact admin."
-        
-        price = self.get_plan_price(plan_id, user_id)
-        if price is None:
-            return False, "Plan not found"
-            
-        total_price = price * quantity
-        
-        # Check user balance
-        user = self.get_user(user_id)
-        if user[4] < total_price:
-            return False, "Insufficient balance"
+        # Returns (True, [key_value, ...]) or (False, reason)
+        if quantity < 1 or quantity > MAX_PURCHASE_QUANTITY:
+            return False, f"Quantity must be between 1 and {MAX_PURCHASE_QUANTITY}"
+        try:
+            with self.transaction() as conn:
+                return True, self._purchase(conn, user_id, plan_id, quantity)
+        except PurchaseError as e:
+            return False, str(e)
+
+    def _purchase(self, conn, user_id, plan_id, quantity):
+        # Runs inside one write transaction. Every check is folded into a
+        # conditional UPDATE, and any failure raises so the whole purchase
+        # rolls back: a key is never handed out twice and balance never
+        # goes negative, no matter how many buyers race for the last key.
+        plan = conn.execute('''
+            SELECT COALESCE(rp.custom_price, pl.base_price), pl.validity_days
+            FROM product_plans pl
+            LEFT JOIN reseller_prices rp ON rp.plan_id = pl.plan_id AND rp.reseller_id = ?
+            WHERE pl.plan_id = ?
+        ''', (user_id, plan_id)).fetchone()
         
-        # Get available key
-        key = self.conn.execute(
-            'SELECT key_id, key_value FROM product_keys WHERE plan_id = ? AND is_used = 0 LIMIT 1',
-            (plan_id,)
+        if not plan:
+            raise PurchaseError("Plan not found")
+        
+        total_cents = to_cents(plan[0]) * quantity
+        total_price = total_cents / 100
+        now = datetime.now()
+        expires_at = now + timedelta(days=plan[1] or 30)
+        
+        # Debit balance only if the user is not banned and can afford it
+        debited = conn.execute(
+            '''UPDATE users SET balance_cents = balance_cents - ?, balance = (balance_cents - ?) / 100.0
+               WHERE user_id = ? AND is_banned = 0 AND balance_cents >= ? RETURNING balance_cents''',
+            (total_cents, total_cents, user_id, total_cents)
         ).fetchone()
         
-        if not key:
-            return False, "Product out of stock"
-        
-        # Get plan validity
-        plan = self.conn.execute('SELECT validity_days FROM product_plans WHERE plan_id = ?', (plan_id,)).fetchone()
-        validity_days = plan[0] if plan else 30
-        expires_at = datetime.now() + timedelta(days=validity_days)
+        if not debited:
+            user = conn.execute('SELECT is_banned FROM users WHERE user_id = ?', (user_id,)).fetchone()
+            if user and user[0]:
+                raise PurchaseError("Your account has been banned. Contact admin.")
+            raise PurchaseError("Insufficient balance")
+        self.invalidate_user(user_id)
         
-        # Create order first to get order_id
-        cursor = self.conn.execute(
+        order_id = conn.execute(
             'INSERT INTO orders (user_id, plan_id, quantity, total_price) VALUES (?, ?, ?, ?)',
             (user_id, plan_id, quantity, total_price)
-        )
-        order_id = cursor.lastrowid
+        ).lastrowid
         
-        # Update key as used with order_id and expiry
-        self.conn.execute(
-            'UPDATE product_keys SET is_used = 1, used_by = ?, used_at = ?, order_id = ?, expires_at = ? WHERE key_id = ?',
-            (user_id, datetime.now(), order_id, expires_at, key[0])
-        )
+        # Claim all keys in one statement; the is_used = 0 guard makes the claim atomic
+        keys = conn.execute(CLAIM_KEYS_SQL, (user_id, now, order_id, expires_at, plan_id, quantity)).fetchall()
         
-        # Update plan stock
-        self.conn.execute(
-            'UPDATE product_plans SET stock = stock - 1 WHERE plan_id = ?',
-            (plan_id,)
-        )
+        if not keys:
+            raise PurchaseError("Product out of stock")
+        if len(keys) < quantity:
+            raise PurchaseError(f"Only {len(keys)} keys left in stock")
         
-        # Deduct balance
-        self.conn.execute(
-            'UPDATE users SET balance = balance - ? WHERE user_id = ?',
-            (total_price, user_id)
+        conn.execute(
+            'UPDATE product_plans SET stock = stock - ? WHERE plan_id = ?',
+            (quantity, plan_id)
         )
+        self.adjust_catalog_stock(plan_id, -quantity)
         
         # Log transaction
-        self.conn.execute(
+        self.record_entry(
+            conn, 'purchase',
+            [('wallet', user_id, -total_cents, debited[0]), ('revenue', None, total_cents, None)],
+            order_id=order_id, memo=f'Purchase order #{order_id}'
+        )
+        conn.execute(
             'INSERT INTO balance_transactions (user_id, amount, transaction_type, reason) VALUES (?, ?, ?, ?)',
             (user_id, -total_price, 'purchase', f'Purchase order #{order_id}')
         )
         
-        self.conn.commit()
-        return True, key[1]
+        return [key[0] for key in keys]
 
     def add_product(self, name, description):
-        cursor = self.conn.execute(
-            'INSERT INTO products (name, description) VALUES (?, ?)',
-            (name, description)
-        )
-        product_id = cursor.lastrowid
-        self.conn.commit()
-        return product_id
+        with self.transaction() as conn:
+            self.invalidate_catalog()
+            cursor = conn.execute(
+                'INSERT INTO products (name, description) VALUES (?, ?)',
+                (name, description)
+            )
+            product_id = cursor.lastrowid
+            return product_id
 
     def update_product(self, product_id, name, description):
-        self.conn.execute(
-            'UPDATE products SET name = ?, description = ? WHERE product_id = ?',
-            (name, description, product_id)
-        )
-        self.conn.commit()
+        with self.transaction() as conn:
+            self.invalidate_catalog()
+            conn.execute(
+                'UPDATE products SET name = ?, description = ? WHERE product_id = ?',
+                (name, description, product_id)
+            )
 
     def delete_product(self, product_id):
-        self.conn.execute(
-            'UPDATE products SET is_active = 0 WHERE product_id = ?',
-            (product_id,)
-        )
-        self.conn.commit()
+        with self.transaction() as conn:
+            self.invalidate_catalog()
+            conn.execute(
+                'UPDATE products SET is_active = 0 WHERE product_id = ?',
+                (product_id,)
+            )
 
     def add_product_plan(self, product_id, validity_days, price, keys):
-        cursor = self.conn.execute(
-            'INSERT INTO product_plans (product_id, validity_days, base_price, stock) VALUES (?, ?, ?, ?)',
-            (product_id, validity_days, price, len(keys))
-        )
-        plan_id = cursor.lastrowid
-        
-        for key in keys:
-            self.conn.execute(
-                'INSERT INTO product_keys (product_id, plan_id, key_value) VALUES (?, ?, ?)',
-                (product_id, plan_id, key.strip())
+        with self.transaction() as conn:
+            self.invalidate_catalog()
+            cursor = conn.execute(
+                'INSERT INTO product_plans (product_id, validity_days, base_price, stock) VALUES (?, ?, ?, 0)',
+                (product_id, validity_days, price)
             )
-        
-        self.conn.commit()
-        return plan_id
+            plan_id = cursor.lastrowid
+            self.insert_keys(conn, plan_id, keys)
+            
+            return plan_id
 
     def update_product_plan(self, plan_id, validity_days, price):
-        self.conn.execute(
-            'UPDATE product_plans SET validity_days = ?, base_price = ? WHERE plan_id = ?',
-            (validity_days, price, plan_id)
-        )
-        self.conn.commit()
+        with self.transaction() as conn:
+            self.invalidate_catalog()
+            conn.execute(
+                'UPDATE product_plans SET validity_days = ?, base_price = ? WHERE plan_id = ?',
+                (validity_days, price, plan_id)
+            )
 
     def delete_product_plan(self, plan_id):
-        self.conn.execute(
-            'UPDATE product_plans SET is_active = 0 WHERE plan_id = ?',
-            (plan_id,)
-        )
-        self.conn.commit()
+        with self.transaction() as conn:
+            self.invalidate_catalog()
+            conn.execute(
+                'UPDATE product_plans SET is_active = 0 WHERE plan_id = ?',
+                (plan_id,)
+            )
 
     def add_keys_to_plan(self, plan_id, keys):
+        # keys may be any iterable of lines, e.g. a file being streamed.
+        # Returns (inserted, duplicates, invalid).
+        with self.transaction() as conn:
+            counts = self.insert_keys(conn, plan_id, keys)
+            self.adjust_catalog_stock(plan_id, counts[0])
+            return counts
+    
+    def insert_keys(self, conn, plan_id, keys):
+        # Bulk insert inside the caller's transaction, KEY_IMPORT_BATCH_SIZE rows
+        # per executemany. Blank lines are skipped; None (undecodable), overlong
+        # or unprintable lines count as invalid; keys the plan already has count
+        # as duplicates. Bumps the plan's stock row but not the catalog.
+        product_id = conn.execute('SELECT product_id FROM product_plans WHERE plan_id = ?', (plan_id,)).fetchone()[0]
+        inserted = attempted = invalid = 0
+        batch = []
         for key in keys:
-            self.conn.execute(
-                'INSERT INTO product_keys (product_id, plan_id, key_value) VALUES ((SELECT product_id FROM product_plans WHERE plan_id = ?), ?, ?)',
-                (plan_id, plan_id, key.strip())
-            )
-        
-        self.conn.execute(
-            'UPDATE product_plans SET stock = stock + ? WHERE plan_id = ?',
-            (len(keys), plan_id)
-        )
-        
-        self.conn.commit()
-        return len(keys)
+            key = key.strip() if key is not None else None
+            if key == '':
+                continue
+            if key is None or len(key) > MAX_KEY_LENGTH or not key.isprintable():
+                invalid += 1
+                continue
+            batch.append((product_id, plan_id, key))
+            if len(batch) == KEY_IMPORT_BATCH_SIZE:
+                inserted += conn.executemany(
+                    'INSERT OR IGNORE INTO product_keys (product_id, plan_id, key_value) VALUES (?, ?, ?)', batch
+                ).rowcount
+                attempted += len(batch)
+                batch = []
+        if batch:
+            inserted += conn.executemany(
+                'INSERT OR IGNORE INTO product_keys (product_id, plan_id, key_value) VALUES (?, ?, ?)', batch
+            ).rowcount
+            attempted += len(batch)
+        
+        conn.execute('UPDATE product_plans SET stock = stock + ? WHERE plan_id = ?', (inserted, plan_id))
+        return inserted, attempted - inserted, invalid
 
     def delete_key(self, key_id):
-        key = self.conn.execute('SELECT is_used, plan_id FROM product_keys WHERE key_id = ?', (key_id,)).fetchone()
-        if key and key[0] == 0:
-            self.conn.execute('DELETE FROM product_keys WHERE key_id = ?', (key_id,))
-            self.conn.execute('UPDATE product_plans SET stock = stock - 1 WHERE plan_id = ?', (key[1],))
-            self.conn.commit()
-            return True
-        return False
+        # Returns the key's plan_id, or None if the key is used or missing
+        with self.transaction() as conn:
+            key = conn.execute('SELECT is_used, plan_id FROM product_keys WHERE key_id = ?', (key_id,)).fetchone()
+            if key and key[0] == 0:
+                conn.execute('DELETE FROM product_keys WHERE key_id = ?', (key_id,))
+                conn.execute('UPDATE product_plans SET stock = stock - 1 WHERE plan_id = ?', (key[1],))
+                self.adjust_catalog_stock(key[1], -1)
+                return key[1]
+            return None
 
     def set_reseller_price(self, reseller_id, plan_id, price):
-        self.conn.execute(
-            '''INSERT OR REPLACE INTO reseller_prices (reseller_id, plan_id, custom_price) 
-               VALUES (?, ?, ?)''',
-            (reseller_id, plan_id, price)
-        )
-        self.conn.commit()
+        with self.transaction() as conn:
+            self.after_commit(lambda: self.price_cache.invalidate(reseller_id))
+            conn.execute(
+                '''INSERT OR REPLACE INTO reseller_prices (reseller_id, plan_id, custom_price) 
+                   VALUES (?, ?, ?)''',
+                (reseller_id, plan_id, price)
+            )
 
+    @read_only
     def get_reseller_prices(self, reseller_id):
-        return self.conn.execute('''
-            SELECT rp.plan_id, rp.custom_price, pl.validity_days, p.name 
-            FROM reseller_prices rp
-            JOIN product_plans pl ON rp.plan_id = pl.plan_id
-            JOIN products p ON pl.product_id = p.product_id
-            WHERE rp.reseller_id = ?
-        ''', (reseller_id,)).fetchall()
+        with self.reader() as conn:
+            return conn.execute('''
+                SELECT rp.plan_id, rp.custom_price, pl.validity_days, p.name 
+                FROM reseller_prices rp
+                JOIN product_plans pl ON rp.plan_id = pl.plan_id
+                JOIN products p ON pl.product_id = p.product_id
+                WHERE rp.reseller_id = ?
+            ''', (reseller_id,)).fetchall()
 
     def set_user_type(self, user_id, user_type):
-        self.conn.execute(
-            'UPDATE users SET user_type = ? WHERE user_id = ?',
-            (user_type, user_id)
-        )
-        self.conn.commit()
-
-    def get_all_users(self):
-        return self.conn.execute('SELECT * FROM users ORDER BY created_at DESC').fetchall()
+        with self.transaction() as conn:
+            self.invalidate_user(user_id)
+            self.set_admin_role(user_id, user_type == 'admin')
+            conn.execute(
+                'UPDATE users SET user_type = ? WHERE user_id = ?',
+                (user_type, user_id)
+            )
 
+    @staticmethod
+    def keyset_page(rows, limit, cursor, backwards):
+        # rows were fetched with LIMIT limit + 1 in the direction of travel;
+        # returns (rows in display order, has_prev, has_next)
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            return rows[::-1], more, True
+        return rows, cursor is not None, more
+
+    @read_only
+    def get_users_page(self, cursor=None, backwards=False, limit=PAGE_SIZE):
+        # Newest users first. cursor is the user_id at the edge of the
+        # current page in the direction of travel.
+        params = [] if cursor is None else [cursor]
+        with self.reader() as conn:
+            rows = conn.execute(users_page_sql(cursor is not None, backwards), (*params, limit + 1)).fetchall()
+        return self.keyset_page(rows, limit, cursor, backwards)
+
+    @read_only
     def get_user_by_id(self, user_id):
-        return self.conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        with self.reader() as conn:
+            return conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
 
+    @read_only
     def get_orders(self, user_id=None):
-        if user_id:
-            return self.conn.execute('''
-                SELECT o.*, p.name, pl.validity_days FROM orders o 
-                JOIN product_plans pl ON o.plan_id = pl.plan_id
-                JOIN products p ON pl.product_id = p.product_id
-                WHERE o.user_id = ? 
-                ORDER BY o.created_at DESC
-            ''', (user_id,)).fetchall()
-        else:
-            return self.conn.execute('''
-                SELECT o.*, p.name, pl.validity_days, u.first_name FROM orders o 
-                JOIN product_plans pl ON o.plan_id = pl.plan_id
-                JOIN products p ON pl.product_id = p.product_id
-                JOIN users u ON o.user_id = u.user_id 
-                ORDER BY o.created_at DESC
-            ''').fetchall()
-
-    def get_purchased_keys(self, user_id):
-        return self.conn.execute('''
-            SELECT k.key_value, k.used_at, p.name, pl.validity_days, o.order_id, k.expires_at
-            FROM product_keys k
-            JOIN product_plans pl ON k.plan_id = pl.plan_id
-            JOIN products p ON pl.product_id = p.product_id
-            JOIN orders o ON k.order_id = o.order_id
-            WHERE k.used_by = ?
-            ORDER BY k.used_at DESC
-        ''', (user_id,)).fetchall()
-
-    def get_all_keys(self, plan_id=None):
-        if plan_id:
-            return self.conn.execute('''
-                SELECT k.key_id, k.key_value, k.is_used, 
-                       CASE WHEN k.is_used = 1 THEN u.user_id ELSE NULL END as used_by,
-                       CASE WHEN k.is_used = 1 THEN u.first_name ELSE NULL END as user_name,
-                       p.name as product_name, pl.validity_days,
-                       k.used_at, k.expires_at
-                FROM product_keys k
-                JOIN product_plans pl ON k.plan_id = pl.plan_id
-                JOIN products p ON pl.product_id = p.product_id
-                LEFT JOIN users u ON k.used_by = u.user_id
-                WHERE k.plan_id = ?
-                ORDER BY k.is_used, k.key_id
-            ''', (plan_id,)).fetchall()
-        else:
-            return self.conn.execute('''
-                SELECT k.key_id, k.key_value, k.is_used, 
-                       CASE WHEN k.is_used = 1 THEN u.user_id ELSE NULL END as used_by,
-                       CASE WHEN k.is_used = 1 THEN u.first_name ELSE NULL END as user_name,
-                       p.name as product_name, pl.validity_days,
-                       k.used_at, k.expires_at
-                FROM product_keys k
-                JOIN product_plans pl ON k.plan_id = pl.plan_id
-                JOIN products p ON pl.product_id = p.product_id
-                LEFT JOIN users u ON k.used_by = u.user_id
-                ORDER BY p.name, pl.validity_days, k.is_used, k.key_id
-            ''').fetchall()
-
+        with self.reader() as conn:
+            if user_id:
+                return conn.execute(USER_ORDERS_SQL, (user_id,)).fetchall()
+            else:
+                return conn.execute('''
+                    SELECT o.*, p.name, pl.validity_days, u.first_name FROM orders o 
+                    JOIN product_plans pl ON o.plan_id = pl.plan_id
+                    JOIN products p ON pl.product_id = p.product_id
+                    JOIN users u ON o.user_id = u.user_id 
+                    ORDER BY o.created_at DESC
+                ''').fetchall()
+
+    @read_only
+    def get_orders_page(self, user_id=None, cursor=None, backwards=False, limit=PAGE_SIZE):
+        # Newest orders first (all users, or just user_id), keyed on order_id
+        params = [value for value in (user_id, cursor) if value is not None]
+        sql = orders_page_sql(user_id is not None, cursor is not None, backwards)
+        with self.reader() as conn:
+            rows = conn.execute(sql, (*params, limit + 1)).fetchall()
+        return self.keyset_page(rows, limit, cursor, backwards)
+
+    @read_only
+    def get_purchased_keys_page(self, user_id, cursor=None, backwards=False, limit=PURCHASED_KEYS_PAGE_SIZE):
+        # Newest purchases first. cursor is a key_id.
+        params = [user_id] if cursor is None else [user_id, cursor]
+        with self.reader() as conn:
+            rows = conn.execute(purchased_keys_page_sql(cursor is not None, backwards), (*params, limit + 1)).fetchall()
+        return self.keyset_page(rows, limit, cursor, backwards)
+    
+    @read_only
+    def count_purchased_keys(self, user_id):
+        with self.reader() as conn:
+            return conn.execute('SELECT COUNT(*) FROM product_keys WHERE used_by = ?', (user_id,)).fetchone()[0]
+    
+    @read_only
+    def export_purchased_keys(self, user_id, path, file_format):
+        # Streams the user's keys, newest first, from the query cursor into a
+        # file (.txt: one key per line, .csv: with details), so a large history
+        # is never held in memory. Returns the number of keys written.
+        count = 0
+        with self.reader() as conn, open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            if file_format == 'csv':
+                writer.writerow(['key', 'product', 'validity_days', 'order_id', 'purchased_at', 'expires_at'])
+            rows = conn.execute(EXPORT_PURCHASED_KEYS_SQL, (user_id,))
+            for row in rows:
+                if file_format == 'csv':
+                    writer.writerow(row)
+                else:
+                    f.write(f"{row[0]}\n")
+                count += 1
+        return count
+
+    @read_only
+    def get_keys_page(self, plan_id, is_used=None, cursor=None, backwards=False, limit=KEY_PAGE_SIZE):
+        # Keys of a plan, available first. cursor is a key_id.
+        params = [value for value in (plan_id, is_used, cursor) if value is not None]
+        sql = keys_page_sql(is_used is not None, cursor is not None, backwards)
+        with self.reader() as conn:
+            rows = conn.execute(sql, (*params, limit + 1)).fetchall()
+        return self.keyset_page(rows, limit, cursor, backwards)
+
+    @read_only
+    def count_used_keys(self, plan_id):
+        with self.reader() as conn:
+            return conn.execute(
+                'SELECT COUNT(*) FROM product_keys WHERE plan_id = ? AND is_used = 1', (plan_id,)
+            ).fetchone()[0]
+
+    @read_only
     def get_sales_statistics(self):
-        total_sales = self.conn.execute('SELECT COUNT(*) FROM orders').fetchone()[0]
-        total_revenue = self.conn.execute('SELECT SUM(total_price) FROM orders').fetchone()[0] or 0
-        total_users = self.conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
-        total_products = self.conn.execute('SELECT COUNT(*) FROM products WHERE is_active = 1').fetchone()[0]
-        banned_users = self.conn.execute('SELECT COUNT(*) FROM users WHERE is_banned = 1').fetchone()[0]
+        # Counters are maintained by triggers (migration 2), so this is one
+        # small read no matter how many orders exist
+        with self.reader() as conn:
+            counters = dict(conn.execute('SELECT name, value FROM store_counters').fetchall())
         
-        total_keys = self.conn.execute('SELECT COUNT(*) FROM product_keys').fetchone()[0]
-        used_keys = self.conn.execute('SELECT COUNT(*) FROM product_keys WHERE is_used = 1').fetchone()[0]
-        available_keys = total_keys - used_keys
+        total_keys = int(counters.get('total_keys', 0))
+        used_keys = int(counters.get('used_keys', 0))
         
         return {
-            'total_sales': total_sales,
-            'total_revenue': total_revenue,
-            'total_users': total_users,
-            'banned_users': banned_users,
-            'total_products': total_products,
+            'total_sales': int(counters.get('total_sales', 0)),
+            'total_revenue': counters.get('total_revenue', 0),
+            'total_users': int(counters.get('total_users', 0)),
+            'banned_users': int(counters.get('banned_users', 0)),
+            'total_products': int(counters.get('total_products', 0)),
             'total_keys': total_keys,
             'used_keys': used_keys,
-            'available_keys': available_keys
+            'available_keys': total_keys - used_keys
         }
 
-    def get_product_stats(self, product_id):
-        sold = self.conn.execute(
-            'SELECT COUNT(*) FROM orders o JOIN product_plans pl ON o.plan_id = pl.plan_id WHERE pl.product_id = ?', (product_id,)
-        ).fetchone()[0]
-        
-        available = self.conn.execute(
-            'SELECT COUNT(*) FROM product_keys k JOIN product_plans pl ON k.plan_id = pl.plan_id WHERE pl.product_id = ? AND k.is_used = 0', (product_id,)
-        ).fetchone()[0]
-        
-        total_keys = self.conn.execute(
-            'SELECT COUNT(*) FROM product_keys k JOIN product_plans pl ON k.plan_id = pl.plan_id WHERE pl.product_id = ?', (product_id,)
-        ).fetchone()[0]
-        
-        revenue = self.conn.execute(
-            'SELECT SUM(total_price) FROM orders o JOIN product_plans pl ON o.plan_id = pl.plan_id WHERE pl.product_id = ?', (product_id,)
-        ).fetchone()[0] or 0
+    @read_only
+    def get_catalog_stats(self):
+        # Per-plan and per-product stats in one grouped query:
+        # {'plans': {plan_id: stats}, 'products': {product_id: stats}}
+        with self.reader() as conn:
+            rows = conn.execute('''
+                SELECT pl.plan_id, pl.product_id,
+                       COALESCE(o.sold, 0), COALESCE(k.available, 0),
+                       COALESCE(k.total_keys, 0), COALESCE(o.revenue, 0)
+                FROM product_plans pl
+                LEFT JOIN (
+                    SELECT plan_id, COUNT(*) AS total_keys, SUM(is_used = 0) AS available
+                    FROM product_keys GROUP BY plan_id
+                ) k ON k.plan_id = pl.plan_id
+                LEFT JOIN (
+                    SELECT plan_id, COUNT(*) AS sold, SUM(total_price) AS revenue
+                    FROM orders GROUP BY plan_id
+                ) o ON o.plan_id = pl.plan_id
+            ''').fetchall()
         
-        return {
-            'sold': sold,
-            'available': available,
-            'total_keys': total_keys,
-            'revenue': revenue
-        }
+        plans = {}
+        products = {}
+        for plan_id, product_id, sold, available, total_keys, revenue in rows:
+            plans[plan_id] = {'sold': sold, 'available': available, 'total_keys': total_keys, 'revenue': revenue}
+            product_stats = products.setdefault(product_id, dict(EMPTY_STATS))
+            for name, value in plans[plan_id].items():
+                product_stats[name] += value
+        
+        return {'plans': plans, 'products': products}
+
+    @read_only
+    def count_product_orders(self, product_id):
+        with self.reader() as conn:
+            return conn.execute(
+                'SELECT COUNT(*) FROM orders o JOIN product_plans pl ON o.plan_id = pl.plan_id WHERE pl.product_id = ?', 
+                (product_id,)
+            ).fetchone()[0]
+
+    @read_only
+    def count_plan_orders(self, plan_id):
+        with self.reader() as conn:
+            return conn.execute(PLAN_ORDER_COUNT_SQL, (plan_id,)).fetchone()[0]
+
+    @read_only
+    def search_users(self, search_term, limit=USER_SEARCH_LIMIT):
+        # A number is a user ID; otherwise a case-insensitive match on username
+        # or name. Terms of 3+ characters are substring matches through the
+        # trigram index, best match first; shorter ones are prefix matches.
+        search_term = search_term.strip().lstrip('@')
+        with self.reader() as conn:
+            try:
+                user_id = int(search_term)
+                return conn.execute(
+                    'SELECT * FROM users WHERE user_id = ?', (user_id,)
+                ).fetchall()
+            except ValueError:
+                pass
+            if len(search_term) >= 3:
+                phrase = '"' + search_term.replace('"', '""') + '"'
+                return conn.execute(USER_SEARCH_SQL, (phrase, limit)).fetchall()
+            if not search_term:
+                return []
+            prefix = search_term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            return conn.execute(USER_PREFIX_SEARCH_SQL, (prefix, prefix, prefix, limit)).fetchall()
 
-    def get_plan_stats(self, plan_id):
-        sold = self.conn.execute(
-            'SELECT COUNT(*) FROM orders WHERE plan_id = ?', (plan_id,)
-        ).fetchone()[0]
-        
-        available = self.conn.execute(
-            'SELECT COUNT(*) FROM product_keys WHERE plan_id = ? AND is_used = 0', (plan_id,)
-        ).fetchone()[0]
-        
-        total_keys = self.conn.execute(
-            'SELECT COUNT(*) FROM product_keys WHERE plan_id = ?', (plan_id,)
-        ).fetchone()[0]
-        
-        revenue = self.conn.execute(
-            'SELECT SUM(total_price) FROM orders WHERE plan_id = ?', (plan_id,)
-        ).fetchone()[0] or 0
-        
-        return {
-            'sold': sold,
-            'available': available,
-            'total_keys': total_keys,
-            'revenue': revenue
-        }
+    def set_admin(self, user_id):
+        with self.transaction() as conn:
+            self.invalidate_user(user_id)
+            self.set_admin_role(user_id, True)
+            conn.execute(
+                'UPDATE users SET user_type = ? WHERE user_id = ?',
+                ('admin', user_id)
+            )
 
-    def search_users(self, search_term):
-        try:
-            user_id = int(search_term)
-            return self.conn.execute(
-                'SELECT * FROM users WHERE user_id = ?', (user_id,)
-            ).fetchall()
-        except ValueError:
-            return self.conn.execute(
-                'SELECT * FROM users WHERE username LIKE ? OR first_name LIKE ?', 
-                (f'%{search_term}%', f'%{search_term}%')
-            ).fetchall()
+class GroupCommitWriter:
+    # The single writer thread. Writes from every handler queue here; the
+    # thread gathers whatever arrives within GROUP_COMMIT_WINDOW and applies
+    # it with Database.run_batch, so N concurrent writes cost one commit
+    # instead of N. Each caller's future resolves only after that commit.
+    def __init__(self, database):
+        self.database = database
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='db-write', daemon=True)
+        self.thread.start()
+    
+    def submit(self, method, *args, **kwargs):
+        future = concurrent.futures.Future()
+        self.queue.put((future, (method, args, kwargs)))
+        return future
+    
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + GROUP_COMMIT_WINDOW
+            while len(batch) < GROUP_COMMIT_MAX_BATCH:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            
+            # Skip writes whose caller was cancelled while they were queued
+            batch = [(future, call) for future, call in batch if future.set_running_or_notify_cancel()]
+            try:
+                results = self.database.run_batch([call for _, call in batch])
+            except Exception as e:
+                # The commit itself failed, so none of the writes happened
+                for future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (future, _), (ok, value) in zip(batch, results):
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+class AsyncDatabase:
+    # Same method surface as Database, but every call runs on a worker thread
+    # so a slow query never blocks the PTB event loop. Reads fan out over the
+    # reader pool; writes are group-committed by the single writer thread.
+    def __init__(self, database):
+        self.database = database
+        self.read_executor = ThreadPoolExecutor(max_workers=database.read_pool_size, thread_name_prefix='db-read')
+        self.writer = GroupCommitWriter(database)
+    
+    async def run(self, method, *args, **kwargs):
+        if getattr(method, 'read_only', False):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.read_executor, functools.partial(method, *args, **kwargs))
+        return await asyncio.wrap_future(self.writer.submit(method, *args, **kwargs))
+
+    # User lookups answer cache hits on the event loop, skipping the executor hop
+    async def get_user(self, user_id):
+        user = self.database.user_cache.get(user_id)
+        if user is None:
+            user = await self.run(self.database.load_user, user_id)
+        if user is None:
+            user = await self.run(self.database.create_user, user_id)
+        return user
 
-    def set_admin(self, user_id):
-        self.conn.execute(
-            'UPDATE users SET user_type = ? WHERE user_id = ?',
-            ('admin', user_id)
-        )
-        self.conn.commit()
+    async def is_user_banned(self, user_id):
+        user = await self.get_user(user_id)
+        return user[6] if user else False  # is_banned field
+
+    async def get_plan_prices(self, user_id):
+        prices = self.database.price_cache.get(user_id)
+        if prices is None:
+            prices = await self.run(self.database.load_plan_prices, user_id)
+        return prices
+
+    async def get_plan_price(self, plan_id, user_id):
+        prices = await self.get_plan_prices(user_id)
+        return prices.get(plan_id)
+
+    def get_role(self, user_id):
+        return self.database.get_role(user_id)
+    
+    def queue_profile(self, user_id, profile):
+        self.database.queue_profile(user_id, profile)
+
+    def __getattr__(self, name):
+        method = getattr(self.database, name)
+        if not callable(method):
+            return method
+
+        @functools.wraps(method)
+        async def run_in_executor(*args, **kwargs):
+            return await self.run(method, *args, **kwargs)
+
+        # Cache the wrapper so later lookups skip __getattr__
+        setattr(self, name, run_in_executor)
+        return run_in_executor
 
 # Initialize database
-db = Database()
+db = AsyncDatabase(Database())
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    # Handles up to max_concurrent_updates updates at once, but each user's
+    # updates one at a time in arrival order, so a user's purchase and balance
+    # flows never interleave. Updates without a user aren't serialized.
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.user_locks = {}  # user_id -> [asyncio.Lock, updates holding or waiting]
+    
+    async def process_update(self, update, coroutine):
+        # Takes the user's lock before PTB's concurrency slot (its @final is
+        # only a typing hint), so a user's queued updates wait without holding
+        # slots that other users' updates need
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        
+        entry = self.user_locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.user_locks[user.id]
+    
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+def encode_varint(value):
+    if value < 0:
+        raise ValueError(f"Can't varint-encode negative value {value}")
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def decode_varint(data, pos):
+    # Returns (value, position after it)
+    value = shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("Truncated varint")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def sign_callback(payload):
+    return hmac.new(CALLBACK_SECRET, payload, hashlib.sha256).digest()[:CALLBACK_SIGNATURE_BYTES]
+
+class SQLitePersistence(BasePersistence):
+    # Keeps PTB's user_data and chat_data in the bot's database. PTB hands over
+    # changed entries every PERSISTENCE_INTERVAL seconds; they are serialized to
+    # JSON, buffered and written in one executemany transaction by a background
+    # task, so no handler waits on a persistence write.
+    def __init__(self, database, update_interval=PERSISTENCE_INTERVAL):
+        super().__init__(store_data=PersistenceInput(bot_data=False, callback_data=False), update_interval=update_interval)
+        self.database = database
+        self.pending = {table: {} for table in PERSISTED_TABLES}  # table -> {id: JSON text or None}
+        self.write_task = None
+    
+    def queue_write(self, table, key, data):
+        try:
+            self.pending[table][key] = json.dumps(data, separators=(',', ':')) if data else None
+        except (TypeError, ValueError) as e:
+            logging.error(f"Error in queue_write: {e}")
+            return
+        if self.write_task is None or self.write_task.done():
+            self.write_task = asyncio.create_task(self.write_pending())
+    
+    async def write_pending(self):
+        # Yield once so the rest of PTB's update cycle joins this batch
+        await asyncio.sleep(0)
+        failed = False
+        while any(self.pending.values()) and not failed:
+            for table, entries in self.pending.items():
+                if not entries:
+                    continue
+                self.pending[table] = {}
+                try:
+                    await self.database.save_persisted(table, list(entries.items()))
+                except Exception as e:
+                    logging.error(f"Error in write_pending: {e}")
+                    # Put the batch back without overwriting anything queued since;
+                    # the next write or flush retries it instead of this loop spinning
+                    for key, value in entries.items():
+                        self.pending[table].setdefault(key, value)
+                    failed = True
+    
+    async def get_user_data(self):
+        return await self.database.load_persisted('user_data')
+    
+    async def get_chat_data(self):
+        return await self.database.load_persisted('chat_data')
+    
+    async def update_user_data(self, user_id, data):
+        self.queue_write('user_data', user_id, data)
+    
+    async def update_chat_data(self, chat_id, data):
+        self.queue_write('chat_data', chat_id, data)
+    
+    async def drop_user_data(self, user_id):
+        self.queue_write('user_data', user_id, None)
+    
+    async def drop_chat_data(self, chat_id):
+        self.queue_write('chat_data', chat_id, None)
+    
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+    
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+    
+    async def flush(self):
+        if self.write_task is not None:
+            await self.write_task
+        await self.write_pending()
+    
+    # bot_data, callback_data and ConversationHandler state aren't used by this bot
+    async def get_bot_data(self):
+        return {}
+    
+    async def update_bot_data(self, data):
+        pass
+    
+    async def refresh_bot_data(self, bot_data):
+        pass
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def get_conversations(self, name):
+        return {}
+    
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+class CallbackRouter:
+    # Dispatch table for inline button callback_data. Exact routes are a dict
+    # lookup; prefix routes live in a trie of "_"-separated segments where the
+    # longest matching prefix wins, so registration order never matters. The
+    # segments after a prefix are converted by the route's arg types; missing
+    # trailing args fall back to the handler's defaults.
+    #
+    # Prefix routes also have a numeric opcode. encode() packs the opcode and
+    # args as varints (str args length-prefixed) into "~<base64url>", signed
+    # when CALLBACK_SECRET is set - far below Telegram's 64-byte limit even
+    # for several large IDs. Legacy "name_<id>" data still resolves.
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = {}  # segment -> node; a node's None entry holds the route ending there
+        self.opcodes = {}  # pattern -> opcode
+        self.by_opcode = {}  # opcode -> route
+    
+    def add(self, pattern, handler, *arg_types, op=None, admin=False, owner=False, context=False, role=False, **kwargs):
+        # A pattern ending in "_" is a prefix route and needs a unique op, anything
+        # else matches exactly. admin / owner routes are refused to callers without
+        # that role before the handler runs; context passes the handler context
+        # after query; role passes the caller's role, as resolved for that check,
+        # as role=; kwargs are passed as-is. Never reuse or renumber an op: old
+        # buttons carry it.
+        access = 'owner' if owner else 'admin' if admin else None
+        route = (handler, arg_types, access, context, role, kwargs)
+        if not pattern.endswith('_'):
+            self.exact[pattern] = route
+            return
+        if op is None or op in self.by_opcode:
+            raise ValueError(f"Prefix route {pattern} needs a unique op")
+        node = self.prefixes
+        for segment in pattern[:-1].split('_'):
+            node = node.setdefault(segment, {})
+        node[None] = route
+        self.opcodes[pattern] = op
+        self.by_opcode[op] = route
+    
+    def encode(self, pattern, *args):
+        op = self.opcodes[pattern]
+        payload = bytearray(encode_varint(op))
+        for convert, arg in zip(self.by_opcode[op][1], args):
+            if convert is str:
+                raw = str(arg).encode()
+                payload += encode_varint(len(raw)) + raw
+            else:
+                payload += encode_varint(int(arg))
+        if CALLBACK_SECRET:
+            payload += sign_callback(bytes(payload))
+        return "~" + base64.urlsafe_b64encode(payload).rstrip(b"=").decode()
+    
+    def decode(self, data):
+        try:
+            return self.unpack(base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)))
+        except ValueError as e:
+            # Bad base64, a truncated varint or a str arg that isn't UTF-8
+            logging.warning(f"Rejected malformed callback data: {e}")
+            return None, None
+    
+    def unpack(self, raw):
+        if CALLBACK_SECRET:
+            raw, signature = raw[:-CALLBACK_SIGNATURE_BYTES], raw[-CALLBACK_SIGNATURE_BYTES:]
+            if not hmac.compare_digest(signature, sign_callback(raw)):
+                logging.warning("Rejected callback data with a bad signature")
+                return None, None
+        
+        op, pos = decode_varint(raw, 0)
+        route = self.by_opcode.get(op)
+        if route is None:
+            return None, None
+        args = []
+        for convert in route[1]:
+            if pos == len(raw):
+                break
+            if convert is str:
+                length, pos = decode_varint(raw, pos)
+                args.append(raw[pos:pos + length].decode())
+                pos += length
+            else:
+                value, pos = decode_varint(raw, pos)
+                args.append(convert(value))
+        if pos != len(raw):
+            return None, None
+        return route, args
+    
+    def resolve(self, data):
+        # Returns (route, args), or (None, None) for unknown or malformed "~" data.
+        # Raises ValueError on a legacy arg that doesn't convert.
+        route = self.exact.get(data)
+        if route:
+            return route, []
+        if data.startswith("~"):
+            return self.decode(data[1:])
+        if CALLBACK_SECRET:
+            return None, None
+        
+        parts = data.split('_')
+        node, end = self.prefixes, 0
+        for i, segment in enumerate(parts):
+            node = node.get(segment)
+            if node is None:
+                break
+            if None in node:
+                route, end = node[None], i + 1
+        if route is None:
+            return None, None
+        
+        args = parts[end:]
+        if len(args) > len(route[1]):
+            return None, None
+        return route, [convert(arg) for convert, arg in zip(route[1], args)]
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Check if user is banned
-    if db.is_user_banned(user_id):
-        user = db.get_user(user_id)
+    if await db.is_user_banned(user_id):
+        user = await db.get_user(user_id)
         ban_reason = user[7] or "No reason provided"
         banned_at = user[8] or "Unknown"
         await update.message.reply_text(
@@ -585,7 +1863,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     keyboard = [
         [InlineKeyboardButton("🛍️ View Products", callback_data="view_products")],
@@ -594,7 +1872,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("🔑 My Purchased Keys", callback_data="my_keys")]
     ]
     
-    if user_id in ADMIN_IDS or user[5] == 'admin':
+    if db.get_role(user_id):
         keyboard.append([InlineKeyboardButton("👑 Admin Panel", callback_data="admin_panel")])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -616,155 +1894,40 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
     user_id = query.from_user.id
     
-    # Check if user is banned for all callbacks except admin panel
-    if not data.startswith("admin_") and db.is_user_banned(user_id):
-        user = db.get_user(user_id)
-        ban_reason = user[7] or "No reason provided"
-        await query.edit_message_text(
-            f"🚫 **Your account has been banned!**\n\n"
-            f"**Reason:** {ban_reason}\n\n"
-            f"Contact admin for more information.",
-            parse_mode='Markdown'
-        )
-        return
-    
     try:
-        # Main menu handlers
-        if data == "view_products":
-            await show_products_menu(query)
-        elif data == "check_balance":
-            await show_balance(query)
-        elif data == "order_history":
-            await show_order_history(query)
-        elif data == "my_keys":
-            await show_my_keys(query)
-        elif data == "main_menu":
-            await show_main_menu(query)
-        
-        # Product handlers
-        elif data.startswith("product_"):
-            product_id = int(data.split("_")[1])
-            await show_product_plans(query, product_id)
-        elif data.startswith("plan_"):
-            plan_id = int(data.split("_")[1])
-            await show_plan_details(query, plan_id)
-        elif data.startswith("buy_"):
-            plan_id = int(data.split("_")[1])
-            await process_purchase(query, plan_id)
-        elif data == "back_to_products":
-            await show_products_menu(query)
-        
-        # Admin handlers
-        elif data == "admin_panel":
-            await show_admin_panel(query)
-        elif data == "admin_manage_products":
-            await admin_manage_products(query)
-        elif data == "admin_manage_users":
-            await admin_manage_users(query)
-        elif data == "admin_statistics":
-            await admin_show_statistics(query)
-        elif data == "admin_all_orders":
-            await admin_show_all_orders(query)
-        elif data == "admin_add_product":
-            await admin_add_product_start(query, context)
-        elif data == "admin_back_to_panel":
-            await show_admin_panel(query)
-        elif data == "admin_view_all_users":
-            await admin_view_all_users(query)
-        elif data == "admin_manage_keys":
-            await admin_manage_keys(query)
-        elif data == "admin_balance_transactions":
-            await admin_show_balance_transactions(query)
-        elif data.startswith("admin_view_keys_"):
-            plan_id = int(data.split("_")[3])
-            await admin_view_plan_keys(query, plan_id)
-        elif data.startswith("admin_add_keys_"):
-            plan_id = int(data.split("_")[3])
-            await admin_add_keys_start(query, context, plan_id)
-        elif data.startswith("admin_delete_key_"):
-            key_id = int(data.split("_")[3])
-            await admin_delete_key(query, key_id)
-        elif data.startswith("admin_add_plan_"):
-            product_id = int(data.split("_")[3])
-            await admin_add_plan_start(query, context, product_id)
-        elif data.startswith("admin_manage_plans_"):
-            product_id = int(data.split("_")[3])
-            await admin_manage_product_plans(query, product_id)
-        elif data.startswith("admin_edit_product_"):
-            product_id = int(data.split("_")[3])
-            await admin_edit_product_start(query, context, product_id)
-        elif data.startswith("admin_delete_product_"):
-            product_id = int(data.split("_")[3])
-            await admin_delete_product(query, product_id)
-        elif data.startswith("admin_edit_plan_"):
-            plan_id = int(data.split("_")[3])
-            await admin_edit_plan_start(query, context, plan_id)
-        elif data.startswith("admin_delete_plan_"):
-            plan_id = int(data.split("_")[3])
-            await admin_delete_plan(query, plan_id)
-        
-        # User management handlers
-        elif data.startswith("admin_search_user"):
-            await admin_search_user(query, context)
-        elif data.startswith("admin_view_user_"):
-            user_id_to_view = int(data.split("_")[3])
-            await admin_view_user_details(query, user_id_to_view)
-        elif data.startswith("admin_set_reseller_"):
-            user_id_to_set = int(data.split("_")[3])
-            db.set_user_type(user_id_to_set, 'reseller')
-            await query.edit_message_text(f"✅ User `{user_id_to_set}` has been set as **Reseller**!", parse_mode='Markdown')
-        elif data.startswith("admin_set_user_"):
-            user_id_to_set = int(data.split("_")[3])
-            db.set_user_type(user_id_to_set, 'user')
-            await query.edit_message_text(f"✅ User `{user_id_to_set}` has been set as **Regular User**!", parse_mode='Markdown')
-        elif data.startswith("admin_set_admin_"):
-            user_id_to_set = int(data.split("_")[3])
-            db.set_admin(user_id_to_set)
-            await query.edit_message_text(f"✅ User `{user_id_to_set}` has been set as **Admin**!", parse_mode='Markdown')
-        elif data.startswith("admin_add_balance_"):
-            user_id_to_add = int(data.split("_")[3])
-            context.user_data['add_balance_user'] = user_id_to_add
-            await query.edit_message_text(f"💵 Please enter the amount to add for user `{user_id_to_add}`:\n\nExample: `50` or `25.99`", parse_mode='Markdown')
-        elif data.startswith("admin_minus_balance_"):
-            user_id_to_minus = int(data.split("_")[3])
-            context.user_data['minus_balance_user'] = user_id_to_minus
-            await query.edit_message_text(f"💵 Please enter the amount to deduct from user `{user_id_to_minus}`:\n\nExample: `50` or `25.99`", parse_mode='Markdown')
-        elif data.startswith("admin_set_price_"):
-            user_id_to_set = int(data.split("_")[3])
-            context.user_data['set_price_user'] = user_id_to_set
-            await admin_set_reseller_price_start(query, context, user_id_to_set)
-        elif data.startswith("admin_set_plan_price_"):
-            parts = data.split("_")
-            target_user_id = int(parts[4])
-            plan_id = int(parts[5])
-            await admin_set_individual_price_start(query, context, target_user_id, plan_id)
-        elif data.startswith("admin_ban_user_"):
-            user_id_to_ban = int(data.split("_")[3])
-            context.user_data['ban_user_id'] = user_id_to_ban
-            await query.edit_message_text(f"🚫 Please enter the ban reason for user `{user_id_to_ban}`:", parse_mode='Markdown')
-        elif data.startswith("admin_unban_user_"):
-            user_id_to_unban = int(data.split("_")[3])
-            db.unban_user(user_id_to_unban, admin_id=user_id)
-            await query.edit_message_text(f"✅ User `{user_id_to_unban}` has been **unbanned**!", parse_mode='Markdown')
-        elif data.startswith("admin_delete_user_"):
-            user_id_to_delete = int(data.split("_")[3])
-            context.user_data['delete_user_id'] = user_id_to_delete
-            keyboard = [
-                [InlineKeyboardButton("✅ Confirm Delete", callback_data=f"admin_confirm_delete_{user_id_to_delete}")],
-                [InlineKeyboardButton("❌ Cancel", callback_data=f"admin_view_user_{user_id_to_delete}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+        route, args = callback_router.resolve(data)
+        if route is None:
+            return
+        handler, _, access, pass_context, pass_role, kwargs = route
+        
+        # Pressing any button abandons a pending text-input flow; handlers that
+        # start a flow set the new state after this
+        end_flow(context.user_data)
+        
+        # Resolved once here; routes added with role=True get it as role=
+        role = db.get_role(user_id) if access or pass_role else None
+        if access:
+            if role is None or (access == 'owner' and role != 'owner'):
+                await query.edit_message_text("❌ Access denied!")
+                return
+        # Banned users can't use anything outside the admin panel
+        elif await db.is_user_banned(user_id):
+            user = await db.get_user(user_id)
+            ban_reason = user[7] or "No reason provided"
             await query.edit_message_text(
-                f"⚠️ **Are you sure you want to DELETE user `{user_id_to_delete}`?**\n\n"
-                f"❌ This action cannot be undone!\n"
-                f"📝 All user data including orders and balance will be permanently removed.",
-                reply_markup=reply_markup,
+                f"🚫 **Your account has been banned!**\n\n"
+                f"**Reason:** {ban_reason}\n\n"
+                f"Contact admin for more information.",
                 parse_mode='Markdown'
             )
-        elif data.startswith("admin_confirm_delete_"):
-            user_id_to_delete = int(data.split("_")[3])
-            db.delete_user(user_id_to_delete, admin_id=user_id)
-            await query.edit_message_text(f"✅ User `{user_id_to_delete}` has been **permanently deleted**!", parse_mode='Markdown')
+            return
+        
+        if pass_role:
+            kwargs = dict(kwargs, role=role)
+        if pass_context:
+            await handler(query, context, *args, **kwargs)
+        else:
+            await handler(query, *args, **kwargs)
     
     except Exception as e:
         logging.error(f"Error in callback handler: {e}")
@@ -772,7 +1935,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_main_menu(query):
     user_id = query.from_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     keyboard = [
         [InlineKeyboardButton("🛍️ View Products", callback_data="view_products")],
@@ -781,7 +1944,7 @@ async def show_main_menu(query):
         [InlineKeyboardButton("🔑 My Purchased Keys", callback_data="my_keys")]
     ]
     
-    if user_id in ADMIN_IDS or user[5] == 'admin':
+    if db.get_role(user_id):
         keyboard.append([InlineKeyboardButton("👑 Admin Panel", callback_data="admin_panel")])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -794,7 +1957,7 @@ async def show_main_menu(query):
 
 async def show_products_menu(query):
     try:
-        products = db.get_products()
+        products = db.catalog.get_products()
         
         if not products:
             keyboard = [[InlineKeyboardButton("🔙 Back to Main Menu", callback_data="main_menu")]]
@@ -807,7 +1970,7 @@ async def show_products_menu(query):
             keyboard.append([
                 InlineKeyboardButton(
                     f"📦 {product[1]}", 
-                    callback_data=f"product_{product[0]}"
+                    callback_data=pack_callback("product_", product[0])
                 )
             ])
         
@@ -825,12 +1988,13 @@ async def show_products_menu(query):
 
 async def show_product_plans(query, product_id):
     try:
-        product = db.conn.execute('SELECT * FROM products WHERE product_id = ?', (product_id,)).fetchone()
+        catalog = db.catalog
+        product = catalog.get_product(product_id)
         if not product:
             await query.edit_message_text("❌ Product not found.")
             return
         
-        plans = db.get_product_plans(product_id)
+        plans = catalog.get_product_plans(product_id)
         
         if not plans:
             keyboard = [[InlineKeyboardButton("🔙 Back to Products", callback_data="back_to_products")]]
@@ -838,13 +2002,14 @@ async def show_product_plans(query, product_id):
             await query.edit_message_text(f"📦 **{product[1]}**\n\n📭 No plans available for this product.", reply_markup=reply_markup)
             return
         
+        prices = await db.get_plan_prices(query.from_user.id)
         keyboard = []
         for plan in plans:
-            price = db.get_plan_price(plan[0], query.from_user.id)
+            price = prices.get(plan[0], plan[3])
             keyboard.append([
                 InlineKeyboardButton(
                     f"⏰ {plan[2]} days - ${price:.2f}", 
-                    callback_data=f"plan_{plan[0]}"
+                    callback_data=pack_callback("plan_", plan[0])
                 )
             ])
         
@@ -862,32 +2027,33 @@ async def show_product_plans(query, product_id):
 
 async def show_plan_details(query, plan_id):
     try:
-        plan = db.conn.execute('''
-            SELECT pl.*, p.name, p.description 
-            FROM product_plans pl 
-            JOIN products p ON pl.product_id = p.product_id 
-            WHERE pl.plan_id = ?
-        ''', (plan_id,)).fetchone()
+        catalog = db.catalog
+        plan = catalog.get_plan(plan_id)
         
         if not plan:
             await query.edit_message_text("❌ Plan not found.")
             return
         
-        price = db.get_plan_price(plan_id, query.from_user.id)
-        stock = db.conn.execute(
-            'SELECT COUNT(*) FROM product_keys WHERE plan_id = ? AND is_used = 0', 
-            (plan_id,)
-        ).fetchone()[0]
+        product = catalog.get_product(plan[1])
+        price = await db.get_plan_price(plan_id, query.from_user.id)
+        stock = catalog.get_stock(plan_id)
         
-        keyboard = [
-            [InlineKeyboardButton("🛒 Buy Now", callback_data=f"buy_{plan_id}")],
-            [InlineKeyboardButton("🔙 Back to Plans", callback_data=f"product_{plan[1]}")]
+        keyboard = [[InlineKeyboardButton("🛒 Buy Now", callback_data=pack_callback("buy_", plan_id))]]
+        
+        # Bulk checkout buttons, only for quantities currently in stock
+        bulk_buttons = [
+            InlineKeyboardButton(f"🛒 x{quantity} - ${price * quantity:.2f}", callback_data=pack_callback("buy_", plan_id, quantity))
+            for quantity in BULK_QUANTITIES if quantity <= stock
         ]
+        for i in range(0, len(bulk_buttons), 2):
+            keyboard.append(bulk_buttons[i:i + 2])
+        
+        keyboard.append([InlineKeyboardButton("🔙 Back to Plans", callback_data=pack_callback("product_", plan[1]))])
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(
-            f"📦 **{plan[6]}**\n\n"
-            f"📝 *{plan[7]}*\n\n"
+            f"📦 **{product[1]}**\n\n"
+            f"📝 *{product[2]}*\n\n"
             f"⏰ **Validity:** {plan[2]} days\n"
             f"💰 **Price:** ${price:.2f}\n"
             f"📊 **Stock Available:** {stock}\n"
@@ -899,13 +2065,13 @@ async def show_plan_details(query, plan_id):
         logging.error(f"Error in show_plan_details: {e}")
         await query.edit_message_text("❌ Error loading plan details. Please try again.")
 
-async def process_purchase(query, plan_id):
+async def process_purchase(query, plan_id, quantity=1):
     try:
         user_id = query.from_user.id
-        success, result = db.create_order(user_id, plan_id)
+        success, result = await db.create_order(user_id, plan_id, quantity)
         
         if success:
-            user = db.get_user(user_id)
+            user = await db.get_user(user_id)
             keyboard = [
                 [InlineKeyboardButton("🛍️ Buy More", callback_data="view_products")],
                 [InlineKeyboardButton("🔑 View My Keys", callback_data="my_keys")],
@@ -913,9 +2079,25 @@ async def process_purchase(query, plan_id):
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
+            if len(result) == 1:
+                keys_text = f"🎯 **Your Key:** `{result[0]}`\n\n"
+            else:
+                key_lines = "\n".join(f"`{key}`" for key in result)
+                if len(key_lines) <= MAX_INLINE_KEYS_LENGTH:
+                    keys_text = f"🔢 **Quantity:** {len(result)}\n🎯 **Your Keys:**\n{key_lines}\n\n"
+                else:
+                    # Too long for one message, deliver the keys as a file
+                    document = io.BytesIO("\n".join(result).encode('utf-8'))
+                    await query.message.reply_document(
+                        document=document,
+                        filename=f"keys_plan{plan_id}_{datetime.now():%Y%m%d_%H%M%S}.txt",
+                        caption=f"🔑 {len(result)} keys"
+                    )
+                    keys_text = f"🔢 **Quantity:** {len(result)}\n📎 *Your keys were sent as a file below.*\n\n"
+            
             await query.edit_message_text(
                 f"✅ **Purchase Successful!**\n\n"
-                f"🎯 **Your Key:** `{result}`\n\n"
+                f"{keys_text}"
                 f"💰 **Remaining Balance:** ${user[4]:.2f}\n\n"
                 f"⚠️ *Keep this key safe and don't share it!*\n"
                 f"📋 *You can view all your purchased keys in 'My Purchased Keys' section*",
@@ -923,7 +2105,7 @@ async def process_purchase(query, plan_id):
                 parse_mode='Markdown'
             )
         else:
-            keyboard = [[InlineKeyboardButton("🔙 Back to Plans", callback_data=f"plan_{plan_id}")]]
+            keyboard = [[InlineKeyboardButton("🔙 Back to Plans", callback_data=pack_callback("plan_", plan_id))]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             await query.edit_message_text(
@@ -939,8 +2121,11 @@ async def process_purchase(query, plan_id):
 
 async def show_balance(query):
     try:
-        user = db.get_user(query.from_user.id)
-        keyboard = [[InlineKeyboardButton("🔙 Back to Main Menu", callback_data="main_menu")]]
+        user = await db.get_user(query.from_user.id)
+        keyboard = [
+            [InlineKeyboardButton("📜 Statement", callback_data="balance_statement")],
+            [InlineKeyboardButton("🔙 Back to Main Menu", callback_data="main_menu")]
+        ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(
@@ -953,26 +2138,63 @@ async def show_balance(query):
         logging.error(f"Error in show_balance: {e}")
         await query.edit_message_text("❌ Error loading balance. Please try again.")
 
-async def show_order_history(query):
+async def show_statement(query):
+    try:
+        opening, postings = await db.get_statement(query.from_user.id)
+        
+        text = f"📜 **Statement - last {STATEMENT_DAYS} days**\n\n"
+        text += f"📂 **Opening Balance:** ${opening / 100:.2f}\n\n"
+        if not postings:
+            text += "📭 No balance activity in this period.\n\n"
+        for created_at, entry_type, amount_cents, balance_after_cents, memo in postings:
+            sign = "+" if amount_cents >= 0 else "-"
+            text += f"🕒 {created_at[:16]} | {sign}${abs(amount_cents) / 100:.2f} → ${balance_after_cents / 100:.2f}\n"
+            text += f"📝 {memo or entry_type.replace('_', ' ')}\n\n"
+        closing = postings[-1][3] if postings else opening
+        text += f"💰 **Closing Balance:** ${closing / 100:.2f}"
+        
+        keyboard = [[InlineKeyboardButton("🔙 Back to Balance", callback_data="check_balance")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+    except Exception as e:
+        logging.error(f"Error in show_statement: {e}")
+        await query.edit_message_text("❌ Error loading statement. Please try again.")
+
+def page_buttons(prefix, rows, has_prev, has_next, *args):
+    # Prev/Next row for a keyset page routed as "<prefix>_next_" / "<prefix>_prev_"
+    # with args followed by the cursor, the first column of the edge row
+    buttons = []
+    if rows and has_prev:
+        buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=pack_callback(f"{prefix}_prev_", *args, rows[0][0])))
+    if rows and has_next:
+        buttons.append(InlineKeyboardButton("Next ➡️", callback_data=pack_callback(f"{prefix}_next_", *args, rows[-1][0])))
+    return [buttons] if buttons else []
+
+def pack_callback(pattern, *args):
+    # Compact callback_data for a prefix route, see CallbackRouter.encode
+    return callback_router.encode(pattern, *args)
+
+async def show_order_history(query, cursor=None, backwards=False):
     try:
         user_id = query.from_user.id
-        orders = db.get_orders(user_id)
+        orders, has_prev, has_next = await db.get_orders_page(user_id, cursor, backwards)
         
-        if not orders:
+        if not orders and cursor is None:
             keyboard = [[InlineKeyboardButton("🔙 Back to Main Menu", callback_data="main_menu")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await query.edit_message_text("📭 You haven't made any orders yet.", reply_markup=reply_markup)
             return
         
         text = "📊 **Your Order History**\n\n"
-        for order in orders[:15]:
+        for order in orders:
             text += f"🆔 **Order #{order[0]}**\n"
-            text += f"📦 **Product:** {order[7]} ({order[8]} days)\n"
+            text += f"📦 **Product:** {order[8]} ({order[9]} days)\n"
             text += f"💵 **Amount:** ${order[5]:.2f}\n"
             text += f"🔢 **Quantity:** {order[4]}\n"
-            text += f"🕒 **Date:** {order[6]}\n\n"
+            text += f"🕒 **Date:** {order[7]}\n\n"
         
-        keyboard = [
+        keyboard = page_buttons("orders", orders, has_prev, has_next) + [
             [InlineKeyboardButton("🔑 View Purchased Keys", callback_data="my_keys")],
             [InlineKeyboardButton("🔙 Back to Main Menu", callback_data="main_menu")]
         ]
@@ -983,12 +2205,12 @@ async def show_order_history(query):
         logging.error(f"Error in show_order_history: {e}")
         await query.edit_message_text("❌ Error loading order history. Please try again.")
 
-async def show_my_keys(query):
+async def show_my_keys(query, cursor=None, backwards=False):
     try:
         user_id = query.from_user.id
-        purchased_keys = db.get_purchased_keys(user_id)
+        purchased_keys, has_prev, has_next = await db.get_purchased_keys_page(user_id, cursor, backwards)
         
-        if not purchased_keys:
+        if not purchased_keys and cursor is None:
             keyboard = [[InlineKeyboardButton("🔙 Back to Main Menu", callback_data="main_menu")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await query.edit_message_text("🔑 **Your Purchased Keys**\n\n📭 You haven't purchased any keys yet.", reply_markup=reply_markup)
@@ -996,14 +2218,18 @@ async def show_my_keys(query):
         
         text = "🔑 **Your Purchased Keys**\n\n"
         for key in purchased_keys:
-            expires_text = f"⏰ **Expires:** {key[5]}" if key[5] else f"⏰ **Validity:** {key[3]} days"
-            text += f"📦 **Product:** {key[2]} ({key[3]} days)\n"
-            text += f"🔑 **Key:** `{key[0]}`\n"
-            text += f"🕒 **Purchased:** {key[1]}\n"
+            expires_text = f"⏰ **Expires:** {key[6]}" if key[6] else f"⏰ **Validity:** {key[4]} days"
+            text += f"📦 **Product:** {key[3]} ({key[4]} days)\n"
+            text += f"🔑 **Key:** `{key[1]}`\n"
+            text += f"🕒 **Purchased:** {key[2]}\n"
             text += f"{expires_text}\n"
-            text += f"🆔 **Order ID:** #{key[4]}\n\n"
+            text += f"🆔 **Order ID:** #{key[5]}\n\n"
         
-        keyboard = [[InlineKeyboardButton("🔙 Back to Main Menu", callback_data="main_menu")]]
+        keyboard = page_buttons("my_keys", purchased_keys, has_prev, has_next) + [
+            [InlineKeyboardButton("📄 Export .txt", callback_data="my_keys_export_txt"),
+             InlineKeyboardButton("📊 Export .csv", callback_data="my_keys_export_csv")],
+            [InlineKeyboardButton("🔙 Back to Main Menu", callback_data="main_menu")]
+        ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
@@ -1011,18 +2237,33 @@ async def show_my_keys(query):
         logging.error(f"Error in show_my_keys: {e}")
         await query.edit_message_text("❌ Error loading purchased keys. Please try again.")
 
+async def export_my_keys(query, file_format):
+    try:
+        # Written to a temp file by the database thread and uploaded from disk
+        fd, path = tempfile.mkstemp(suffix=f".{file_format}")
+        os.close(fd)
+        try:
+            count = await db.export_purchased_keys(query.from_user.id, path, file_format)
+            if not count:
+                await query.message.reply_text("📭 You haven't purchased any keys yet.")
+                return
+            with open(path, 'rb') as f:
+                await query.message.reply_document(
+                    document=f,
+                    filename=f"my_keys_{datetime.now():%Y%m%d_%H%M%S}.{file_format}",
+                    caption=f"🔑 {count} keys"
+                )
+        finally:
+            os.remove(path)
+    except Exception as e:
+        logging.error(f"Error in export_my_keys: {e}")
+        await query.message.reply_text("❌ Error exporting purchased keys. Please try again.")
+
 # ==================== ADMIN FUNCTIONS ====================
 
 async def show_admin_panel(query):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        stats = db.get_sales_statistics()
+        stats = await db.get_sales_statistics()
         
         keyboard = [
             [InlineKeyboardButton("📦 Manage Products", callback_data="admin_manage_products")],
@@ -1056,13 +2297,6 @@ Choose an option below:"""
 
 async def admin_manage_users(query):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
         keyboard = [
             [InlineKeyboardButton("🔍 Search User by ID/Username", callback_data="admin_search_user")],
             [InlineKeyboardButton("👥 View All Users", callback_data="admin_view_all_users")],
@@ -1080,25 +2314,19 @@ async def admin_manage_users(query):
         logging.error(f"Error in admin_manage_users: {e}")
         await query.edit_message_text("❌ Error loading user management. Please try again.")
 
-async def admin_view_all_users(query):
+async def admin_view_all_users(query, cursor=None, backwards=False):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        users = db.get_all_users()
+        users, has_prev, has_next = await db.get_users_page(cursor, backwards)
         
         text = "👥 **All Users**\n\n"
         keyboard = []
         
-        for user in users[:15]:
+        for user in users:
             ban_status = "🚫" if user[6] else "✅"
             text += f"{ban_status} `{user[0]}` | 👤 {user[5]} | 💰 ${user[4]:.2f}\n"
-            keyboard.append([InlineKeyboardButton(f"Manage User {user[0]}", callback_data=f"admin_view_user_{user[0]}")])
+            keyboard.append([InlineKeyboardButton(f"Manage User {user[0]}", callback_data=pack_callback("admin_view_user_", user[0]))])
         
+        keyboard += page_buttons("admin_users", users, has_prev, has_next)
         keyboard.append([InlineKeyboardButton("🔙 Back to User Management", callback_data="admin_manage_users")])
         reply_markup = InlineKeyboardMarkup(keyboard)
         
@@ -1107,27 +2335,20 @@ async def admin_view_all_users(query):
         logging.error(f"Error in admin_view_all_users: {e}")
         await query.edit_message_text("❌ Error loading users. Please try again.")
 
-async def admin_view_user_details(query, user_id_to_view):
+async def admin_view_user_details(query, user_id_to_view, role):
     try:
-        current_user_id = query.from_user.id
-        current_user = db.get_user(current_user_id)
-        
-        if current_user_id not in ADMIN_IDS and current_user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        user = db.get_user_by_id(user_id_to_view)
+        user = await db.get_user_by_id(user_id_to_view)
         if not user:
             await query.edit_message_text("❌ User not found!")
             return
         
-        user_orders = db.get_orders(user_id_to_view)
+        user_orders = await db.get_orders(user_id_to_view)
         total_spent = sum(order[5] for order in user_orders) if user_orders else 0
-        purchased_keys = db.get_purchased_keys(user_id_to_view)
+        purchased_keys_count = await db.count_purchased_keys(user_id_to_view)
         
         reseller_prices = []
         if user[5] == 'reseller':
-            reseller_prices = db.get_reseller_prices(user_id_to_view)
+            reseller_prices = await db.get_reseller_prices(user_id_to_view)
         
         ban_status = "🚫 **BANNED**" if user[6] else "✅ **Active**"
         ban_info = f"\n🚫 **Ban Reason:** {user[7]}\n⏰ **Banned On:** {user[8]}" if user[6] else ""
@@ -1145,7 +2366,7 @@ async def admin_view_user_details(query, user_id_to_view):
 📊 **Statistics:**
 🛒 **Total Orders:** {len(user_orders)}
 💵 **Total Spent:** ${total_spent:.2f}
-🔑 **Keys Purchased:** {len(purchased_keys)}"""
+🔑 **Keys Purchased:** {purchased_keys_count}"""
 
         if reseller_prices:
             text += "\n\n💰 **Reseller Prices:**\n"
@@ -1154,29 +2375,29 @@ async def admin_view_user_details(query, user_id_to_view):
 
         keyboard = [
             [
-                InlineKeyboardButton("💵 Add Balance", callback_data=f"admin_add_balance_{user_id_to_view}"),
-                InlineKeyboardButton("➖ Minus Balance", callback_data=f"admin_minus_balance_{user_id_to_view}")
+                InlineKeyboardButton("💵 Add Balance", callback_data=pack_callback("admin_add_balance_", user_id_to_view)),
+                InlineKeyboardButton("➖ Minus Balance", callback_data=pack_callback("admin_minus_balance_", user_id_to_view))
             ]
         ]
         
         if user[6]:  # If user is banned
-            keyboard.append([InlineKeyboardButton("✅ Unban User", callback_data=f"admin_unban_user_{user_id_to_view}")])
+            keyboard.append([InlineKeyboardButton("✅ Unban User", callback_data=pack_callback("admin_unban_user_", user_id_to_view))])
         else:
-            keyboard.append([InlineKeyboardButton("🚫 Ban User", callback_data=f"admin_ban_user_{user_id_to_view}")])
+            keyboard.append([InlineKeyboardButton("🚫 Ban User", callback_data=pack_callback("admin_ban_user_", user_id_to_view))])
         
         keyboard.append([
-            InlineKeyboardButton("💰 Set Prices", callback_data=f"admin_set_price_{user_id_to_view}"),
+            InlineKeyboardButton("💰 Set Prices", callback_data=pack_callback("admin_set_price_", user_id_to_view)),
         ])
         
-        if current_user_id in ADMIN_IDS:
-            keyboard[-1].append(InlineKeyboardButton("👑 Set Admin", callback_data=f"admin_set_admin_{user_id_to_view}"))
+        if role == 'owner':
+            keyboard[-1].append(InlineKeyboardButton("👑 Set Admin", callback_data=pack_callback("admin_set_admin_", user_id_to_view)))
         
         if user[5] == 'user':
-            keyboard.append([InlineKeyboardButton("🎫 Set Reseller", callback_data=f"admin_set_reseller_{user_id_to_view}")])
+            keyboard.append([InlineKeyboardButton("🎫 Set Reseller", callback_data=pack_callback("admin_set_reseller_", user_id_to_view))])
         elif user[5] == 'reseller':
-            keyboard.append([InlineKeyboardButton("👤 Set Regular", callback_data=f"admin_set_user_{user_id_to_view}")])
+            keyboard.append([InlineKeyboardButton("👤 Set Regular", callback_data=pack_callback("admin_set_user_", user_id_to_view))])
         
-        keyboard.append([InlineKeyboardButton("🗑️ Delete User", callback_data=f"admin_delete_user_{user_id_to_view}")])
+        keyboard.append([InlineKeyboardButton("🗑️ Delete User", callback_data=pack_callback("admin_delete_user_", user_id_to_view))])
         keyboard.append([InlineKeyboardButton("🔙 Back to User Management", callback_data="admin_manage_users")])
         
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1185,16 +2406,51 @@ async def admin_view_user_details(query, user_id_to_view):
         logging.error(f"Error in admin_view_user_details: {e}")
         await query.edit_message_text("❌ Error loading user details. Please try again.")
 
+async def admin_set_user_type(query, user_id_to_set, user_type):
+    if user_type == 'admin':
+        await db.set_admin(user_id_to_set)
+    else:
+        await db.set_user_type(user_id_to_set, user_type)
+    labels = {'reseller': "Reseller", 'user': "Regular User", 'admin': "Admin"}
+    await query.edit_message_text(f"✅ User `{user_id_to_set}` has been set as **{labels[user_type]}**!", parse_mode='Markdown')
+
+async def admin_add_balance_start(query, context, user_id_to_add):
+    start_flow(context.user_data, 'add_balance', target_user_id=user_id_to_add)
+    await query.edit_message_text(f"💵 Please enter the amount to add for user `{user_id_to_add}`:\n\nExample: `50` or `25.99`", parse_mode='Markdown')
+
+async def admin_minus_balance_start(query, context, user_id_to_minus):
+    start_flow(context.user_data, 'minus_balance', target_user_id=user_id_to_minus)
+    await query.edit_message_text(f"💵 Please enter the amount to deduct from user `{user_id_to_minus}`:\n\nExample: `50` or `25.99`", parse_mode='Markdown')
+
+async def admin_ban_user_start(query, context, user_id_to_ban):
+    start_flow(context.user_data, 'ban_user', target_user_id=user_id_to_ban)
+    await query.edit_message_text(f"🚫 Please enter the ban reason for user `{user_id_to_ban}`:", parse_mode='Markdown')
+
+async def admin_unban_user(query, user_id_to_unban):
+    await db.unban_user(user_id_to_unban, admin_id=query.from_user.id)
+    await query.edit_message_text(f"✅ User `{user_id_to_unban}` has been **unbanned**!", parse_mode='Markdown')
+
+async def admin_delete_user_confirm(query, user_id_to_delete):
+    keyboard = [
+        [InlineKeyboardButton("✅ Confirm Delete", callback_data=pack_callback("admin_confirm_delete_", user_id_to_delete))],
+        [InlineKeyboardButton("❌ Cancel", callback_data=pack_callback("admin_view_user_", user_id_to_delete))]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(
+        f"⚠️ **Are you sure you want to DELETE user `{user_id_to_delete}`?**\n\n"
+        f"❌ This action cannot be undone!\n"
+        f"📝 All user data including orders and balance will be permanently removed.",
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+
+async def admin_delete_user(query, user_id_to_delete):
+    await db.delete_user(user_id_to_delete, admin_id=query.from_user.id)
+    await query.edit_message_text(f"✅ User `{user_id_to_delete}` has been **permanently deleted**!", parse_mode='Markdown')
+
 async def admin_show_balance_transactions(query):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        transactions = db.get_balance_transactions(limit=20)
+        transactions = await db.get_balance_transactions(limit=20)
         
         text = "💰 **Balance Transactions**\n\n"
         
@@ -1219,15 +2475,10 @@ async def admin_show_balance_transactions(query):
 
 async def admin_show_statistics(query):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        stats = db.get_sales_statistics()
-        products = db.get_products()
+        stats = await db.get_sales_statistics()
+        products = db.catalog.get_products()
+        catalog_stats = await db.get_catalog_stats()
+        cache_stats = db.user_cache.stats()
         
         text = f"""📊 **Store Statistics - {STORE_NAME}**
 
@@ -1247,10 +2498,13 @@ Used Keys: {stats['used_keys']}
 Available Keys: {stats['available_keys']}
 Stock Rate: {(stats['available_keys']/stats['total_keys']*100):.1f}%
 
+🧠 **User Cache:**
+Hits: {cache_stats['hits']} | Misses: {cache_stats['misses']} | Cached: {cache_stats['size']}
+
 📈 **Product Performance:**\n"""
         
         for product in products:
-            product_stats = db.get_product_stats(product[0])
+            product_stats = catalog_stats['products'].get(product[0], EMPTY_STATS)
             text += f"\n📦 **{product[1]}**\n"
             text += f"   Sold: {product_stats['sold']} | Revenue: ${product_stats['revenue']:.2f}\n"
             text += f"   Available: {product_stats['available']}/{product_stats['total_keys']}\n"
@@ -1263,91 +2517,135 @@ Stock Rate: {(stats['available_keys']/stats['total_keys']*100):.1f}%
         logging.error(f"Error in admin_show_statistics: {e}")
         await query.edit_message_text("❌ Error loading statistics. Please try again.")
 
+# ==================== INPUT FLOWS ====================
+
+# An admin text-input flow is a state name in user_data['state'], the time it
+# was entered in user_data['state_at'], and the values collected so far in
+# user_data['flow']. FLOW_STATES (below the handlers) maps each state to its
+# handler and timeout, so incoming messages are dispatched with one lookup.
+
+def start_flow(user_data, state, **values):
+    # Replaces whatever flow the user was in with a fresh one
+    user_data['flow'] = {}
+    enter_state(user_data, state, **values)
+
+def enter_state(user_data, state, **values):
+    user_data['state'] = state
+    user_data['state_at'] = time.time()
+    user_data['flow'].update(values)
+
+def end_flow(user_data):
+    user_data.pop('state', None)
+    user_data.pop('state_at', None)
+    user_data.pop('flow', None)
+
+def flow_expired(user_data, now):
+    state = user_data.get('state')
+    if state is None:
+        return False
+    if state not in FLOW_STATES:
+        return True
+    return now - user_data.get('state_at', 0) > FLOW_STATES[state][1]
+
+async def sweep_stale_flows(application):
+    # Evicts flows whose state has timed out, so abandoned prompts don't sit
+    # in user_data (and the persisted copy of it) indefinitely
+    while True:
+        await asyncio.sleep(FLOW_SWEEP_INTERVAL)
+        now = time.time()
+        stale = [uid for uid, user_data in application.user_data.items() if flow_expired(user_data, now)]
+        for uid in stale:
+            end_flow(application.user_data[uid])
+        if stale:
+            application.mark_data_for_update_persistence(user_ids=stale)
+
 # ==================== MESSAGE HANDLERS ====================
 
+async def current_flow_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Looks up the user's flow state, ending it (and telling them) if it has
+    # timed out or they've lost admin rights. Returns None when there's nothing to do
+    state = context.user_data.get('state')
+    if state is None:
+        await update.message.reply_text("Please use the menu buttons to navigate.")
+        return None
+    
+    # Every text-input flow is an admin flow
+    if not db.get_role(update.effective_user.id):
+        end_flow(context.user_data)
+        await update.message.reply_text("❌ Access denied!")
+        return None
+    
+    if state not in FLOW_STATES or flow_expired(context.user_data, time.time()):
+        end_flow(context.user_data)
+        await update.message.reply_text("⌛ That input has expired. Please start again from the menu.")
+        return None
+    
+    return state
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
     message_text = update.message.text
     
     try:
-        # Handle user search
-        if context.user_data.get('searching_user'):
-            await handle_user_search(update, context, message_text)
-            return
-        
-        # Handle balance addition
-        if 'add_balance_user' in context.user_data:
-            await handle_add_balance(update, context, message_text)
-            return
-        
-        # Handle balance deduction
-        if 'minus_balance_user' in context.user_data:
-            await handle_minus_balance(update, context, message_text)
+        state = await current_flow_state(update, context)
+        if state is None:
             return
         
-        # Handle ban user
-        if 'ban_user_id' in context.user_data:
-            await handle_ban_user(update, context, message_text)
-            return
-        
-        # Handle product addition
-        if context.user_data.get('adding_product'):
-            await handle_add_product_stages(update, context, message_text)
-            return
-        
-        # Handle plan addition
-        if context.user_data.get('adding_plan'):
-            await handle_add_plan_stages(update, context, message_text)
-            return
-        
-        # Handle keys addition
-        if context.user_data.get('adding_keys'):
-            await handle_add_keys(update, context, message_text)
-            return
-        
-        # Handle individual price setting
-        if context.user_data.get('setting_individual_price'):
-            await handle_set_individual_price(update, context, message_text)
-            return
-        
-        await update.message.reply_text("Please use the menu buttons to navigate.")
+        handler, _ = FLOW_STATES[state]
+        await handler(update, context, message_text)
     
     except Exception as e:
         logging.error(f"Error in handle_message: {e}")
         await update.message.reply_text("❌ An error occurred. Please try again.")
 
-async def handle_user_search(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
-    user_id = update.effective_user.id
-    user = db.get_user(user_id)
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        state = await current_flow_state(update, context)
+        if state is None:
+            return
+        
+        # Only key entry accepts uploaded files
+        if state == 'add_keys':
+            await handle_key_file(update, context)
+        else:
+            await update.message.reply_text("❌ Please send your answer as a text message.")
     
-    if user_id not in ADMIN_IDS and user[5] != 'admin':
-        await update.message.reply_text("❌ Access denied!")
+    except Exception as e:
+        logging.error(f"Error in handle_document: {e}")
+        await update.message.reply_text("❌ An error occurred. Please try again.")
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.user_data.get('state') is None:
+        await update.message.reply_text("Nothing to cancel.")
         return
     
-    users = db.search_users(message_text)
+    end_flow(context.user_data)
+    await update.message.reply_text("❌ Cancelled. Please use the menu buttons to continue.")
+
+async def handle_user_search(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
+    users = await db.search_users(message_text)
     
     if not users:
         await update.message.reply_text("❌ No users found with that search term.")
-        context.user_data.pop('searching_user', None)
+        end_flow(context.user_data)
         return
     
     text = "🔍 **Search Results**\n\n"
     keyboard = []
     
-    for user in users[:10]:
+    for user in users:
         ban_status = "🚫" if user[6] else "✅"
         text += f"{ban_status} `{user[0]}` | 👤 {user[5]} | 💰 ${user[4]:.2f}\n"
-        keyboard.append([InlineKeyboardButton(f"Manage User {user[0]}", callback_data=f"admin_view_user_{user[0]}")])
+        keyboard.append([InlineKeyboardButton(f"Manage User {user[0]}", callback_data=pack_callback("admin_view_user_", user[0]))])
     
     keyboard.append([InlineKeyboardButton("🔙 Back to User Management", callback_data="admin_manage_users")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
-    context.user_data.pop('searching_user', None)
+    end_flow(context.user_data)
 
 async def handle_add_balance(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
     user_id = update.effective_user.id
-    target_user_id = context.user_data['add_balance_user']
+    target_user_id = context.user_data['flow']['target_user_id']
     
     try:
         amount = float(message_text)
@@ -1355,7 +2653,7 @@ async def handle_add_balance(update: Update, context: ContextTypes.DEFAULT_TYPE,
             await update.message.reply_text("❌ Amount must be positive. Please try again:")
             return
         
-        db.update_user_balance(
+        await db.update_user_balance(
             target_user_id, 
             amount, 
             "admin_add", 
@@ -1363,7 +2661,7 @@ async def handle_add_balance(update: Update, context: ContextTypes.DEFAULT_TYPE,
             reason=f"Admin balance addition: ${amount:.2f}"
         )
         
-        target_user = db.get_user(target_user_id)
+        target_user = await db.get_user(target_user_id)
         await update.message.reply_text(
             f"✅ **Balance added successfully!**\n\n"
             f"👤 User: `{target_user_id}`\n"
@@ -1372,14 +2670,14 @@ async def handle_add_balance(update: Update, context: ContextTypes.DEFAULT_TYPE,
             parse_mode='Markdown'
         )
         
-        context.user_data.pop('add_balance_user', None)
+        end_flow(context.user_data)
         
     except ValueError:
         await update.message.reply_text("❌ Invalid amount. Please enter a valid number:")
 
 async def handle_minus_balance(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
     user_id = update.effective_user.id
-    target_user_id = context.user_data['minus_balance_user']
+    target_user_id = context.user_data['flow']['target_user_id']
     
     try:
         amount = float(message_text)
@@ -1387,14 +2685,14 @@ async def handle_minus_balance(update: Update, context: ContextTypes.DEFAULT_TYP
             await update.message.reply_text("❌ Amount must be positive. Please try again:")
             return
         
-        target_user = db.get_user(target_user_id)
+        target_user = await db.get_user(target_user_id)
         if target_user[4] < amount:
             await update.message.reply_text(
                 f"❌ User only has ${target_user[4]:.2f} balance. Cannot deduct ${amount:.2f}. Please try again:"
             )
             return
         
-        db.update_user_balance(
+        await db.update_user_balance(
             target_user_id, 
             -amount, 
             "admin_deduct", 
@@ -1402,7 +2700,7 @@ async def handle_minus_balance(update: Update, context: ContextTypes.DEFAULT_TYP
             reason=f"Admin balance deduction: ${amount:.2f}"
         )
         
-        target_user = db.get_user(target_user_id)
+        target_user = await db.get_user(target_user_id)
         await update.message.reply_text(
             f"✅ **Balance deducted successfully!**\n\n"
             f"👤 User: `{target_user_id}`\n"
@@ -1411,16 +2709,16 @@ async def handle_minus_balance(update: Update, context: ContextTypes.DEFAULT_TYP
             parse_mode='Markdown'
         )
         
-        context.user_data.pop('minus_balance_user', None)
+        end_flow(context.user_data)
         
     except ValueError:
         await update.message.reply_text("❌ Invalid amount. Please enter a valid number:")
 
 async def handle_ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
     user_id = update.effective_user.id
-    target_user_id = context.user_data['ban_user_id']
+    target_user_id = context.user_data['flow']['target_user_id']
     
-    db.ban_user(target_user_id, reason=message_text, admin_id=user_id)
+    await db.ban_user(target_user_id, reason=message_text, admin_id=user_id)
     
     await update.message.reply_text(
         f"✅ **User has been banned!**\n\n"
@@ -1429,21 +2727,13 @@ async def handle_ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE, me
         parse_mode='Markdown'
     )
     
-    context.user_data.pop('ban_user_id', None)
+    end_flow(context.user_data)
 
 # ==================== PRODUCT MANAGEMENT HANDLERS ====================
 
 async def admin_add_product_start(query, context):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        context.user_data['adding_product'] = True
-        context.user_data['add_product_stage'] = 'name'
+        start_flow(context.user_data, 'add_product_name')
         
         keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data="admin_manage_products")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1456,53 +2746,34 @@ async def admin_add_product_start(query, context):
         logging.error(f"Error in admin_add_product_start: {e}")
         await query.edit_message_text("❌ Error starting product addition. Please try again.")
 
-async def handle_add_product_stages(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
-    user_id = update.effective_user.id
-    user = db.get_user(user_id)
+async def handle_add_product_name(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
+    enter_state(context.user_data, 'add_product_description', product_name=message_text)
+    await update.message.reply_text("📝 Please enter the product description:")
+
+async def handle_add_product_description(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
+    product_name = context.user_data['flow']['product_name']
+    product_description = message_text
     
-    if user_id not in ADMIN_IDS and user[5] != 'admin':
-        await update.message.reply_text("❌ Access denied!")
-        context.user_data.clear()
-        return
+    product_id = await db.add_product(product_name, product_description)
     
-    if context.user_data['add_product_stage'] == 'name':
-        context.user_data['product_name'] = message_text
-        context.user_data['add_product_stage'] = 'description'
-        await update.message.reply_text("📝 Please enter the product description:")
+    await update.message.reply_text(
+        f"✅ **Product added successfully!**\n\n"
+        f"📦 **Name:** {product_name}\n"
+        f"📝 **Description:** {product_description}\n"
+        f"🆔 **Product ID:** `{product_id}`\n\n"
+        f"You can now add plans to this product.",
+        parse_mode='Markdown'
+    )
     
-    elif context.user_data['add_product_stage'] == 'description':
-        product_name = context.user_data['product_name']
-        product_description = message_text
-        
-        product_id = db.add_product(product_name, product_description)
-        
-        await update.message.reply_text(
-            f"✅ **Product added successfully!**\n\n"
-            f"📦 **Name:** {product_name}\n"
-            f"📝 **Description:** {product_description}\n"
-            f"🆔 **Product ID:** `{product_id}`\n\n"
-            f"You can now add plans to this product.",
-            parse_mode='Markdown'
-        )
-        
-        context.user_data.clear()
+    end_flow(context.user_data)
 
 async def admin_add_plan_start(query, context, product_id):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        context.user_data['adding_plan'] = True
-        context.user_data['add_plan_product_id'] = product_id
-        context.user_data['add_plan_stage'] = 'validity'
+        start_flow(context.user_data, 'add_plan_validity', product_id=product_id)
         
-        product = db.conn.execute('SELECT * FROM products WHERE product_id = ?', (product_id,)).fetchone()
+        product = await db.get_product(product_id)
         
-        keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data=f"admin_manage_plans_{product_id}")]]
+        keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data=pack_callback("admin_manage_plans_", product_id))]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(
@@ -1513,94 +2784,72 @@ async def admin_add_plan_start(query, context, product_id):
         logging.error(f"Error in admin_add_plan_start: {e}")
         await query.edit_message_text("❌ Error starting plan addition. Please try again.")
 
-async def handle_add_plan_stages(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
-    user_id = update.effective_user.id
-    user = db.get_user(user_id)
+async def handle_add_plan_validity(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
+    try:
+        validity_days = int(message_text)
+        if validity_days <= 0:
+            await update.message.reply_text("❌ Validity must be positive. Please enter valid days:")
+            return
+        
+        enter_state(context.user_data, 'add_plan_price', validity_days=validity_days)
+        await update.message.reply_text("💰 Please enter the base price (e.g., 9.99):")
     
-    if user_id not in ADMIN_IDS and user[5] != 'admin':
-        await update.message.reply_text("❌ Access denied!")
-        context.user_data.clear()
+    except ValueError:
+        await update.message.reply_text("❌ Invalid number. Please enter valid days:")
+
+async def handle_add_plan_price(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
+    try:
+        price = float(message_text)
+        if price <= 0:
+            await update.message.reply_text("❌ Price must be positive. Please enter valid price:")
+            return
+        
+        enter_state(context.user_data, 'add_plan_keys', price=price)
+        await update.message.reply_text("🔑 Please enter the product keys (one key per line):")
+    
+    except ValueError:
+        await update.message.reply_text("❌ Invalid price. Please enter valid amount:")
+
+async def handle_add_plan_keys(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
+    keys = [key.strip() for key in message_text.split('\n') if key.strip()]
+    
+    if not keys:
+        await update.message.reply_text("❌ No valid keys provided. Please enter at least one key:")
         return
     
-    if context.user_data['add_plan_stage'] == 'validity':
-        try:
-            validity_days = int(message_text)
-            if validity_days <= 0:
-                await update.message.reply_text("❌ Validity must be positive. Please enter valid days:")
-                return
-            
-            context.user_data['plan_validity'] = validity_days
-            context.user_data['add_plan_stage'] = 'price'
-            await update.message.reply_text("💰 Please enter the base price (e.g., 9.99):")
-        
-        except ValueError:
-            await update.message.reply_text("❌ Invalid number. Please enter valid days:")
+    flow = context.user_data['flow']
+    product_id = flow['product_id']
+    validity_days = flow['validity_days']
+    price = flow['price']
     
-    elif context.user_data['add_plan_stage'] == 'price':
-        try:
-            price = float(message_text)
-            if price <= 0:
-                await update.message.reply_text("❌ Price must be positive. Please enter valid price:")
-                return
-            
-            context.user_data['plan_price'] = price
-            context.user_data['add_plan_stage'] = 'keys'
-            await update.message.reply_text("🔑 Please enter the product keys (one key per line):")
-        
-        except ValueError:
-            await update.message.reply_text("❌ Invalid price. Please enter valid amount:")
+    plan_id = await db.add_product_plan(product_id, validity_days, price, keys)
     
-    elif context.user_data['add_plan_stage'] == 'keys':
-        keys = [key.strip() for key in message_text.split('\n') if key.strip()]
-        
-        if not keys:
-            await update.message.reply_text("❌ No valid keys provided. Please enter at least one key:")
-            return
-        
-        product_id = context.user_data['add_plan_product_id']
-        validity_days = context.user_data['plan_validity']
-        price = context.user_data['plan_price']
-        
-        plan_id = db.add_product_plan(product_id, validity_days, price, keys)
-        
-        product = db.conn.execute('SELECT * FROM products WHERE product_id = ?', (product_id,)).fetchone()
-        
-        await update.message.reply_text(
-            f"✅ **Plan added successfully!**\n\n"
-            f"📦 **Product:** {product[1]}\n"
-            f"⏰ **Validity:** {validity_days} days\n"
-            f"💰 **Price:** ${price:.2f}\n"
-            f"🔑 **Keys Added:** {len(keys)}\n"
-            f"🆔 **Plan ID:** `{plan_id}`",
-            parse_mode='Markdown'
-        )
-        
-        context.user_data.clear()
+    product = await db.get_product(product_id)
+    
+    await update.message.reply_text(
+        f"✅ **Plan added successfully!**\n\n"
+        f"📦 **Product:** {product[1]}\n"
+        f"⏰ **Validity:** {validity_days} days\n"
+        f"💰 **Price:** ${price:.2f}\n"
+        f"🔑 **Keys Added:** {db.catalog.get_stock(plan_id)}\n"
+        f"🆔 **Plan ID:** `{plan_id}`",
+        parse_mode='Markdown'
+    )
+    
+    end_flow(context.user_data)
 
 async def admin_add_keys_start(query, context, plan_id):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
+        start_flow(context.user_data, 'add_keys', plan_id=plan_id)
         
-        context.user_data['adding_keys'] = True
-        context.user_data['add_keys_plan_id'] = plan_id
+        plan = await db.get_plan_details(plan_id)
         
-        plan = db.conn.execute('''
-            SELECT pl.*, p.name 
-            FROM product_plans pl 
-            JOIN products p ON pl.product_id = p.product_id 
-            WHERE pl.plan_id = ?
-        ''', (plan_id,)).fetchone()
-        
-        keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data=f"admin_view_keys_{plan_id}")]]
+        keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data=pack_callback("admin_view_keys_", plan_id))]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(
-            f"🔑 **Add Keys to {plan[6]} - {plan[2]} days**\n\nPlease enter the product keys (one key per line):",
+            f"🔑 **Add Keys to {plan[6]} - {plan[2]} days**\n\nPlease enter the product keys (one key per line), "
+            f"or upload a .txt/.csv file with one key per line:",
             reply_markup=reply_markup
         )
     except Exception as e:
@@ -1608,51 +2857,77 @@ async def admin_add_keys_start(query, context, plan_id):
         await query.edit_message_text("❌ Error starting keys addition. Please try again.")
 
 async def handle_add_keys(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
-    user_id = update.effective_user.id
-    user = db.get_user(user_id)
-    
-    if user_id not in ADMIN_IDS and user[5] != 'admin':
-        await update.message.reply_text("❌ Access denied!")
-        context.user_data.clear()
-        return
-    
-    plan_id = context.user_data['add_keys_plan_id']
+    plan_id = context.user_data['flow']['plan_id']
     keys = [key.strip() for key in message_text.split('\n') if key.strip()]
     
     if not keys:
         await update.message.reply_text("❌ No valid keys provided. Please enter at least one key:")
         return
     
-    added_count = db.add_keys_to_plan(plan_id, keys)
+    counts = await db.add_keys_to_plan(plan_id, keys)
+    await reply_keys_added(update, plan_id, counts)
+    
+    end_flow(context.user_data)
+
+async def handle_key_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    document = update.message.document
+    file_name = (document.file_name or '').lower()
+    if not file_name.endswith(('.txt', '.csv')):
+        await update.message.reply_text("❌ Please upload a .txt or .csv file with one key per line:")
+        return
+    if document.file_size and document.file_size > MAX_KEY_FILE_SIZE:
+        await update.message.reply_text("❌ File is too large (max 20 MB). Please split it and upload the parts:")
+        return
+    
+    plan_id = context.user_data['flow']['plan_id']
+    await update.message.reply_text("⏳ Importing keys...")
     
-    plan = db.conn.execute('''
-        SELECT pl.*, p.name 
-        FROM product_plans pl 
-        JOIN products p ON pl.product_id = p.product_id 
-        WHERE pl.plan_id = ?
-    ''', (plan_id,)).fetchone()
+    # Download to disk and stream it into the import rather than holding it in memory
+    fd, path = tempfile.mkstemp(suffix=Path(file_name).suffix)
+    os.close(fd)
+    try:
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_drive(path)
+        counts = await db.add_keys_to_plan(plan_id, read_key_file(path, file_name.endswith('.csv')))
+    finally:
+        os.remove(path)
+    
+    await reply_keys_added(update, plan_id, counts)
+    end_flow(context.user_data)
+
+def read_key_file(path, is_csv):
+    # Yields one key per line of an uploaded file (the first column for .csv),
+    # or None for a line that isn't valid UTF-8
+    with open(path, 'rb') as f:
+        for raw in f:
+            try:
+                line = raw.decode('utf-8-sig')
+            except UnicodeDecodeError:
+                yield None
+                continue
+            if is_csv:
+                row = next(csv.reader([line]), None)
+                line = row[0] if row else ''
+            yield line
+
+async def reply_keys_added(update, plan_id, counts):
+    inserted, duplicates, invalid = counts
+    plan = await db.get_plan_details(plan_id)
     
     await update.message.reply_text(
         f"✅ **Keys added successfully!**\n\n"
         f"📦 **Product:** {plan[6]}\n"
         f"⏰ **Plan:** {plan[2]} days\n"
-        f"🔑 **Keys Added:** {added_count}\n"
-        f"📊 **New Stock:** {plan[4] + added_count}",
+        f"🔑 **Keys Added:** {inserted}\n"
+        f"♻️ **Duplicates Skipped:** {duplicates}\n"
+        f"⚠️ **Invalid Lines:** {invalid}\n"
+        f"📊 **New Stock:** {plan[4]}",
         parse_mode='Markdown'
     )
-    
-    context.user_data.clear()
 
 async def admin_search_user(query, context):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        context.user_data['searching_user'] = True
+        start_flow(context.user_data, 'search_user')
         
         keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data="admin_manage_users")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1667,32 +2942,18 @@ async def admin_search_user(query, context):
 
 async def admin_set_individual_price_start(query, context, target_user_id, plan_id):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        plan = db.conn.execute('''
-            SELECT pl.*, p.name 
-            FROM product_plans pl 
-            JOIN products p ON pl.product_id = p.product_id 
-            WHERE pl.plan_id = ?
-        ''', (plan_id,)).fetchone()
+        plan = await db.get_plan_details(plan_id)
         
         if not plan:
             await query.edit_message_text("❌ Plan not found!")
             return
         
-        context.user_data['setting_individual_price'] = True
-        context.user_data['price_user_id'] = target_user_id
-        context.user_data['price_plan_id'] = plan_id
+        start_flow(context.user_data, 'set_individual_price', target_user_id=target_user_id, plan_id=plan_id)
         
-        current_price = db.get_plan_price(plan_id, target_user_id)
+        current_price = await db.get_plan_price(plan_id, target_user_id)
         base_price = plan[3]
         
-        keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data=f"admin_set_price_{target_user_id}")]]
+        keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data=pack_callback("admin_set_price_", target_user_id))]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(
@@ -1709,31 +2970,18 @@ async def admin_set_individual_price_start(query, context, target_user_id, plan_
         await query.edit_message_text("❌ Error starting price setting. Please try again.")
 
 async def handle_set_individual_price(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
-    user_id = update.effective_user.id
-    user = db.get_user(user_id)
-    
-    if user_id not in ADMIN_IDS and user[5] != 'admin':
-        await update.message.reply_text("❌ Access denied!")
-        context.user_data.clear()
-        return
-    
     try:
         price = float(message_text)
         if price < 0:
             await update.message.reply_text("❌ Price cannot be negative. Please enter valid price:")
             return
         
-        target_user_id = context.user_data['price_user_id']
-        plan_id = context.user_data['price_plan_id']
+        target_user_id = context.user_data['flow']['target_user_id']
+        plan_id = context.user_data['flow']['plan_id']
         
-        db.set_reseller_price(target_user_id, plan_id, price)
+        await db.set_reseller_price(target_user_id, plan_id, price)
         
-        plan = db.conn.execute('''
-            SELECT pl.*, p.name 
-            FROM product_plans pl 
-            JOIN products p ON pl.product_id = p.product_id 
-            WHERE pl.plan_id = ?
-        ''', (plan_id,)).fetchone()
+        plan = await db.get_plan_details(plan_id)
         
         await update.message.reply_text(
             f"✅ **Price set successfully!**\n\n"
@@ -1744,7 +2992,7 @@ async def handle_set_individual_price(update: Update, context: ContextTypes.DEFA
             parse_mode='Markdown'
         )
         
-        context.user_data.clear()
+        end_flow(context.user_data)
         
     except ValueError:
         await update.message.reply_text("❌ Invalid price. Please enter a valid number:")
@@ -1753,14 +3001,9 @@ async def handle_set_individual_price(update: Update, context: ContextTypes.DEFA
 
 async def admin_manage_products(query):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        products = db.get_products()
+        catalog = db.catalog
+        products = catalog.get_products()
+        catalog_stats = await db.get_catalog_stats()
         
         text = "📦 **Product Management**\n\n"
         
@@ -1768,15 +3011,15 @@ async def admin_manage_products(query):
             text += "📭 No products available.\n"
         else:
             for product in products:
-                stats = db.get_product_stats(product[0])
-                plans = db.get_product_plans(product[0])
+                stats = catalog_stats['products'].get(product[0], EMPTY_STATS)
+                plans = catalog.get_product_plans(product[0])
                 
                 text += f"📦 **{product[1]}** (ID: `{product[0]}`)\n"
                 text += f"📝 {product[2]}\n"
                 
                 if plans:
                     for plan in plans:
-                        plan_stats = db.get_plan_stats(plan[0])
+                        plan_stats = catalog_stats['plans'].get(plan[0], EMPTY_STATS)
                         text += f"   ⏰ {plan[2]} days - ${plan[3]:.2f} | Stock: {plan_stats['available']}/{plan_stats['total_keys']}\n"
                 else:
                     text += f"   📭 No plans added\n"
@@ -1791,9 +3034,9 @@ async def admin_manage_products(query):
             keyboard.append([InlineKeyboardButton("🔧 Manage All Plans", callback_data="admin_manage_keys")])
             for product in products:
                 keyboard.append([
-                    InlineKeyboardButton(f"⚙️ {product[1]}", callback_data=f"admin_manage_plans_{product[0]}"),
-                    InlineKeyboardButton("✏️ Edit", callback_data=f"admin_edit_product_{product[0]}"),
-                    InlineKeyboardButton("🗑️ Delete", callback_data=f"admin_delete_product_{product[0]}")
+                    InlineKeyboardButton(f"⚙️ {product[1]}", callback_data=pack_callback("admin_manage_plans_", product[0])),
+                    InlineKeyboardButton("✏️ Edit", callback_data=pack_callback("admin_edit_product_", product[0])),
+                    InlineKeyboardButton("🗑️ Delete", callback_data=pack_callback("admin_delete_product_", product[0]))
                 ])
         
         keyboard.append([InlineKeyboardButton("🔙 Back to Admin Panel", callback_data="admin_back_to_panel")])
@@ -1806,19 +3049,12 @@ async def admin_manage_products(query):
 
 async def admin_manage_product_plans(query, product_id):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        product = db.conn.execute('SELECT * FROM products WHERE product_id = ?', (product_id,)).fetchone()
+        product = await db.get_product(product_id)
         if not product:
             await query.edit_message_text("❌ Product not found!")
             return
         
-        plans = db.get_product_plans(product_id)
+        plans = await db.get_product_plans(product_id)
         
         text = f"📦 **Plans for {product[1]}**\n\n"
         keyboard = []
@@ -1826,22 +3062,23 @@ async def admin_manage_product_plans(query, product_id):
         if not plans:
             text += "📭 No plans available.\n"
         else:
+            catalog_stats = await db.get_catalog_stats()
             for plan in plans:
-                stats = db.get_plan_stats(plan[0])
+                stats = catalog_stats['plans'].get(plan[0], EMPTY_STATS)
                 text += f"⏰ **{plan[2]} days** (ID: `{plan[0]}`)\n"
                 text += f"💰 ${plan[3]} | 📊 Sold: {stats['sold']} | 📦 Stock: {stats['available']}/{stats['total_keys']}\n"
                 text += f"💵 Revenue: ${stats['revenue']:.2f}\n\n"
                 
                 keyboard.append([
-                    InlineKeyboardButton(f"🔑 {plan[2]}d Keys", callback_data=f"admin_view_keys_{plan[0]}"),
-                    InlineKeyboardButton(f"➕ Add Keys", callback_data=f"admin_add_keys_{plan[0]}")
+                    InlineKeyboardButton(f"🔑 {plan[2]}d Keys", callback_data=pack_callback("admin_view_keys_", plan[0])),
+                    InlineKeyboardButton(f"➕ Add Keys", callback_data=pack_callback("admin_add_keys_", plan[0]))
                 ])
                 keyboard.append([
-                    InlineKeyboardButton(f"✏️ Edit {plan[2]}d", callback_data=f"admin_edit_plan_{plan[0]}"),
-                    InlineKeyboardButton(f"🗑️ Delete {plan[2]}d", callback_data=f"admin_delete_plan_{plan[0]}")
+                    InlineKeyboardButton(f"✏️ Edit {plan[2]}d", callback_data=pack_callback("admin_edit_plan_", plan[0])),
+                    InlineKeyboardButton(f"🗑️ Delete {plan[2]}d", callback_data=pack_callback("admin_delete_plan_", plan[0]))
                 ])
         
-        keyboard.append([InlineKeyboardButton("➕ Add New Plan", callback_data=f"admin_add_plan_{product_id}")])
+        keyboard.append([InlineKeyboardButton("➕ Add New Plan", callback_data=pack_callback("admin_add_plan_", product_id))])
         keyboard.append([InlineKeyboardButton("🔙 Back to Products", callback_data="admin_manage_products")])
         
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1852,24 +3089,20 @@ async def admin_manage_product_plans(query, product_id):
 
 async def admin_manage_keys(query):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        products = db.get_products()
+        catalog = db.catalog
+        catalog_stats = await db.get_catalog_stats()
         
         text = "🔑 **Key Management**\n\n"
         keyboard = []
         
-        for product in products:
-            plans = db.get_product_plans(product[0])
-            for plan in plans:
-                stats = db.get_plan_stats(plan[0])
+        for product in catalog.get_products():
+            for plan in catalog.get_product_plans(product[0]):
+                stats = catalog_stats['plans'].get(plan[0], EMPTY_STATS)
                 keyboard.append([
-                    InlineKeyboardButton(f"🔑 {product[1]} {plan[2]}d", callback_data=f"admin_view_keys_{plan[0]}")
+                    InlineKeyboardButton(
+                        f"🔑 {product[1]} {plan[2]}d ({stats['available']}/{stats['total_keys']})",
+                        callback_data=pack_callback("admin_view_keys_", plan[0])
+                    )
                 ])
         
         keyboard.append([InlineKeyboardButton("🔙 Back to Admin Panel", callback_data="admin_back_to_panel")])
@@ -1880,50 +3113,46 @@ async def admin_manage_keys(query):
         logging.error(f"Error in admin_manage_keys: {e}")
         await query.edit_message_text("❌ Error loading key management. Please try again.")
 
-async def admin_view_plan_keys(query, plan_id):
+async def admin_view_plan_keys(query, plan_id, key_filter='all', cursor=None, backwards=False):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        plan = db.conn.execute('''
-            SELECT pl.*, p.name 
-            FROM product_plans pl 
-            JOIN products p ON pl.product_id = p.product_id 
-            WHERE pl.plan_id = ?
-        ''', (plan_id,)).fetchone()
+        plan = await db.get_plan_details(plan_id)
         
         if not plan:
             await query.edit_message_text("❌ Plan not found!")
             return
         
-        keys = db.get_all_keys(plan_id)
-        stats = db.get_plan_stats(plan_id)
+        keys, has_prev, has_next = await db.get_keys_page(plan_id, KEY_FILTERS[key_filter], cursor, backwards)
+        available = db.catalog.get_stock(plan_id)
+        used = await db.count_used_keys(plan_id)
         
         text = f"🔑 **Keys for {plan[6]} - {plan[2]} days**\n\n"
         text += f"📊 **Statistics:**\n"
-        text += f"• Total Keys: {stats['total_keys']}\n"
-        text += f"• Used Keys: {stats['sold']}\n"
-        text += f"• Available Keys: {stats['available']}\n\n"
+        text += f"• Total Keys: {available + used}\n"
+        text += f"• Used Keys: {used}\n"
+        text += f"• Available Keys: {available}\n\n"
         
+        filter_labels = {'all': "📋 All", 'free': "🟢 Available", 'used': "✅ Used"}
         keyboard = [
-            [InlineKeyboardButton("➕ Add More Keys", callback_data=f"admin_add_keys_{plan_id}")],
+            [InlineKeyboardButton("➕ Add More Keys", callback_data=pack_callback("admin_add_keys_", plan_id))],
+            [
+                InlineKeyboardButton(f"• {label} •" if name == key_filter else label, callback_data=pack_callback("admin_keys_", plan_id, name))
+                for name, label in filter_labels.items()
+            ],
         ]
         
         if keys:
             text += "🔑 **Key List:**\n"
-            for key in keys[:10]:  # Show first 10 keys
+            for key in keys:
                 status = "✅ Used" if key[2] else "🟢 Available"
                 user_info = f"by {key[4]} ({key[3]})" if key[2] else ""
                 text += f"• `{key[1]}` - {status} {user_info}\n"
-            
-            if len(keys) > 10:
-                text += f"\n... and {len(keys) - 10} more keys"
+                if not key[2]:
+                    keyboard.append([InlineKeyboardButton(f"🗑️ Delete {key[1][:24]}", callback_data=pack_callback("admin_delete_key_", key[0]))])
+        else:
+            text += "📭 No keys to show."
         
-        keyboard.append([InlineKeyboardButton("🔙 Back to Plans", callback_data=f"admin_manage_plans_{plan[1]}")])
+        keyboard += page_buttons("admin_keys", keys, has_prev, has_next, plan_id, key_filter)
+        keyboard.append([InlineKeyboardButton("🔙 Back to Plans", callback_data=pack_callback("admin_manage_plans_", plan[1]))])
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
@@ -1933,17 +3162,12 @@ async def admin_view_plan_keys(query, plan_id):
 
 async def admin_delete_key(query, key_id):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        success = db.delete_key(key_id)
+        plan_id = await db.delete_key(key_id)
         
-        if success:
-            await query.edit_message_text("✅ Key deleted successfully!")
+        if plan_id:
+            keyboard = [[InlineKeyboardButton("🔙 Back to Keys", callback_data=pack_callback("admin_view_keys_", plan_id))]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await query.edit_message_text("✅ Key deleted successfully!", reply_markup=reply_markup)
         else:
             await query.edit_message_text("❌ Cannot delete used key or key not found!")
     except Exception as e:
@@ -1952,21 +3176,12 @@ async def admin_delete_key(query, key_id):
 
 async def admin_edit_product_start(query, context, product_id):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        product = db.conn.execute('SELECT * FROM products WHERE product_id = ?', (product_id,)).fetchone()
+        product = await db.get_product(product_id)
         if not product:
             await query.edit_message_text("❌ Product not found!")
             return
         
-        context.user_data['editing_product'] = True
-        context.user_data['edit_product_id'] = product_id
-        context.user_data['edit_product_stage'] = 'name'
+        start_flow(context.user_data, 'edit_product_name', product_id=product_id)
         
         keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data="admin_manage_products")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1983,55 +3198,35 @@ async def admin_edit_product_start(query, context, product_id):
         logging.error(f"Error in admin_edit_product_start: {e}")
         await query.edit_message_text("❌ Error starting product edit. Please try again.")
 
-async def handle_edit_product_stages(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
-    user_id = update.effective_user.id
-    user = db.get_user(user_id)
+async def handle_edit_product_name(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
+    enter_state(context.user_data, 'edit_product_description', new_name=message_text)
+    await update.message.reply_text("📝 Please enter the new product description:")
+
+async def handle_edit_product_description(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
+    product_id = context.user_data['flow']['product_id']
+    new_name = context.user_data['flow']['new_name']
+    new_description = message_text
     
-    if user_id not in ADMIN_IDS and user[5] != 'admin':
-        await update.message.reply_text("❌ Access denied!")
-        context.user_data.clear()
-        return
+    await db.update_product(product_id, new_name, new_description)
     
-    if context.user_data['edit_product_stage'] == 'name':
-        context.user_data['new_product_name'] = message_text
-        context.user_data['edit_product_stage'] = 'description'
-        await update.message.reply_text("📝 Please enter the new product description:")
+    await update.message.reply_text(
+        f"✅ **Product updated successfully!**\n\n"
+        f"📦 **New Name:** {new_name}\n"
+        f"📝 **New Description:** {new_description}\n"
+        f"🆔 **Product ID:** `{product_id}`",
+        parse_mode='Markdown'
+    )
     
-    elif context.user_data['edit_product_stage'] == 'description':
-        product_id = context.user_data['edit_product_id']
-        new_name = context.user_data['new_product_name']
-        new_description = message_text
-        
-        db.update_product(product_id, new_name, new_description)
-        
-        await update.message.reply_text(
-            f"✅ **Product updated successfully!**\n\n"
-            f"📦 **New Name:** {new_name}\n"
-            f"📝 **New Description:** {new_description}\n"
-            f"🆔 **Product ID:** `{product_id}`",
-            parse_mode='Markdown'
-        )
-        
-        context.user_data.clear()
+    end_flow(context.user_data)
 
 async def admin_delete_product(query, product_id):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        product = db.conn.execute('SELECT * FROM products WHERE product_id = ?', (product_id,)).fetchone()
+        product = await db.get_product(product_id)
         if not product:
             await query.edit_message_text("❌ Product not found!")
             return
         
-        orders_count = db.conn.execute(
-            'SELECT COUNT(*) FROM orders o JOIN product_plans pl ON o.plan_id = pl.plan_id WHERE pl.product_id = ?', 
-            (product_id,)
-        ).fetchone()[0]
+        orders_count = await db.count_product_orders(product_id)
         
         if orders_count > 0:
             await query.edit_message_text(
@@ -2042,7 +3237,7 @@ async def admin_delete_product(query, product_id):
             )
             return
         
-        db.delete_product(product_id)
+        await db.delete_product(product_id)
         
         keyboard = [[InlineKeyboardButton("🔙 Back to Products", callback_data="admin_manage_products")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -2060,29 +3255,15 @@ async def admin_delete_product(query, product_id):
 
 async def admin_edit_plan_start(query, context, plan_id):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        plan = db.conn.execute('''
-            SELECT pl.*, p.name 
-            FROM product_plans pl 
-            JOIN products p ON pl.product_id = p.product_id 
-            WHERE pl.plan_id = ?
-        ''', (plan_id,)).fetchone()
+        plan = await db.get_plan_details(plan_id)
         
         if not plan:
             await query.edit_message_text("❌ Plan not found!")
             return
         
-        context.user_data['editing_plan'] = True
-        context.user_data['edit_plan_id'] = plan_id
-        context.user_data['edit_plan_stage'] = 'validity'
+        start_flow(context.user_data, 'edit_plan_validity', plan_id=plan_id)
         
-        keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data=f"admin_manage_plans_{plan[1]}")]]
+        keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data=pack_callback("admin_manage_plans_", plan[1]))]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(
@@ -2097,86 +3278,56 @@ async def admin_edit_plan_start(query, context, plan_id):
         logging.error(f"Error in admin_edit_plan_start: {e}")
         await query.edit_message_text("❌ Error starting plan edit. Please try again.")
 
-async def handle_edit_plan_stages(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
-    user_id = update.effective_user.id
-    user = db.get_user(user_id)
-    
-    if user_id not in ADMIN_IDS and user[5] != 'admin':
-        await update.message.reply_text("❌ Access denied!")
-        context.user_data.clear()
-        return
-    
-    if context.user_data['edit_plan_stage'] == 'validity':
-        try:
-            new_validity = int(message_text)
-            if new_validity <= 0:
-                await update.message.reply_text("❌ Validity must be positive. Please enter valid days:")
-                return
-            
-            context.user_data['new_plan_validity'] = new_validity
-            context.user_data['edit_plan_stage'] = 'price'
-            await update.message.reply_text("💰 Please enter the new price (e.g., 9.99):")
+async def handle_edit_plan_validity(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
+    try:
+        new_validity = int(message_text)
+        if new_validity <= 0:
+            await update.message.reply_text("❌ Validity must be positive. Please enter valid days:")
+            return
         
-        except ValueError:
-            await update.message.reply_text("❌ Invalid number. Please enter valid days:")
+        enter_state(context.user_data, 'edit_plan_price', new_validity=new_validity)
+        await update.message.reply_text("💰 Please enter the new price (e.g., 9.99):")
     
-    elif context.user_data['edit_plan_stage'] == 'price':
-        try:
-            new_price = float(message_text)
-            if new_price <= 0:
-                await update.message.reply_text("❌ Price must be positive. Please enter valid price:")
-                return
-            
-            plan_id = context.user_data['edit_plan_id']
-            new_validity = context.user_data['new_plan_validity']
-            
-            db.update_product_plan(plan_id, new_validity, new_price)
-            
-            plan = db.conn.execute('''
-                SELECT pl.*, p.name 
-                FROM product_plans pl 
-                JOIN products p ON pl.product_id = p.product_id 
-                WHERE pl.plan_id = ?
-            ''', (plan_id,)).fetchone()
-            
-            await update.message.reply_text(
-                f"✅ **Plan updated successfully!**\n\n"
-                f"📦 **Product:** {plan[6]}\n"
-                f"⏰ **New Validity:** {new_validity} days\n"
-                f"💰 **New Price:** ${new_price:.2f}\n"
-                f"🆔 **Plan ID:** `{plan_id}`",
-                parse_mode='Markdown'
-            )
-            
-            context.user_data.clear()
-        
-        except ValueError:
-            await update.message.reply_text("❌ Invalid price. Please enter valid amount:")
+    except ValueError:
+        await update.message.reply_text("❌ Invalid number. Please enter valid days:")
 
-async def admin_delete_plan(query, plan_id):
+async def handle_edit_plan_price(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
+        new_price = float(message_text)
+        if new_price <= 0:
+            await update.message.reply_text("❌ Price must be positive. Please enter valid price:")
             return
         
-        plan = db.conn.execute('''
-            SELECT pl.*, p.name 
-            FROM product_plans pl 
-            JOIN products p ON pl.product_id = p.product_id 
-            WHERE pl.plan_id = ?
-        ''', (plan_id,)).fetchone()
+        plan_id = context.user_data['flow']['plan_id']
+        new_validity = context.user_data['flow']['new_validity']
+        
+        await db.update_product_plan(plan_id, new_validity, new_price)
+        
+        plan = await db.get_plan_details(plan_id)
+        
+        await update.message.reply_text(
+            f"✅ **Plan updated successfully!**\n\n"
+            f"📦 **Product:** {plan[6]}\n"
+            f"⏰ **New Validity:** {new_validity} days\n"
+            f"💰 **New Price:** ${new_price:.2f}\n"
+            f"🆔 **Plan ID:** `{plan_id}`",
+            parse_mode='Markdown'
+        )
+        
+        end_flow(context.user_data)
+    
+    except ValueError:
+        await update.message.reply_text("❌ Invalid price. Please enter valid amount:")
+
+async def admin_delete_plan(query, plan_id):
+    try:
+        plan = await db.get_plan_details(plan_id)
         
         if not plan:
             await query.edit_message_text("❌ Plan not found!")
             return
         
-        orders_count = db.conn.execute(
-            'SELECT COUNT(*) FROM orders WHERE plan_id = ?', 
-            (plan_id,)
-        ).fetchone()[0]
+        orders_count = await db.count_plan_orders(plan_id)
         
         if orders_count > 0:
             await query.edit_message_text(
@@ -2187,9 +3338,9 @@ async def admin_delete_plan(query, plan_id):
             )
             return
         
-        db.delete_product_plan(plan_id)
+        await db.delete_product_plan(plan_id)
         
-        keyboard = [[InlineKeyboardButton("🔙 Back to Plans", callback_data=f"admin_manage_plans_{plan[1]}")]]
+        keyboard = [[InlineKeyboardButton("🔙 Back to Plans", callback_data=pack_callback("admin_manage_plans_", plan[1]))]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(
@@ -2206,35 +3357,29 @@ async def admin_delete_plan(query, plan_id):
 
 async def admin_set_reseller_price_start(query, context, user_id):
     try:
-        current_user_id = query.from_user.id
-        current_user = db.get_user(current_user_id)
-        
-        if current_user_id not in ADMIN_IDS and current_user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        products = db.get_products()
+        catalog = db.catalog
+        products = catalog.get_products()
         
         if not products:
             await query.edit_message_text("❌ No products available to set prices!")
             return
         
+        prices = await db.get_plan_prices(user_id)
         text = "💰 **Set Reseller Prices**\n\n"
         keyboard = []
         
         for product in products:
-            plans = db.get_product_plans(product[0])
-            for plan in plans:
-                current_price = db.get_plan_price(plan[0], user_id)
+            for plan in catalog.get_product_plans(product[0]):
+                current_price = prices.get(plan[0], plan[3])
                 base_price = plan[3]
                 text += f"📦 {product[1]} - {plan[2]} days\n"
                 text += f"   Base: ${base_price:.2f} | Current: ${current_price:.2f}\n\n"
                 
                 keyboard.append([
-                    InlineKeyboardButton(f"💰 {product[1]} {plan[2]}d", callback_data=f"admin_set_plan_price_{user_id}_{plan[0]}")
+                    InlineKeyboardButton(f"💰 {product[1]} {plan[2]}d", callback_data=pack_callback("admin_set_plan_price_", user_id, plan[0]))
                 ])
         
-        keyboard.append([InlineKeyboardButton("🔙 Back to User", callback_data=f"admin_view_user_{user_id}")])
+        keyboard.append([InlineKeyboardButton("🔙 Back to User", callback_data=pack_callback("admin_view_user_", user_id))])
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
@@ -2242,30 +3387,24 @@ async def admin_set_reseller_price_start(query, context, user_id):
         logging.error(f"Error in admin_set_reseller_price_start: {e}")
         await query.edit_message_text("❌ Error starting price setting. Please try again.")
 
-async def admin_show_all_orders(query):
+async def admin_show_all_orders(query, cursor=None, backwards=False):
     try:
-        user_id = query.from_user.id
-        user = db.get_user(user_id)
-        
-        if user_id not in ADMIN_IDS and user[5] != 'admin':
-            await query.edit_message_text("❌ Access denied!")
-            return
-        
-        orders = db.get_orders()
+        orders, has_prev, has_next = await db.get_orders_page(cursor=cursor, backwards=backwards)
         
         text = "📋 **All Orders**\n\n"
         
         if not orders:
             text += "📭 No orders found."
         else:
-            for order in orders[:15]:
+            for order in orders:
                 text += f"🆔 **Order #{order[0]}**\n"
-                text += f"👤 **User:** {order[8]} (ID: `{order[1]}`)\n"
-                text += f"📦 **Product:** {order[7]} ({order[8]} days)\n"
+                text += f"👤 **User:** {order[10]} (ID: `{order[1]}`)\n"
+                text += f"📦 **Product:** {order[8]} ({order[9]} days)\n"
                 text += f"💵 **Amount:** ${order[5]:.2f}\n"
-                text += f"🕒 **Date:** {order[6]}\n\n"
+                text += f"🕒 **Date:** {order[7]}\n\n"
         
-        keyboard = [[InlineKeyboardButton("🔙 Back to Admin Panel", callback_data="admin_back_to_panel")]]
+        keyboard = page_buttons("admin_orders", orders, has_prev, has_next)
+        keyboard.append([InlineKeyboardButton("🔙 Back to Admin Panel", callback_data="admin_back_to_panel")])
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
@@ -2273,20 +3412,166 @@ async def admin_show_all_orders(query):
         logging.error(f"Error in admin_show_all_orders: {e}")
         await query.edit_message_text("❌ Error loading orders. Please try again.")
 
+# Every inline button's callback_data, see CallbackRouter.add. Admin handlers
+# rely on the router's role check and don't repeat it.
+callback_router = CallbackRouter()
+
+# Main menu
+callback_router.add("view_products", show_products_menu)
+callback_router.add("check_balance", show_balance)
+callback_router.add("balance_statement", show_statement)
+callback_router.add("order_history", show_order_history)
+callback_router.add("orders_next_", show_order_history, int, op=1)
+callback_router.add("orders_prev_", show_order_history, int, op=2, backwards=True)
+callback_router.add("my_keys", show_my_keys)
+callback_router.add("my_keys_next_", show_my_keys, int, op=34)
+callback_router.add("my_keys_prev_", show_my_keys, int, op=35, backwards=True)
+callback_router.add("my_keys_export_txt", export_my_keys, file_format='txt')
+callback_router.add("my_keys_export_csv", export_my_keys, file_format='csv')
+callback_router.add("main_menu", show_main_menu)
+
+# Products
+callback_router.add("product_", show_product_plans, int, op=3)
+callback_router.add("plan_", show_plan_details, int, op=4)
+callback_router.add("buy_", process_purchase, int, int, op=5)  # buy_<plan>[_<quantity>]
+callback_router.add("back_to_products", show_products_menu)
+
+# Admin panel
+callback_router.add("admin_panel", show_admin_panel, admin=True)
+callback_router.add("admin_back_to_panel", show_admin_panel, admin=True)
+callback_router.add("admin_manage_products", admin_manage_products, admin=True)
+callback_router.add("admin_manage_users", admin_manage_users, admin=True)
+callback_router.add("admin_statistics", admin_show_statistics, admin=True)
+callback_router.add("admin_all_orders", admin_show_all_orders, admin=True)
+callback_router.add("admin_orders_next_", admin_show_all_orders, int, op=6, admin=True)
+callback_router.add("admin_orders_prev_", admin_show_all_orders, int, op=7, backwards=True, admin=True)
+callback_router.add("admin_add_product", admin_add_product_start, admin=True, context=True)
+callback_router.add("admin_view_all_users", admin_view_all_users, admin=True)
+callback_router.add("admin_users_next_", admin_view_all_users, int, op=8, admin=True)
+callback_router.add("admin_users_prev_", admin_view_all_users, int, op=9, backwards=True, admin=True)
+callback_router.add("admin_manage_keys", admin_manage_keys, admin=True)
+callback_router.add("admin_balance_transactions", admin_show_balance_transactions, admin=True)
+
+# Products, plans and keys
+callback_router.add("admin_view_keys_", admin_view_plan_keys, int, op=10, admin=True)
+callback_router.add("admin_keys_", admin_view_plan_keys, int, str, op=11, admin=True)  # admin_keys_<plan>_<filter>
+callback_router.add("admin_keys_next_", admin_view_plan_keys, int, str, int, op=12, admin=True)
+callback_router.add("admin_keys_prev_", admin_view_plan_keys, int, str, int, op=13, backwards=True, admin=True)
+callback_router.add("admin_add_keys_", admin_add_keys_start, int, op=14, admin=True, context=True)
+callback_router.add("admin_delete_key_", admin_delete_key, int, op=15, admin=True)
+callback_router.add("admin_add_plan_", admin_add_plan_start, int, op=16, admin=True, context=True)
+callback_router.add("admin_manage_plans_", admin_manage_product_plans, int, op=17, admin=True)
+callback_router.add("admin_edit_product_", admin_edit_product_start, int, op=18, admin=True, context=True)
+callback_router.add("admin_delete_product_", admin_delete_product, int, op=19, admin=True)
+callback_router.add("admin_edit_plan_", admin_edit_plan_start, int, op=20, admin=True, context=True)
+callback_router.add("admin_delete_plan_", admin_delete_plan, int, op=21, admin=True)
+
+# User management
+callback_router.add("admin_search_user", admin_search_user, admin=True, context=True)
+callback_router.add("admin_view_user_", admin_view_user_details, int, op=22, admin=True, role=True)
+callback_router.add("admin_set_reseller_", admin_set_user_type, int, op=23, user_type='reseller', admin=True)
+callback_router.add("admin_set_user_", admin_set_user_type, int, op=24, user_type='user', admin=True)
+callback_router.add("admin_set_admin_", admin_set_user_type, int, op=25, user_type='admin', owner=True)
+callback_router.add("admin_add_balance_", admin_add_balance_start, int, op=26, admin=True, context=True)
+callback_router.add("admin_minus_balance_", admin_minus_balance_start, int, op=27, admin=True, context=True)
+callback_router.add("admin_set_price_", admin_set_reseller_price_start, int, op=28, admin=True, context=True)
+callback_router.add("admin_set_plan_price_", admin_set_individual_price_start, int, int, op=29, admin=True, context=True)
+callback_router.add("admin_ban_user_", admin_ban_user_start, int, op=30, admin=True, context=True)
+callback_router.add("admin_unban_user_", admin_unban_user, int, op=31, admin=True)
+callback_router.add("admin_delete_user_", admin_delete_user_confirm, int, op=32, admin=True)
+callback_router.add("admin_confirm_delete_", admin_delete_user, int, op=33, admin=True)
+
+# Input flow states: state -> (message handler, seconds before the flow times out)
+FLOW_STATES = {
+    'search_user': (handle_user_search, 300),
+    'add_balance': (handle_add_balance, 300),
+    'minus_balance': (handle_minus_balance, 300),
+    'ban_user': (handle_ban_user, 300),
+    'set_individual_price': (handle_set_individual_price, 300),
+    'add_product_name': (handle_add_product_name, 900),
+    'add_product_description': (handle_add_product_description, 900),
+    'add_plan_validity': (handle_add_plan_validity, 900),
+    'add_plan_price': (handle_add_plan_price, 900),
+    'add_plan_keys': (handle_add_plan_keys, 1800),
+    'add_keys': (handle_add_keys, 1800),
+    'edit_product_name': (handle_edit_product_name, 900),
+    'edit_product_description': (handle_edit_product_description, 900),
+    'edit_plan_validity': (handle_edit_plan_validity, 900),
+    'edit_plan_price': (handle_edit_plan_price, 900),
+}
+
+# ==================== BACKGROUND TASKS ====================
+
+async def record_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Runs ahead of every other handler (group -1); the write happens in the
+    # next profile flush, not here
+    user = update.effective_user
+    if user:
+        db.queue_profile(user.id, (user.username, user.first_name, user.last_name))
+
+async def flush_profiles_periodically():
+    while True:
+        await asyncio.sleep(PROFILE_FLUSH_INTERVAL)
+        try:
+            await db.flush_profiles()
+        except Exception as e:
+            logging.error(f"Error in flush_profiles: {e}")
+
+async def post_init(application):
+    application.bot_data['flow_sweeper'] = asyncio.create_task(sweep_stale_flows(application))
+    application.bot_data['profile_flusher'] = asyncio.create_task(flush_profiles_periodically())
+
+async def post_shutdown(application):
+    for name in ('flow_sweeper', 'profile_flusher'):
+        task = application.bot_data.pop(name, None)
+        if task:
+            task.cancel()
+    await db.flush_profiles()
+
 def main():
-    application = Application.builder().token(BOT_TOKEN).build()
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL must be set when BOT_MODE=webhook")
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(UserOrderedUpdateProcessor(CONCURRENT_UPDATES))
+        .persistence(SQLitePersistence(db))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Add handlers
+    application.add_handler(TypeHandler(Update, record_profile), group=-1)
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(CallbackQueryHandler(handle_callback))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
     
     # Start the bot
     print("🤖 Bot is starting...")
-    print(f"👑 Admin ID: {ADMIN_IDS[0]}")
+    print(f"👑 Admin IDs: {', '.join(str(admin_id) for admin_id in sorted(ADMIN_IDS))}")
     print(f"🏪 Store Name: {STORE_NAME}")
+    print(f"📡 Mode: {BOT_MODE}")
     print("📊 Database initialized successfully!")
-    application.run_polling()
+    
+    unindexed = db.database.find_unindexed_queries()
+    if unindexed:
+        logging.warning(f"Queries not served by an index in order: {', '.join(unindexed)}")
+    
+    if BOT_MODE == 'webhook':
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,34 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# bot opens its module-level database on import, so point it somewhere disposable first
+os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bot_database.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path):
+    return bot.Database(str(tmp_path / 'bot_database.db'))
+
+
+@pytest.fixture
+def async_db(database):
+    return bot.AsyncDatabase(database)
+
+
+@pytest.fixture
+def plan(database):
+    # A plan with 10 keys at $1.00
+    product_id = database.add_product('Product', 'Description')
+    return database.add_product_plan(product_id, 30, 1.0, [f'key-{i}' for i in range(10)])
+
+
+def free_keys(database, plan_id):
+    return database.conn.execute(
+        'SELECT COUNT(*) FROM product_keys WHERE plan_id = ? AND is_used = 0', (plan_id,)
+    ).fetchone()[0]
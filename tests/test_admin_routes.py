@@ -0,0 +1,66 @@
+import asyncio
+import types
+
+import pytest
+
+import bot
+
+OWNER, ADMIN, CUSTOMER = 1, 2, 3
+
+
+class Query:
+    def __init__(self, user_id, data):
+        self.from_user = types.SimpleNamespace(id=user_id, username=None, first_name=None, last_name=None)
+        self.data = data
+        self.edits = []
+    
+    async def answer(self, *args, **kwargs):
+        pass
+    
+    async def edit_message_text(self, text, reply_markup=None, **kwargs):
+        buttons = [button.text for row in reply_markup.inline_keyboard for button in row] if reply_markup else []
+        self.edits.append((text, buttons))
+
+
+@pytest.fixture
+def press(database, async_db, monkeypatch):
+    monkeypatch.setattr(bot, 'db', async_db)
+    monkeypatch.setattr(bot, 'ADMIN_IDS', frozenset({OWNER}))
+    for user_id in (OWNER, ADMIN, CUSTOMER):
+        database.create_user(user_id)
+    database.admin_ids = frozenset({ADMIN})
+    
+    role_lookups = []
+    get_role = database.get_role
+    def spy(user_id):
+        role_lookups.append(user_id)
+        return get_role(user_id)
+    monkeypatch.setattr(database, 'get_role', spy)
+    
+    def press(user_id, data):
+        role_lookups.clear()
+        query = Query(user_id, data)
+        update = types.SimpleNamespace(callback_query=query, effective_user=query.from_user)
+        asyncio.run(bot.handle_callback(update, types.SimpleNamespace(user_data={})))
+        return query.edits[-1], list(role_lookups)
+    return press
+
+
+def test_admin_route_gets_the_resolved_role(press):
+    data = bot.callback_router.encode('admin_view_user_', CUSTOMER)
+    (text, buttons), lookups = press(OWNER, data)
+    assert '👑 Set Admin' in buttons
+    assert lookups == [OWNER]
+    
+    (text, buttons), lookups = press(ADMIN, data)
+    assert 'User Details' in text
+    assert '👑 Set Admin' not in buttons
+    assert lookups == [ADMIN]
+
+
+def test_denied_caller_never_reaches_the_handler(press):
+    edit, lookups = press(CUSTOMER, bot.callback_router.encode('admin_view_user_', OWNER))
+    assert edit == ('❌ Access denied!', [])
+    assert lookups == [CUSTOMER]
+    edit, _ = press(ADMIN, bot.callback_router.encode('admin_set_admin_', CUSTOMER))
+    assert edit == ('❌ Access denied!', [])
@@ -0,0 +1,87 @@
+import base64
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def router():
+    router = bot.CallbackRouter()
+    router.add('admin_keys_next_', 'keys page', int, str, int, op=12)
+    router.add('buy_', 'buy', int, int, op=5)
+    router.add('user_', 'user', int, op=300)
+    return router
+
+
+@pytest.fixture(params=[b'', b'test-secret'], ids=['unsigned', 'signed'])
+def secret(request, monkeypatch):
+    monkeypatch.setattr(bot, 'CALLBACK_SECRET', request.param)
+    return request.param
+
+
+def flip(data, index):
+    # Flips one bit of the decoded payload byte at index and re-encodes it
+    raw = bytearray(base64.urlsafe_b64decode(data[1:] + '=' * (-len(data[1:]) % 4)))
+    raw[index] ^= 0x01
+    return '~' + base64.urlsafe_b64encode(bytes(raw)).rstrip(b'=').decode()
+
+
+def test_round_trip(router, secret):
+    data = router.encode('admin_keys_next_', 2 ** 40, 'used ✓', 987654321)
+    assert len(data) <= 64
+    route, args = router.resolve(data)
+    assert route[0] == 'keys page'
+    assert args == [2 ** 40, 'used ✓', 987654321]
+    
+    assert router.resolve(router.encode('user_', 2 ** 62))[1] == [2 ** 62]
+    # Trailing args left off fall back to the handler's defaults
+    assert router.resolve(router.encode('buy_', 7))[1] == [7]
+
+
+def test_flipped_signature_byte_is_rejected(router, monkeypatch):
+    monkeypatch.setattr(bot, 'CALLBACK_SECRET', b'test-secret')
+    data = router.encode('buy_', 7, 2)
+    assert router.resolve(data)[1] == [7, 2]
+    for index in range(-bot.CALLBACK_SIGNATURE_BYTES, 0):
+        assert router.resolve(flip(data, index)) == (None, None)
+    # So is a tampered payload under the original signature
+    assert router.resolve(flip(data, 1)) == (None, None)
+
+
+def test_data_signed_with_another_secret_is_rejected(router, monkeypatch):
+    monkeypatch.setattr(bot, 'CALLBACK_SECRET', b'old-secret')
+    data = router.encode('buy_', 7, 2)
+    monkeypatch.setattr(bot, 'CALLBACK_SECRET', b'test-secret')
+    assert router.resolve(data) == (None, None)
+
+
+def test_legacy_data_is_refused_when_signing(router, monkeypatch):
+    assert router.resolve('buy_7_2')[1] == [7, 2]
+    monkeypatch.setattr(bot, 'CALLBACK_SECRET', b'test-secret')
+    assert router.resolve('buy_7_2') == (None, None)
+    assert router.resolve('user_1') == (None, None)
+
+
+@pytest.mark.parametrize('data', [
+    '~',
+    '~A',  # not valid base64
+    '~gA',  # varint with its continuation bit set and nothing after it
+    '~DICA',  # admin_keys_next_ with its plan id cut off mid-varint
+    '~DAEFYWI',  # a str arg that runs past the end
+    '~DAEB_w',  # str arg that isn't UTF-8
+    '~BQcCAw',  # one arg more than buy_ takes
+])
+def test_truncated_or_malformed_payloads_are_rejected(router, secret, data):
+    assert router.resolve(data) == (None, None)
+
+
+def test_every_op_round_trips_through_the_bot_router(monkeypatch):
+    monkeypatch.setattr(bot, 'CALLBACK_SECRET', b'test-secret')
+    router = bot.callback_router
+    for pattern, op in router.opcodes.items():
+        arg_types = router.by_opcode[op][1]
+        args = [123456789 if convert is int else 'unused' for convert in arg_types]
+        route, decoded = router.resolve(router.encode(pattern, *args))
+        assert route is router.by_opcode[op], pattern
+        assert decoded == args, pattern
@@ -0,0 +1,69 @@
+import pytest
+
+import bot
+
+
+def sample_args(arg_types):
+    return [5798359099 if convert is int else 'free' for convert in arg_types]
+
+
+def legacy(pattern, args):
+    return pattern + '_'.join(str(arg) for arg in args)
+
+
+@pytest.fixture
+def router():
+    return bot.callback_router
+
+
+def test_every_exact_route_resolves_to_itself(router):
+    for data, route in router.exact.items():
+        assert router.resolve(data) == (route, []), data
+
+
+def test_every_prefix_route_resolves_legacy_and_encoded(router):
+    for pattern, op in router.opcodes.items():
+        route = router.by_opcode[op]
+        args = sample_args(route[1])
+        assert router.resolve(legacy(pattern, args)) == (route, args), pattern
+        assert router.resolve(router.encode(pattern, *args)) == (route, args), pattern
+
+
+@pytest.mark.parametrize('data, pattern, args', [
+    ('admin_keys_3_free', 'admin_keys_', [3, 'free']),
+    ('admin_keys_next_3_free_1200', 'admin_keys_next_', [3, 'free', 1200]),
+    ('admin_keys_prev_3_free_1200', 'admin_keys_prev_', [3, 'free', 1200]),
+    ('admin_set_price_42', 'admin_set_price_', [42]),
+    ('admin_set_plan_price_42_7', 'admin_set_plan_price_', [42, 7]),
+    ('admin_set_user_42', 'admin_set_user_', [42]),
+    ('admin_set_reseller_42', 'admin_set_reseller_', [42]),
+    ('my_keys_next_9', 'my_keys_next_', [9]),
+])
+def test_longest_prefix_wins(router, data, pattern, args):
+    assert router.resolve(data) == (router.by_opcode[router.opcodes[pattern]], args)
+
+
+def test_registration_order_does_not_matter():
+    # The old elif chain broke if admin_set_price_ came before admin_set_plan_price_
+    routes = [('admin_set_price_', 'reseller price', 1), ('admin_set_plan_price_', 'plan price', 2)]
+    for order in (routes, routes[::-1]):
+        router = bot.CallbackRouter()
+        for pattern, handler, op in order:
+            router.add(pattern, handler, int, int, op=op)
+        assert router.resolve('admin_set_plan_price_42_7')[0][0] == 'plan price'
+        assert router.resolve('admin_set_price_42')[0][0] == 'reseller price'
+
+
+def test_unknown_data_and_extra_args_resolve_to_nothing(router):
+    assert router.resolve('nonsense') == (None, None)
+    assert router.resolve('admin') == (None, None)
+    assert router.resolve('buy_1_2_3') == (None, None)
+
+
+def test_access_flags(router):
+    assert router.resolve('view_products')[0][2] is None
+    assert router.resolve('admin_panel')[0][2] == 'admin'
+    assert router.resolve('admin_set_admin_42')[0][2] == 'owner'
+    # Every admin_ route is guarded
+    routes = list(router.exact.items()) + [(pattern, router.by_opcode[op]) for pattern, op in router.opcodes.items()]
+    assert all(route[2] for pattern, route in routes if pattern.startswith('admin_'))
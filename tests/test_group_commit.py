@@ -0,0 +1,98 @@
+import asyncio
+import threading
+
+from conftest import free_keys
+
+
+def test_catalog_stock_with_edit_and_purchase_in_one_batch(database, async_db, plan):
+    database.create_user(1)
+    database.update_user_balance(1, 100, 'admin_add')
+    product_id = database.catalog.get_plan(plan)[1]
+    
+    batch_sizes = []
+    run_batch = database.run_batch
+    def spy(calls):
+        batch_sizes.append(len(calls))
+        return run_batch(calls)
+    database.run_batch = spy
+    
+    async def writes():
+        return await asyncio.gather(
+            async_db.update_product(product_id, 'Renamed', 'Description'),
+            async_db.create_order(1, plan, 2),
+            async_db.add_keys_to_plan(plan, ['new-1', 'new-2', 'new-3']),
+        )
+    
+    results = asyncio.run(writes())
+    assert results[1][0] is True
+    assert batch_sizes == [3]
+    assert free_keys(database, plan) == 11
+    assert database.catalog.get_stock(plan) == 11
+
+
+def test_failed_write_rolls_back_alone(database, async_db):
+    database.create_user(1)
+    database.create_user(2)
+    
+    def fail():
+        database.conn.execute('UPDATE users SET balance_cents = 999 WHERE user_id = 2')
+        raise ValueError('boom')
+    
+    async def writes():
+        return await asyncio.gather(
+            async_db.run(fail),
+            async_db.update_user_balance(1, 5, 'admin_add'),
+            return_exceptions=True,
+        )
+    
+    failed, _ = asyncio.run(writes())
+    assert isinstance(failed, ValueError)
+    assert database.get_user_by_id(1)[4] == 5
+    assert database.get_user_by_id(2)[4] == 0
+    assert database.conn.execute('SELECT balance_cents FROM users WHERE user_id = 2').fetchone()[0] == 0
+
+
+def test_new_user_is_created_by_the_writer(database, async_db):
+    writer_threads = []
+    create_user = database.create_user
+    def spy(user_id):
+        writer_threads.append(threading.current_thread().name)
+        return create_user(user_id)
+    database.create_user = spy
+    
+    assert database.load_user(7) is None
+    assert database.get_user_by_id(7) is None
+    
+    database.queue_profile(7, ('seven', 'Se', 'Ven'))
+    user = asyncio.run(async_db.get_user(7))
+    assert user[0] == 7 and user[1] == 'seven'
+    assert writer_threads == ['db-write']
+    assert asyncio.run(async_db.get_user(7)) == user
+    assert len(writer_threads) == 1
+
+
+def test_failing_commit_hook_does_not_fail_committed_writes(database, async_db, caplog):
+    database.create_user(1)
+    
+    def write_with_bad_hook():
+        with database.transaction() as conn:
+            conn.execute('UPDATE users SET username = ? WHERE user_id = 1', ('renamed',))
+            database.after_commit(lambda: 1 / 0)
+        return 'done'
+    
+    async def writes():
+        return await asyncio.gather(
+            async_db.run(write_with_bad_hook),
+            async_db.update_user_balance(1, 5, 'admin_add'),
+        )
+    
+    assert asyncio.run(writes())[0] == 'done'
+    assert database.get_user_by_id(1)[1] == 'renamed'
+    assert database.get_user_by_id(1)[4] == 5
+    assert 'Error in commit hook: division by zero' in caplog.text
+
+
+def test_writer_fsyncs_commits(database):
+    assert database.conn.execute('PRAGMA synchronous').fetchone()[0] == 2  # FULL
+    with database.reader() as conn:
+        assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
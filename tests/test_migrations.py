@@ -0,0 +1,33 @@
+import sqlite3
+
+import bot
+
+
+def test_keys_sold_twice_survive_the_unique_key_migration(tmp_path, monkeypatch):
+    # A v3 database from before key values were deduplicated: 'DUP' was imported
+    # twice and both copies sold, 'SPARE' twice with one copy sold, 'FREE' twice unsold
+    path = str(tmp_path / 'bot_database.db')
+    monkeypatch.setattr(bot, 'MIGRATIONS', bot.MIGRATIONS[:3])
+    bot.Database(path)
+    monkeypatch.undo()
+    
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO products (product_id, name) VALUES (1, 'Product')")
+    conn.execute("INSERT INTO product_plans (plan_id, product_id, validity_days, base_price, stock) VALUES (1, 1, 30, 1.0, 4)")
+    conn.executemany(
+        'INSERT INTO product_keys (product_id, plan_id, key_value, is_used, used_by, order_id) VALUES (1, 1, ?, ?, ?, ?)',
+        [('DUP', 1, 5, 1), ('DUP', 1, 6, 2), ('SPARE', 0, None, None), ('SPARE', 1, 7, 3), ('FREE', 0, None, None), ('FREE', 0, None, None)],
+    )
+    conn.commit()
+    conn.close()
+    
+    database = bot.Database(path)
+    assert database.conn.execute('PRAGMA user_version').fetchone()[0] == len(bot.MIGRATIONS)
+    rows = database.conn.execute(
+        'SELECT key_value, is_used, order_id, is_duplicate FROM product_keys ORDER BY key_id'
+    ).fetchall()
+    assert rows == [('DUP', 1, 1, 0), ('DUP', 1, 2, 1), ('SPARE', 1, 3, 0), ('FREE', 0, None, 0)]
+    assert database.catalog.get_stock(1) == 1
+    
+    # The flagged copy doesn't stop imports from skipping a value the plan already has
+    assert database.add_keys_to_plan(1, ['DUP', 'SPARE', 'FREE', 'NEW']) == (1, 3, 0)
@@ -0,0 +1,32 @@
+import asyncio
+
+import bot
+
+
+def test_failed_write_is_retried_without_clobbering_newer_data(database, async_db):
+    persistence = bot.SQLitePersistence(async_db)
+    save_persisted = async_db.save_persisted
+    calls = []
+    
+    async def flaky(table, rows):
+        calls.append((table, dict(rows)))
+        if len(calls) == 1:
+            # Newer data for user 1 arrives while the failing write is in flight
+            await persistence.update_user_data(1, {'step': 2})
+            raise RuntimeError('database is locked')
+        return await save_persisted(table, rows)
+    async_db.save_persisted = flaky
+    
+    async def run():
+        await persistence.update_user_data(1, {'step': 1})
+        await persistence.update_user_data(2, {'step': 1})
+        await persistence.update_chat_data(3, {'chat': True})
+        await persistence.write_task
+        assert persistence.pending['user_data']
+        await persistence.flush()
+        return await persistence.get_user_data(), await persistence.get_chat_data()
+    
+    user_data, chat_data = asyncio.run(run())
+    assert user_data == {1: {'step': 2}, 2: {'step': 1}}
+    assert chat_data == {3: {'chat': True}}
+    assert not any(persistence.pending.values())
@@ -0,0 +1,85 @@
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bot
+from conftest import free_keys
+
+BUYERS = range(1, 41)
+QUANTITIES = [1, 1, 2, 3]
+FAILURES = {'Insufficient balance', 'Product out of stock', 'Only 1 keys left in stock', 'Only 2 keys left in stock'}
+
+
+def fund_buyers(database, rng):
+    # 10 keys at $1.00, 40 buyers with $0-$5 racing for them in mixed quantities
+    for user_id in BUYERS:
+        database.create_user(user_id)
+        database.update_user_balance(user_id, rng.randint(0, 5), 'admin_add')
+
+
+def check_store(database, plan, results, stocked=10):
+    sold = [key for ok, keys in results if ok for key in keys]
+    assert len(sold) == len(set(sold)) == stocked
+    assert {reason for ok, reason in results if not ok} <= FAILURES
+    
+    conn = database.conn
+    assert conn.execute('SELECT COUNT(*) FROM users WHERE balance_cents < 0').fetchone()[0] == 0
+    assert conn.execute('SELECT stock FROM product_plans WHERE plan_id = ?', (plan,)).fetchone()[0] == free_keys(database, plan) == 0
+    assert conn.execute('SELECT COUNT(*) FROM product_keys WHERE is_used = 1 AND order_id IS NULL').fetchone()[0] == 0
+    assert conn.execute('SELECT SUM(quantity) FROM orders').fetchone()[0] == stocked
+    
+    # Double-entry: every entry balances, and wallets match users.balance_cents
+    assert conn.execute('SELECT SUM(amount_cents) FROM ledger_postings').fetchone()[0] == 0
+    assert conn.execute(
+        'SELECT COUNT(*) FROM (SELECT entry_id FROM ledger_postings GROUP BY entry_id HAVING SUM(amount_cents) != 0)'
+    ).fetchone()[0] == 0
+    assert conn.execute('''
+        SELECT COUNT(*) FROM users u
+        WHERE u.balance_cents != (SELECT COALESCE(SUM(amount_cents), 0) FROM ledger_postings WHERE user_id = u.user_id)
+    ''').fetchone()[0] == 0
+
+
+def test_concurrent_orders_never_sell_a_key_twice(database, async_db, plan):
+    rng = random.Random(3)
+    fund_buyers(database, rng)
+    
+    async def orders():
+        return await asyncio.gather(*(
+            async_db.create_order(user_id, plan, rng.choice(QUANTITIES))
+            for user_id in BUYERS for _ in range(3)
+        ))
+    
+    check_store(database, plan, asyncio.run(orders()))
+    assert database.catalog.get_stock(plan) == 0
+
+
+def test_two_databases_on_one_file_never_sell_a_key_twice(database, plan):
+    # Two instances on the same file, as in webhook mode behind a load balancer:
+    # each has its own writer connection, so purchases only meet inside SQLite.
+    # Eight buyer threads, four per instance, start together; 30 more keys keep
+    # the race going past the first few orders.
+    rng = random.Random(5)
+    fund_buyers(database, rng)
+    database.add_keys_to_plan(plan, [f'extra-{i}' for i in range(30)])
+    instances = (database, bot.Database(database.path))
+    orders = [(user_id, rng.choice(QUANTITIES)) for user_id in BUYERS for _ in range(3)]
+    rng.shuffle(orders)
+    start = threading.Barrier(8)
+    
+    def buyer(worker):
+        instance = instances[worker % 2]
+        start.wait()
+        results = []
+        for user_id, quantity in orders[worker::8]:
+            results.append(instance.create_order(user_id, plan, quantity))
+            # A real buyer doesn't fire orders back to back; the gap lets the
+            # other instance's busy retries get SQLite's write lock in between
+            time.sleep(0.001)
+        return results
+    
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        per_worker = list(pool.map(buyer, range(8)))
+    
+    check_store(database, plan, [result for results in per_worker for result in results], stocked=40)
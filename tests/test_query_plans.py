@@ -0,0 +1,47 @@
+import pytest
+
+import bot
+
+
+def explain(database, sql, params):
+    with database.reader() as conn:
+        conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        return [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()]
+
+
+def test_no_hot_query_scans_a_table(database):
+    assert database.find_unindexed_queries() == []
+
+
+@pytest.mark.parametrize('name', sorted(bot.INDEXED_QUERIES))
+def test_hot_query_uses_an_index_in_order(database, name):
+    # Same check as the startup warning, per query so a failure shows its plan
+    sql, params = bot.INDEXED_QUERIES[name]
+    plan = explain(database, sql, params)
+    assert not any(bot.is_unindexed_step(step) for step in plan), plan
+
+
+def test_startup_check_reports_a_sort(database):
+    # Without idx_orders_user_order the user's orders are still found through
+    # another index but sorted in a temp b-tree
+    database.conn.execute('DROP INDEX idx_orders_user_order')
+    assert 'user orders page' in database.find_unindexed_queries()
+
+
+def test_every_page_variant_runs(database, plan):
+    # The methods build their SQL with the same *_page_sql helpers checked above
+    for backwards in (False, True):
+        for cursor in (None, 1):
+            database.get_users_page(cursor=cursor, backwards=backwards)
+            database.get_orders_page(cursor=cursor, backwards=backwards)
+            database.get_orders_page(user_id=1, cursor=cursor, backwards=backwards)
+            database.get_purchased_keys_page(1, cursor=cursor, backwards=backwards)
+            for is_used in (None, 0, 1):
+                database.get_keys_page(plan, is_used=is_used, cursor=cursor, backwards=backwards)
+    
+    keys, has_prev, has_next = database.get_keys_page(plan, limit=4)
+    assert [key[1] for key in keys] == ['key-0', 'key-1', 'key-2', 'key-3']
+    assert (has_prev, has_next) == (False, True)
+    keys, has_prev, has_next = database.get_keys_page(plan, cursor=keys[-1][0], limit=4)
+    assert [key[1] for key in keys] == ['key-4', 'key-5', 'key-6', 'key-7']
+    assert (has_prev, has_next) == (True, True)
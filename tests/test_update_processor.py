@@ -0,0 +1,53 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import bot
+
+
+def update_from(user_id):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id))
+
+
+def test_busy_user_does_not_hold_other_users_slots():
+    async def scenario():
+        processor = bot.UserOrderedUpdateProcessor(4)
+        finished = {}
+        
+        async def handle(name, seconds):
+            await asyncio.sleep(seconds)
+            finished[name] = time.monotonic() - start
+        
+        start = time.monotonic()
+        tasks = [
+            asyncio.create_task(processor.process_update(update_from(1), handle(f'slow-{i}', 0.1)))
+            for i in range(6)
+        ]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(processor.process_update(update_from(2), handle('quick', 0.01))))
+        await asyncio.gather(*tasks)
+        return finished, processor
+    
+    finished, processor = asyncio.run(scenario())
+    assert finished['quick'] < 0.05
+    assert [name for name in sorted(finished, key=finished.get) if name.startswith('slow')] == [f'slow-{i}' for i in range(6)]
+    assert finished['slow-5'] >= 0.6
+    assert processor.user_locks == {}
+
+
+def test_concurrency_limit_still_applies_across_users():
+    async def scenario():
+        processor = bot.UserOrderedUpdateProcessor(2)
+        running = peak = 0
+        
+        async def handle():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+        
+        await asyncio.gather(*(processor.process_update(update_from(user_id), handle()) for user_id in range(6)))
+        return peak
+    
+    assert asyncio.run(scenario()) == 2